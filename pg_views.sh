@@ -11,11 +11,15 @@ CREATE VIEW genera AS
 
 # document count per-species - corresponding to the per-status boxplot
 # under 'species coverage' on the dashboard
+# (reads the normalised link_species table written by find_species.py,
+# rather than splitting links.species over the whole table - joined with links,
+# as the dashboard is, so that rows of deleted links are not counted)
 CREATE VIEW doc_count AS
     SELECT foo."SISRecID",name_com,name_sci,status,count FROM
-        (SELECT CAST(unnest(string_to_array(species, '|')) AS Integer) AS "SISRecID",count(*) 
-            FROM links
-            GROUP BY "SISRecID") AS foo
+        (SELECT sisrecid AS "SISRecID",count(DISTINCT link_species.link) 
+            FROM link_species
+                INNER JOIN links ON links.link = link_species.link
+            GROUP BY sisrecid) AS foo
         INNER JOIN
         (SELECT status,name_com,name_sci,"SISRecID" 
             FROM species) AS bar
@@ -23,6 +27,14 @@ CREATE VIEW doc_count AS
     ORDER BY status,count desc;
 
 
+# all documents mentioning a given species - an index scan on link_species
+SELECT links.link,title,date,score,field,count
+FROM link_species
+    INNER JOIN links ON links.link = link_species.link
+WHERE sisrecid = 22698305
+ORDER BY score DESC;
+
+
 # Journal titles coming from OpenAlex
 SELECT "container.title",count(*) 
 FROM dois 
@@ -40,7 +52,7 @@ WHERE search_term ilike 'openalex%'
     AND language!='en' AND gotscore=1 
     AND score > -8.0 
     AND length(species)>0 
-    AND date > '2010-01-01' 
+    AND pubdate > '2010-01-01' 
 GROUP BY lang 
 ORDER BY count DESC 
 LIMIT 15;
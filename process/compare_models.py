@@ -0,0 +1,92 @@
+"""
+Report comparing relevance models scored side by side by score_for_topic.py.
+
+Reads the table 'model_scores' for records scored against every model being
+compared and prints, for each model, the distribution of scores, then the Spearman
+and Kendall rank correlations between models and the overlap of their top-ranked
+records. By default all models in the table are compared; otherwise give the
+model_ids (as in score_for_topic.py, by default model file names without extension),
+the first as reference.
+
+E.g.
+
+pgfile="/Volumes/blitshare/pg/param.txt"
+
+./process/compare_models.py $pgfile
+./process/compare_models.py $pgfile bli_model_bow_11107 bli_model_bow_candidate
+
+"""
+
+import sys
+import pandas as pd
+from sqlalchemy import create_engine
+
+# read command line
+try:
+	pgfile = sys.argv[1];			    del sys.argv[1]
+except:
+	print("Usage:", sys.argv[0], "pg_file [model_id ...]")
+	sys.exit(1)
+model_ids = sys.argv[1:]
+
+# read Postgres parameters
+try:
+	exec(open(pgfile).read())
+except:
+	print(f'Cannot open file {pgfile}')
+	sys.exit(1)
+
+# open connection to database
+engine = create_engine(f"postgresql://{PGUSER}:{PGPASSWORD}@{PGHOST}:5432/{PGDATABASE}", echo=False)
+
+# sizes of top-ranked sets to compare
+TOPN = [100, 1000, 10000]
+
+##########################################################
+
+def main():
+    df = pd.read_sql_query(
+        'select link, model_id, score from "model_scores"',
+        con = engine)
+    scores = df.pivot(index='link', columns='model_id', values='score')
+    if model_ids != []:
+        missing = [x for x in model_ids if x not in scores.columns]
+        if missing != []:
+            print(f'No scores for model(s) {missing}')
+            return 1
+        scores = scores[model_ids]
+    # only records scored against every model are comparable
+    scores = scores.dropna()
+    if scores.shape[1] < 2:
+        print(f'Need at least two models to compare, found {list(scores.columns)}')
+        return 1
+    print(f'{scores.shape[0]} records scored against {scores.shape[1]} models\n')
+
+    print('Score distributions:')
+    print(scores.describe(percentiles=[0.1, 0.25, 0.5, 0.75, 0.9]).T.to_string())
+
+    print('\nSpearman rank correlation:')
+    print(scores.corr(method='spearman').round(4).to_string())
+
+    print('\nKendall rank correlation:')
+    print(scores.corr(method='kendall').round(4).to_string())
+
+    # how many of the reference model's top-n records each model also ranks top-n
+    reference = scores.columns[0]
+    print(f'\nOverlap of top-ranked records with {reference}:')
+    overlap = dict()
+    for n in TOPN:
+        if n > scores.shape[0]:
+            continue
+        top_ref = set(scores[reference].nlargest(n).index)
+        overlap[f'top {n}'] = {m: len(top_ref & set(scores[m].nlargest(n).index)) / n
+                               for m in scores.columns}
+    print(pd.DataFrame(overlap).round(3).to_string())
+    return 0
+
+##########################################################
+
+if __name__ == '__main__':
+    main()
+
+# DONE
\ No newline at end of file
@@ -1,5 +1,7 @@
 """
 Reviews all database records where language is not present and uses spaCy language detector to determine language.
+Detection now calls the detector behind the spaCy component directly (see language_id.py), on
+batches of records spread over worker processes - same language codes, no spaCy model.
 
 E.g. 
 
@@ -8,14 +10,17 @@ pgfile="/Volumes/blitshare/pg/param.txt"
 
 python3 ./process/detect_language.py $pgfile
 
+To check agreement with the spaCy pipeline on records already tagged:
+
+python3 ./process/language_id_benchmark.py $pgfile 2000
+
 
 """
 
 import sys
-import spacy
-from spacy.language import Language
-
-from spacy_language_detection import LanguageDetector
+import time
+import language_id as li
+import pgstream
 from sqlalchemy import create_engine, update, select, bindparam
 from sqlalchemy import Table, Column, String, Integer, Float, MetaData
 
@@ -46,16 +51,13 @@ links = Table('links', metadata_obj,
               Column('language', String)
              )
 
-def get_lang_detector(nlp, name):
-    return LanguageDetector(seed=42)  # We use the seed 42
-
-# load NLP pipeline
-nlp = spacy.load('en_core_web_md') 
-Language.factory("language_detector", func=get_lang_detector)
-nlp.add_pipe('language_detector', last=True)
+# run budget (None for no limit) and commit size
+MAXRECORDS = None
+TIMEBUDGET = 3600
+CHUNKSIZE = 500
 
-# global constants
-MAXCALLS = 5000
+# detections less probable than this are counted in the summary
+LOWCONFIDENCE = 0.9
 
 ##########################################################
 
@@ -70,55 +72,47 @@ def main():
             links.c.gottext == 1,
             links.c.language == ''
             )
-    # initialise update list for this domain
-    update_list = []
-
-    # connect to database
-    with engine.connect() as conn:
-        records = conn.execute(selecter)
-    # MAIN LOOP
-    for row in records:
-        thislink = row.link
-        # stop if reached MAXCALLS
-        if ncalls >= MAXCALLS:
-            break
-        # skip bad records
-        if row.title == "" or row.title == None or row.abstract == "" or row.abstract == None:
-            continue
-        ncalls += 1
-        # set text to score
-        try:
-            text = '\n'.join([row.title, row.abstract])
-            doc = nlp(text)
-            language = doc._.language['language']
-            update_list += [{
-                    'linkvalue': thislink,
-                    'langvalue': language
-                }]
-            ngood += 1
-            if language != 'en':
-                print(f'{ncalls}: {language}')
-                print(f'{row.title}')
-        except:
-            continue
-    # END OF MAIN LOOP
-
-    # finish if no output
-    if update_list == []:
-        print(f'No language updates to make - read {ncalls} records')
-        return 0
-    # ... otherwise make update instructions
+    # make update instructions
     updater = links.update().\
             where(links.c.link == bindparam('linkvalue')).\
             values(
                 language = bindparam('langvalue')
                 )
-    # ... and commit to remote table
-    with engine.connect() as conn:
-        conn.execute(updater, update_list)
-        conn.commit()
-    
-    print(f'Read {ncalls} records, successful language-id {ngood}')
+    # initialise counters for updates and confidence
+    nupdates = 0
+    totalprob = 0.0
+    nlow = 0
+
+    # MAIN LOOP - over chunks streamed from the database, detected in one batch
+    start = time.time()
+    with li.make_pool() as pool:
+        for rows in pgstream.stream_chunks(engine, selecter, CHUNKSIZE, MAXRECORDS, TIMEBUDGET):
+            # skip bad records
+            rows = [row for row in rows
+                    if not (row.title == "" or row.title == None or row.abstract == "" or row.abstract == None)]
+            ncalls += len(rows)
+            texts = ['\n'.join([row.title, row.abstract]) for row in rows]
+            update_list = []
+            for row, (language, prob) in zip(rows, li.detect_batch(texts, pool)):
+                update_list += [{
+                        'linkvalue': row.link,
+                        'langvalue': language
+                    }]
+                ngood += 1
+                totalprob += prob
+                if prob < LOWCONFIDENCE:
+                    nlow += 1
+                if language != 'en':
+                    print(f'{ngood}: {language} ({prob:.2f})')
+                    print(f'{row.title}')
+            # commit this chunk
+            nupdates += pgstream.write_chunk(engine, updater, update_list)
+    # END OF MAIN LOOP
+    elapsed = max(time.time() - start, 1e-6)
+
+    if ngood > 0:
+        print(f'{ncalls/elapsed:.1f} records/sec, mean confidence {totalprob/ngood:.3f}, {nlow} below {LOWCONFIDENCE}')
+    print(f'Read {ncalls} records, successful language-id {ngood}, {nupdates} updates written')
     return 0
 
 ##########################################################
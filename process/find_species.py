@@ -1,5 +1,5 @@
 """
-Read text columns 'title/abstract/pdftext' and update column 'species'.
+Read text columns 'title/abstract/pdftext/pdftext_translation' and update column 'species'.
 'species' is a string formed by concatenating SISRecID's with | delimiter.
 over the set of fields specified, using a taxonomy given as a command line argument.
 
@@ -11,6 +11,42 @@ birdfile='/Volumes/blitshare/data/BirdLife_species_list_Jan_2022.xlsx'
 
 ./process/find_species.py $pgfile $birdfile
 
+An optional third argument selects the matching backend:
+
+    trie        token trie built from the taxonomy (default, see species_matcher.py)
+    spacy       spaCy EntityRuler over en_core_web_md
+    compare     run both, report any differences and write nothing
+    retag       re-tag after a taxonomy update (see below)
+
+./process/find_species.py $pgfile $birdfile compare
+
+Alongside 'species', each record's distinct name tokens (words occurring in some
+taxonomy name) are written to the token index table 'species_tokens'. When BirdLife
+publishes a new species list, retag mode diffs it against the previous list and
+uses the index to rescan only records that could contain an added, removed or
+re-assigned name, patching their species strings:
+
+oldbirdfile='/Volumes/blitshare/data/BirdLife_species_list_Jan_2021.xlsx'
+./process/find_species.py $pgfile $birdfile retag $oldbirdfile
+
+Re-tagging is idempotent, so a retag run that stops on its time budget is simply
+run again.
+
+Species mentions are also written to the normalised table 'link_species', one row
+per (link, sisrecid, field) with a mention count, in the same transaction as the
+species string. Records tagged before link_species existed are rescanned, once,
+with
+
+./process/find_species.py $pgfile $birdfile backfill
+
+The spacy backend streams records through nlp.pipe() in batches of BATCH_SIZE
+over N_PROCESS worker processes, loading only the tokenizer and entity ruler.
+All backends report throughput in docs/sec and chars/sec.
+
+Long texts (full pdftext) are split into windows of at most WINDOWSIZE characters
+at paragraph or sentence boundaries, overlapping by more than the longest name,
+and the species found in each window are merged.
+
 """
 
 import sys
@@ -19,18 +55,30 @@ from spacy.matcher import PhraseMatcher
 from spacy.tokens import Span
 from spacy.lang.en import English
 from spacy.pipeline import EntityRuler
-import pandas as pd
 import numpy as np
 import re
-from sqlalchemy import create_engine, update, select, bindparam
-from sqlalchemy import Table, Column, String, Integer, Float, MetaData
+import time
+from itertools import groupby
+import species_matcher as sm
+import pgstream
+from sqlalchemy import create_engine, update, select, bindparam, text, exists
+from sqlalchemy import Table, Column, String, Integer, Float, MetaData, Index, ForeignKey
+from sqlalchemy.dialects.postgresql import ARRAY, insert as pg_insert
 
 # read command line
 try:
 	pgfile = sys.argv[1];			    del sys.argv[1]
 	birdfile = sys.argv[1];				del sys.argv[1]	
 except:
-	print("Usage:", sys.argv[0], "pg_file species_file")
+	print("Usage:", sys.argv[0], "pg_file species_file [trie|spacy|compare|backfill|retag old_species_file]")
+	sys.exit(1)
+
+# optional backend
+BACKENDS = ['trie', 'spacy', 'compare', 'retag', 'backfill']
+backend = sys.argv[1] if len(sys.argv) > 1 else 'trie'
+oldbirdfile = sys.argv[2] if len(sys.argv) > 2 else None
+if backend not in BACKENDS or (backend == 'retag' and oldbirdfile == None):
+	print("Usage:", sys.argv[0], "pg_file species_file [trie|spacy|compare|backfill|retag old_species_file]")
 	sys.exit(1)
 
 # read Postgres parameters
@@ -50,88 +98,76 @@ links = Table('links', metadata_obj,
               Column('title', String),
               Column('abstract', String),
 			  Column('pdftext', String),
+              Column('pdftext_translation', String),
 			  Column('species', String),
               Column('badlink', Integer),
               Column('gottext', Integer),
               Column('gotspecies', Integer)
              )
+# (rows go with their links record - see also scrape/remove_duplicates.sh,
+# for tables made before the foreign keys)
+species_tokens = Table('species_tokens', metadata_obj,
+              Column('link', String, ForeignKey('links.link', ondelete='CASCADE'), primary_key=True),
+              Column('tokens', ARRAY(String))
+             )
+Index('species_tokens_gin', species_tokens.c.tokens, postgresql_using='gin')
+link_species = Table('link_species', metadata_obj,
+              Column('link', String, ForeignKey('links.link', ondelete='CASCADE'), primary_key=True),
+              Column('sisrecid', Integer, primary_key=True),
+              Column('field', String, primary_key=True),
+              Column('count', Integer)
+             )
+Index('link_species_sisrecid', link_species.c.sisrecid, link_species.c.link)
+
+# text fields searched, each matched separately
+FIELDS = ['title', 'abstract', 'pdftext', 'pdftext_translation']
 
-# global variables - id_dict will assign species id to commmon/scientific names
-id_dict = dict()
-MAXCALLS = 2000
+# SQL command strings for re-tagging
+unindexed_cmd = '\
+    SELECT link FROM links \
+    WHERE gotspecies = 1 \
+    AND NOT EXISTS ( \
+        SELECT * \
+        FROM species_tokens \
+        WHERE species_tokens.link = links.link \
+        )'
+lookup_cmd = '\
+    SELECT species_tokens.link FROM species_tokens \
+    INNER JOIN links ON links.link = species_tokens.link \
+    WHERE links.gotspecies = 1 \
+    AND species_tokens.tokens @> CAST(:tokens AS text[])'
+regex_cmd = '\
+    SELECT link FROM links \
+    WHERE gotspecies = 1 \
+    AND ( \
+        title ~* :patt \
+        OR abstract ~* :patt \
+        OR pdftext ~* :patt \
+        OR pdftext_translation ~* :patt \
+        )'
+
+# global variables - run budget (None for no limit) and commit size
+MAXRECORDS = None
+TIMEBUDGET = 3600
+CHUNKSIZE = 500
+RETAG_BATCH = 5000
+
+# text window size for matching (must stay below spaCy's nlp.max_length)
+WINDOWSIZE = 100000
+BATCH_SIZE = 64
+N_PROCESS = 8
+
+# en_core_web_md components whose output this stage never reads
+UNUSED_COMPONENTS = ['tok2vec', 'tagger', 'parser', 'senter', 'attribute_ruler', 'lemmatizer', 'ner']
 
 ##########################################################
 # functions
 
-def make_taxonomy_df():
-    '''
-    build species taxonomy
-    '''
-    taxonomy_df = pd.read_excel(birdfile, header=0, dtype=str).fillna('')
-    new_tax_columns = {
-    'Common name': 'comName',
-    'Scientific name': 'sciName',
-    'Synonyms': 'syn',
-    'Alternative common names' : 'alt',
-    'SISRecID' : 'id'
-    }
-    taxonomy_df.rename(columns=new_tax_columns, inplace=True)
-    return taxonomy_df.iloc[:,0:5]
-
-def make_tax_patterns(taxonomy_df):
-    '''
-    build taxonomy_patterns for NLP, and also construct id_dict 
-    '''
-    # Row-wise operations (index i):
-    def com_name(i):
-        global id_dict
-        # outputs a list of names, each one a list of lower-case words
-        main = taxonomy_df.iloc[i,:]['comName'].lower()
-        id_dict[main] = taxonomy_df.at[i,'id']
-        out = [main.split()]
-        if len(taxonomy_df.at[i,'alt']) > 0:
-            alt_names = [x.strip() for x in taxonomy_df.at[i,'alt'].split(',')]
-            alt_names = [x.lower() for x in alt_names]
-            for x in alt_names:
-                id_dict[x] = taxonomy_df.at[i,'id']
-                out += [x.split()]
-        return out
-
-    def sci_name(i):
-        global id_dict
-        # outputs a list of names, each one a list of lower-case words
-        main = taxonomy_df.iloc[i,:]['sciName'].lower()
-        id_dict[main] = taxonomy_df.at[i,'id']
-        out = [main.split()]
-        if len(taxonomy_df.at[i,'syn']) > 0:
-            syn_names = [x.strip() for x in taxonomy_df.at[i,'syn'].split(',')]
-            syn_names = [x.lower() for x in syn_names]
-            for x in syn_names:
-                id_dict[x] = taxonomy_df.at[i,'id']
-                out += [x.split()]
-        return out
-
-    # build pattern list
-    n_species = taxonomy_df.shape[0]
-    tp = [ 
-    [{'label' : 'comName', 'pattern': [{'LOWER': x} for x in y]}
-    for y in com_name(i)]
-    for i in range(n_species) if len(com_name(i)) > 0] + \
-    [
-    [{'label' : 'sciName', 'pattern': [{'LOWER': x} for x in y]}
-    for y in sci_name(i)]
-    for i in range(n_species) if len(sci_name(i)) > 0]
-    # tidy up
-    tp = sum(tp, [])
-    tp = [x for x in tp if len(x['pattern']) > 0]
-    return tp
-
 def make_nlp_pipeline(taxonomy_patterns):
 	'''
 	build NLP pieline
 	'''
-	nlp = spacy.load('en_core_web_md')
-	nlp.add_pipe('sentencizer')
+	nlp = spacy.load('en_core_web_md', exclude = UNUSED_COMPONENTS)
 	config = {
 	"phrase_matcher_attr": None,
 	"validate": True,
@@ -146,94 +182,252 @@ def make_nlp_pipeline(taxonomy_patterns):
 def clean_text(txt):
 	return re.sub('<b>|</b>|<i>|</i>|\\(|\\)', " ", txt)
 
-##########################################################
+def spacy_species(id_dict, doc, skip = 0):
+    '''
+    species id counts and names found by the EntityRuler
+    (as sm.scan_text(), without index tokens)
+    '''
+    ents = [ent for ent in doc.ents if ent.label_ in ['comName','sciName']]
+    id_counts = dict()
+    for ent in ents:
+        if ent.end_char > skip:
+            sisrecid = id_dict[ent.text.lower()]
+            id_counts[sisrecid] = id_counts.get(sisrecid, 0) + 1
+    sp_list = list(set([ent.text.lower() for ent in ents]))
+    return id_counts, sp_list
 
-def main():
-    print("Reading taxonomy file")
-    tax_df = make_taxonomy_df()
-    
-    print("Parsing taxonomy patterns")
-    tax_patterns = make_tax_patterns(tax_df)
-    
-    print("Building NLP pipeline")
-    nlp = make_nlp_pipeline(tax_patterns)
-    
-    print("Locating species mentions")
+def record_windows(records, overlap):
+    '''
+    generator of (text window, (link, species, field, skip)) to search,
+    field by field, where skip is the overlap with the previous window
+    '''
+    for row in records:
+        for field in FIELDS:
+            txt = getattr(row, field)
+            if txt == None or txt == '':
+                continue
+            prev_end = 0
+            for offset, window in sm.text_windows(clean_text(txt), WINDOWSIZE, overlap):
+                yield window, (row.link, row.species, field, max(0, prev_end - offset))
+                prev_end = offset + len(window)
+
+def locate_species(taxonomy, nlp, selecter, max_records, time_budget):
+    '''
+    find species in records returned by selecter, writing species strings,
+    per-field counts to link_species and the token index chunk by chunk,
+    all in one transaction per chunk
+    outputs dict of counters
+    '''
+    id_dict = taxonomy['id_dict']
+    trie = taxonomy['trie']
+    vocab = taxonomy['vocab']
+    overlap = sm.max_name_length(id_dict) + 64
     # initialise counters
-    ncalls = 0
-    ngood = 0
+    ct = {'read': 0, 'good': 0, 'changed': 0, 'diffs': 0, 'updates': 0}
 
-    # select database records
-    selecter = select(links).\
-        where(
-            links.c.gottext == 1,
-            links.c.gotspecies == 0,
-            links.c.badlink == 0
-            )
-    # initialise update list for this domain
+    # make update instructions
+    updater = links.update().\
+                where(links.c.link == bindparam('linkvalue')).\
+                values(
+                    species = bindparam('speciesvalue'),
+                    gotspecies = bindparam('speciesflagvalue')
+                )
+    indexer = pg_insert(species_tokens).\
+                values(
+                    link = bindparam('linkvalue'),
+                    tokens = bindparam('tokensvalue')
+                )
+    indexer = indexer.on_conflict_do_update(
+                    index_elements = ['link'],
+                    set_ = {'tokens': indexer.excluded.tokens}
+                )
+    deleter = link_species.delete().\
+                where(link_species.c.link == bindparam('linkvalue'))
+    inserter = link_species.insert().\
+                values(
+                    link = bindparam('linkvalue'),
+                    sisrecid = bindparam('idvalue'),
+                    field = bindparam('fieldvalue'),
+                    count = bindparam('countvalue')
+                )
+    # initialise update lists for the current chunk
     update_list = []
+    index_list = []
+    delete_list = []
+    insert_list = []
+    def write():
+        return pgstream.write_statements(engine, [
+            (updater, update_list),
+            (indexer, index_list),
+            (deleter, delete_list),
+            (inserter, insert_list)
+            ])[0]
 
-    # connect to database
-    with engine.connect() as conn:
-        records = conn.execute(selecter)
-    # MAIN LOOP  
-    for row in records:
-        thislink = row.link
-        ncalls += 1
-        # stop if reached MAXCALLS
-        if ncalls > MAXCALLS:
-            break
-        # set text to search
-        if row.title != None:
-            txt = row.title
-        else:
-            txt = ''
-        if row.abstract != None:
-            txt = '\n'.join([txt, row.abstract])
-        if row.pdftext != None:
-            txt = '\n'.join([txt, row.pdftext])
-        if txt == '':
+    # stream records from the database
+    records = pgstream.stream_records(engine, selecter, CHUNKSIZE, max_records, time_budget)
+    # stream text windows through the chosen backend
+    texts = record_windows(records, overlap)
+    if backend in ['trie', 'retag', 'backfill']:
+        results = ((txt, key, sm.scan_text(trie, id_dict, vocab, txt, key[3])) for txt, key in texts)
+    else:
+        docs = nlp.pipe(texts, as_tuples=True, batch_size=BATCH_SIZE, n_process=N_PROCESS)
+        results = ((doc.text, key, spacy_species(id_dict, doc, key[3]) + (sm.index_tokens(vocab, doc.text),))
+                   for doc, key in docs)
+
+    # MAIN LOOP - over records, merging results from their windows
+    nchars = 0
+    start = time.time()
+    for (thislink, oldspecies), windows in groupby(results, key=lambda x: x[1][:2]):
+        ct['read'] += 1
+        id_set, sp_set, tok_set = set(), set(), set()
+        trie_ids, trie_names = set(), set()
+        field_counts = dict()
+        for txt, (_, _, field, _), (window_counts, window_names, window_tokens) in windows:
+            nchars += len(txt)
+            id_set.update(window_counts.keys())
+            sp_set.update(window_names)
+            tok_set.update(window_tokens)
+            for sisrecid in window_counts:
+                fc = (sisrecid, field)
+                field_counts[fc] = field_counts.get(fc, 0) + window_counts[sisrecid]
+            if backend == 'compare':
+                window_ids, window_names = sm.find_species(trie, id_dict, txt)
+                trie_ids.update(window_ids)
+                trie_names.update(window_names)
+        id_list, sp_list = list(id_set), list(sp_set)
+        if backend == 'compare':
+            if trie_ids != id_set:
+                ct['diffs'] += 1
+                print(f"{ct['read']}: {thislink}")
+                print(f'  spacy only: {sorted(sp_set - trie_names)}')
+                print(f'  trie only: {sorted(trie_names - sp_set)}')
             continue
-        # otherwise proceed
-        txt = clean_text(txt)
-        doc = nlp(txt)
-        ents = [ent.label_ for ent in doc.ents]
-        if 'comName' in ents or 'sciName' in ents:
-            sp_list = [ent.text.lower() for ent in doc.ents if ent.label_ in ['comName','sciName']]
-            id_list = [id_dict[s] for s in sp_list]
-            id_list = list(set(id_list))
-            sp_list = list(set(sp_list)) # only used for verbose output
-            id_string = '|'.join(id_list)
-        else:
-            sp_list = []
-            id_string = ""
+        id_string = '|'.join(id_list)
         update_list += [{
                         'linkvalue': thislink,
-                        'speciesvalue': id_string, 
+                        'speciesvalue': id_string,
                         'speciesflagvalue': 1
                         }]
+        index_list += [{
+                        'linkvalue': thislink,
+                        'tokensvalue': sorted(tok_set)
+                        }]
+        delete_list += [{'linkvalue': thislink}]
+        insert_list += [{
+                        'linkvalue': thislink,
+                        'idvalue': int(sisrecid),
+                        'fieldvalue': field,
+                        'countvalue': count
+                        } for (sisrecid, field), count in field_counts.items()]
         if len(sp_list) > 0:
-            ngood += 1
-            print(f'{ncalls}: {id_string} {sp_list}')
-    # END OF MAIN LOOP 
+            ct['good'] += 1
+        if id_set != set((oldspecies or '').split('|')) - {''}:
+            ct['changed'] += 1
+            print(f"{ct['read']}: {id_string} {sp_list}")
+        # commit each full chunk
+        if len(update_list) >= CHUNKSIZE:
+            ct['updates'] += write()
+            update_list.clear()
+            index_list.clear()
+            delete_list.clear()
+            insert_list.clear()
+    # END OF MAIN LOOP
+    elapsed = max(time.time() - start, 1e-6)
+    print(f"{backend}: {ct['read']/elapsed:.1f} docs/sec, {nchars/elapsed:.0f} chars/sec")
+
+    # commit what remains (comparison writes nothing)
+    if backend != 'compare':
+        ct['updates'] += write()
+    return ct
+
+def retag_candidates(old_taxonomy, new_taxonomy):
+    '''
+    links of already-tagged records that could contain a name affected by the
+    change of taxonomy, found from the token index species_tokens
+    '''
+    affected = sm.diff_taxonomies(old_taxonomy['id_dict'], new_taxonomy['id_dict'])
+    old_vocab = old_taxonomy['vocab']
+    new_tokens = sorted(new_taxonomy['vocab'] - old_vocab)
+    print(f'{len(affected)} names affected, {len(new_tokens)} new name tokens')
+    candidates = set()
+    with engine.connect() as conn:
+        # (1) records not yet in the token index
+        result = conn.execute(text(unindexed_cmd))
+        candidates.update([row.link for row in result])
+        print(f'{len(candidates)} tagged records not yet indexed')
+        # (2) records holding every indexed token of some affected name
+        for name in affected:
+            toks = sm.index_tokens(old_vocab, name)
+            if len(toks) == 0:
+                continue
+            result = conn.execute(text(lookup_cmd), {'tokens': toks})
+            candidates.update([row.link for row in result])
+        # (3) tokens outside the old vocabulary are not in the index -
+        #     a single regex pass over stored text finds records containing them
+        if len(new_tokens) > 0:
+            patt = '\\m(' + '|'.join(new_tokens) + ')\\M'
+            result = conn.execute(text(regex_cmd), {'patt': patt})
+            candidates.update([row.link for row in result])
+    return sorted(candidates)
 
-    # finish if no output
-    if update_list == []:
-        print(f'Read {ncalls} records, found species in {ngood}')
+##########################################################
+
+def main():
+    print("Loading taxonomy")
+    taxonomy = sm.compile_taxonomy(birdfile)
+
+    nlp = None
+    if backend in ['spacy', 'compare']:
+        print("Building NLP pipeline")
+        nlp = make_nlp_pipeline(taxonomy['patterns'])
+
+    # make sure token index and link_species exist
+    metadata_obj.create_all(engine, tables = [species_tokens, link_species], checkfirst = True)
+
+    # re-tag mode: rescan only records that may be affected by the taxonomy change
+    if backend == 'retag':
+        print("Loading previous taxonomy")
+        old_taxonomy = sm.compile_taxonomy(oldbirdfile)
+        print("Finding candidate records")
+        candidates = retag_candidates(old_taxonomy, taxonomy)
+        print(f'Re-tagging {len(candidates)} records')
+        total = {'read': 0, 'changed': 0, 'updates': 0}
+        start = time.time()
+        for i in range(0, len(candidates), RETAG_BATCH):
+            remaining = None if TIMEBUDGET == None else TIMEBUDGET - (time.time() - start)
+            if remaining != None and remaining <= 0:
+                print(f'Time budget of {TIMEBUDGET}s used up')
+                break
+            selecter = select(links).\
+                where(links.c.link.in_(candidates[i:(i + RETAG_BATCH)]))
+            ct = locate_species(taxonomy, nlp, selecter, None, remaining)
+            for k in total:
+                total[k] += ct[k]
+        print(f"Re-tagged {total['read']} records, species changed in {total['changed']}, {total['updates']} updates written")
         return 0
-    # ... otherwise make update instructions
-    updater = links.update().\
-                where(links.c.link == bindparam('linkvalue')).\
-                values(
-                    species = bindparam('speciesvalue'),
-                    gotspecies = bindparam('speciesflagvalue')
+
+    print("Locating species mentions")
+    # select database records
+    if backend == 'backfill':
+        selecter = select(links).\
+            where(
+                links.c.gotspecies == 1,
+                links.c.species != '',
+                ~exists().where(link_species.c.link == links.c.link)
                 )
-    # ... and commit to remote table
-    with engine.connect() as conn:
-        conn.execute(updater, update_list)
-        conn.commit()
+    else:
+        selecter = select(links).\
+            where(
+                links.c.gottext == 1,
+                links.c.gotspecies == 0,
+                links.c.badlink == 0
+                )
+    ct = locate_species(taxonomy, nlp, selecter, MAXRECORDS, TIMEBUDGET)
 
-    print(f'Read {ncalls} records, found species in {ngood}')
+    if backend == 'compare':
+        print(f"Read {ct['read']} records, backends differ on {ct['diffs']}")
+    else:
+        print(f"Read {ct['read']} records, found species in {ct['good']}, {ct['updates']} updates written")
     return 0
 
 ##########################################################
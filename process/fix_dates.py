@@ -9,13 +9,24 @@ pgfile="/Volumes/blitshare/pg/param.txt"
 
 ./process/fix_dates.py $pgfile
 
+Normalisation is incremental: the flag 'datenorm' is set once a row's date has been
+normalised, and a trigger on links clears it whenever the date is inserted or changed
+by anyone else (ingest scripts, step (1) below) - both added once by the migration
+migrate_datenorm.py, run before this script. Only flagged rows are read, and each
+distinct date string is parsed once - by regex for the formats we usually see,
+with dateutil as the fallback. The typed column 'pubdate' follows 'date' through
+its own trigger (see migrate_pubdate.py).
+
 """
 
+import re
 import sys 
+from datetime import date
+from functools import lru_cache
+import pgstream
 from sqlalchemy import create_engine, update, select, bindparam, text
-from sqlalchemy import Table, Column, String, MetaData
+from sqlalchemy import Table, Column, String, Integer, MetaData
 from dateutil.parser import parse
-#from datetime import datetime
 
 # read command line
 try:
@@ -66,13 +77,53 @@ metadata_obj = MetaData()
 links = Table('links', metadata_obj,
               Column('link', String, primary_key=True),
               Column('date', String),
-              Column('doi', String)
+              Column('doi', String),
+              Column('datenorm', Integer)
              )
 dois = Table('dois', metadata_obj,
               Column('doi', String, primary_key=True),
               Column('created', String)
              )
 
+# commit size
+CHUNKSIZE = 5000
+
+# fast paths for the date formats most often seen
+iso_patt = re.compile(r'^(\d{4})-(\d{2})-(\d{2})$')
+mon_patt = re.compile(r'^(\d{4})-([A-Za-z]{3})-(\d{1,2})$')
+pdf_patt = re.compile(r'^D:(\d{4})(\d{2})(\d{2})')
+MONTHS = {m: i+1 for i, m in enumerate(['jan','feb','mar','apr','may','jun','jul','aug','sep','oct','nov','dec'])}
+
+##########################################################
+# functions
+
+@lru_cache(maxsize=None)
+def normalise_date(thisdate):
+    """
+    yyyy-mm-dd string for a raw date string, or None if it cannot be parsed
+    (memoized, as the same strings recur across many records)
+    """
+    s = thisdate.strip()
+    try:
+        m = iso_patt.match(s)
+        if m:
+            return date(int(m[1]), int(m[2]), int(m[3])).strftime("%Y-%m-%d")
+        m = mon_patt.match(s)
+        if m and m[2].lower() in MONTHS:
+            return date(int(m[1]), MONTHS[m[2].lower()], int(m[3])).strftime("%Y-%m-%d")
+        m = pdf_patt.match(s)
+        if m:
+            return date(int(m[1]), int(m[2]), int(m[3])).strftime("%Y-%m-%d")
+    except ValueError:
+        pass
+    # ... otherwise the general parser
+    try:
+        return parse(thisdate, fuzzy=True).date().strftime("%Y-%m-%d")
+    except:
+        return None
+
+##########################################################
+
 def main():
     # (1) send SQL command to update dates to value against corresponding DOI
     print('Aligning all dates with DOI values to CrossRef data ...')
@@ -87,49 +138,46 @@ def main():
             conn.execute(text(update_cmd))
             conn.commit()
     
-    # (2) normalise all dates in main table
-    print('Normalising all dates to yyyy-mm-dd format ...')
-    update_list = []
+    # (2) normalise dates inserted or changed since the last run
+    print('Normalising new dates to yyyy-mm-dd format ...')
     # select relevant records
-    selecter = select(links).\
-        where(links.c.date != None)
+    selecter = select(links.c.link, links.c.date).\
+        where(links.c.datenorm == 0)
+    # make update instructions - setting the flag, so the trigger leaves it alone
+    updater = links.update().\
+        where(links.c.link == bindparam('linkvalue')).\
+        values(
+            date = bindparam('datevalue'),
+            datenorm = 1
+            )
     # process results
     ndates = 0
-    nupdates = 0
-    with engine.connect() as conn:
-        result2 = conn.execute(selecter)
-        for row in result2:
+    nchanged = 0
+    nfailed = 0
+    for rows in pgstream.stream_chunks(engine, selecter, CHUNKSIZE):
+        update_list = []
+        for row in rows:
             ndates += 1
             thisdate = row.date
-            try:
-                newdate = parse(thisdate, fuzzy=True).date()
-                newdate = newdate.strftime("%Y-%m-%d")
-            except:
+            newdate = None if thisdate == None else normalise_date(thisdate)
+            if newdate == None:
+                # unparseable (or no date) - flag as done, the trigger
+                # clears the flag if the date changes
+                if thisdate != None:
+                    nfailed += 1
                 newdate = thisdate
-                continue
-            if newdate != thisdate:
-                nupdates += 1
-                update_list += [{
-                    'linkvalue': row.link,
-                    'datevalue': newdate
-                    }]
+            elif newdate != thisdate:
+                nchanged += 1
                 print(f'{thisdate} --> {newdate}')
-    # quit if no output
-    if update_list == []:
-        print(f"{nupdates} dates changed out of {ndates}")
-        return 0
-    
-    # make update instructions 
-    updater = links.update().\
-        where(links.c.link == bindparam('linkvalue')).\
-        values(date=bindparam('datevalue'))
-    
-    # ... and commit to database
-    with engine.connect() as conn:
-        conn.execute(updater, update_list)
-        conn.commit()
+            update_list += [{
+                'linkvalue': row.link,
+                'datevalue': newdate
+                }]
+        # commit this chunk
+        pgstream.write_chunk(engine, updater, update_list)
 
-    print(f"{nupdates} dates needed reformatting out of {ndates}")
+    print(f"{nchanged} dates needed reformatting out of {ndates} new or changed, {nfailed} unparseable, "
+          f"{normalise_date.cache_info().currsize} distinct strings parsed")
     return 0
 
 ##########################################################
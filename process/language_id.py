@@ -0,0 +1,79 @@
+"""
+Package of routines for language identification.
+
+Uses the character n-gram detector langdetect directly, configured exactly as the
+spaCy LanguageDetector component (spacy_language_detection) configures it - same
+profiles, same seed - so the language codes written are the same as before, but
+with no spaCy model loaded and no parse. Detection of a batch of texts is spread
+over worker processes, each loading the language profiles once.
+
+E.g.
+
+import language_id as li
+li.detect('Seabird bycatch in longline fisheries')      # --> ('en', 0.99...)
+with li.make_pool() as pool:
+    results = li.detect_batch(texts, pool)
+"""
+
+import multiprocessing
+import langdetect
+from langdetect import detect_langs
+from langdetect.detector_factory import PROFILES_DIRECTORY, DetectorFactory
+from langdetect.lang_detect_exception import LangDetectException
+
+
+##############################################################
+# parameters
+
+SEED = 42
+N_PROCESS = 8
+BATCH_SIZE = 64
+
+# as returned by the spaCy LanguageDetector when detection fails
+UNKNOWN = ('UNKNOWN', 0.0)
+
+
+##############################################################
+# detection
+
+def init_detector(seed = SEED):
+    """
+    Public
+    Loads language profiles and fixes the seed, once per process
+    """
+    factory = DetectorFactory()
+    factory.load_profile(PROFILES_DIRECTORY)
+    factory.set_seed(seed=seed)
+    langdetect.detector_factory._factory = factory
+
+def detect(text):
+    """
+    Public
+    Outputs (language code, probability) of the most probable language of text
+    """
+    if langdetect.detector_factory._factory is None:
+        init_detector()
+    try:
+        best = detect_langs(text)[0]
+        return str(best.lang), float(best.prob)
+    except LangDetectException:
+        return UNKNOWN
+
+def make_pool(processes = N_PROCESS):
+    """
+    Public
+    Pool of worker processes for detect_batch(), forked where possible so that
+    workers do not re-import (and re-run) the calling script
+    """
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+    return context.Pool(processes, initializer=init_detector)
+
+def detect_batch(texts, pool = None, batch_size = BATCH_SIZE):
+    """
+    Public
+    Outputs list of (language code, probability) for a list of texts,
+    over the worker processes of pool if given
+    """
+    if pool is None:
+        return [detect(text) for text in texts]
+    return pool.map(detect, texts, chunksize=batch_size)
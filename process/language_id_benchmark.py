@@ -0,0 +1,131 @@
+"""
+Agreement benchmark of language_id.py against the spaCy language detection pipeline
+previously used by detect_language.py.
+
+Takes a sample of records that already have a language and detects the language of
+title + abstract both ways, reporting agreement, timing and the disagreements found.
+Nothing is written to the database.
+
+E.g.
+
+pgfile="/Volumes/blitshare/pg/param.txt"
+
+python3 ./process/language_id_benchmark.py $pgfile 2000
+
+"""
+
+import sys
+import time
+from collections import Counter
+import spacy
+from spacy.language import Language
+from spacy_language_detection import LanguageDetector
+import language_id as li
+from sqlalchemy import create_engine, select, func
+from sqlalchemy import Table, Column, String, Integer, MetaData
+
+# read command line
+try:
+	pgfile = sys.argv[1];			    del sys.argv[1]
+except:
+	print("Usage:", sys.argv[0], "pg_file [n]")
+	sys.exit(1)
+
+# optional sample size
+try:
+	NSAMPLE = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+except:
+	print("Usage:", sys.argv[0], "pg_file [n]")
+	sys.exit(1)
+
+# read Postgres parameters
+try:
+	exec(open(pgfile).read())
+except:
+	print(f'Cannot open file {pgfile}')
+	sys.exit(1)
+
+# open connection to database
+engine = create_engine(f"postgresql://{PGUSER}:{PGPASSWORD}@{PGHOST}:5432/{PGDATABASE}", echo=False)
+
+# create SQL table
+metadata_obj = MetaData()
+links = Table('links', metadata_obj,
+              Column('link', String, primary_key=True),
+              Column('title', String),
+              Column('abstract', String),
+              Column('gottext', Integer),
+              Column('language', String)
+             )
+
+##########################################################
+
+def spacy_pipeline():
+    """
+    the pipeline previously used by detect_language.py
+    """
+    def get_lang_detector(nlp, name):
+        return LanguageDetector(seed=li.SEED)
+    nlp = spacy.load('en_core_web_md')
+    Language.factory("language_detector", func=get_lang_detector)
+    nlp.add_pipe('language_detector', last=True)
+    return nlp
+
+def main():
+    # sample of records with a language, non-English ones included as far as possible
+    selecter = select(links.c.link, links.c.title, links.c.abstract, links.c.language).\
+        where(
+            links.c.gottext == 1,
+            links.c.language != '',
+            links.c.title != '',
+            links.c.abstract != ''
+            ).\
+        order_by((links.c.language == 'en'), func.random()).\
+        limit(NSAMPLE)
+    with engine.connect() as conn:
+        rows = conn.execute(selecter).fetchall()
+    texts = ['\n'.join([row.title, row.abstract]) for row in rows]
+    print(f'Detecting language of {len(texts)} records')
+
+    # spaCy path
+    nlp = spacy_pipeline()
+    start = time.time()
+    spacy_langs = [doc._.language['language'] for doc in nlp.pipe(texts)]
+    spacy_time = max(time.time() - start, 1e-6)
+
+    # direct path, single process and batched
+    start = time.time()
+    results = li.detect_batch(texts)
+    single_time = max(time.time() - start, 1e-6)
+    start = time.time()
+    with li.make_pool() as pool:
+        results = li.detect_batch(texts, pool)
+    batch_time = max(time.time() - start, 1e-6)
+
+    # compare
+    nagree = 0
+    nstored = 0
+    diffs = Counter()
+    for row, old, (new, prob) in zip(rows, spacy_langs, results):
+        if old == new:
+            nagree += 1
+        else:
+            diffs[(old, new)] += 1
+            print(f'{row.link}: spacy {old}, language_id {new} ({prob:.2f})')
+        if new == row.language:
+            nstored += 1
+
+    n = max(len(texts), 1)
+    print(f'spaCy: {len(texts)/spacy_time:.1f} records/sec')
+    print(f'language_id: {len(texts)/single_time:.1f} records/sec, batched over {li.N_PROCESS} processes {len(texts)/batch_time:.1f} records/sec')
+    print(f'Agreement with spaCy {nagree}/{len(texts)} ({100*nagree/n:.2f}%), with stored language {nstored}/{len(texts)} ({100*nstored/n:.2f}%)')
+    for (old, new), ct in diffs.most_common():
+        print(f'  {old} --> {new}: {ct}')
+    return 0
+
+##########################################################
+
+if __name__ == '__main__':
+    main()
+
+# DONE
\ No newline at end of file
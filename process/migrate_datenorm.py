@@ -0,0 +1,85 @@
+"""
+One-off migration adding incremental date normalisation to the links table.
+
+Adds the flag column 'datenorm' (0 until fix_dates.py has normalised the row's date)
+with a partial index on the rows still to normalise, and a trigger that clears the
+flag whenever a row is inserted or its date is changed by anyone but fix_dates.py -
+which sets the flag in the same update, so the trigger leaves it alone.
+
+All steps run in one transaction, so the trigger is replaced atomically. Every
+existing row starts with datenorm = 0, so the next run of fix_dates.py normalises
+the whole table once, and only new or changed dates after that.
+
+Safe to run again: every step checks what is already there.
+
+E.g.
+
+open -g $AZURE_VOLUME
+pgfile="/Volumes/blitshare/pg/param.txt"
+
+./process/migrate_datenorm.py $pgfile
+
+"""
+
+import sys
+from sqlalchemy import create_engine, text
+
+# read command line
+try:
+	pgfile = sys.argv[1];			        del sys.argv[1]
+except:
+	print("Usage:", sys.argv[0], "pgfile")
+	sys.exit(1)
+
+# read Postgres parameters
+try:
+	exec(open(pgfile).read())
+except:
+	print(f'Cannot open file {pgfile}')
+	sys.exit(1)
+
+# open connection to database
+engine = create_engine(f"postgresql://{PGUSER}:{PGPASSWORD}@{PGHOST}:5432/{PGDATABASE}", echo=False)
+
+# SQL command strings
+setup_cmds = [
+    'ALTER TABLE links ADD COLUMN IF NOT EXISTS datenorm INTEGER DEFAULT 0',
+    'CREATE INDEX IF NOT EXISTS links_datenorm ON links (link) WHERE datenorm = 0',
+    "CREATE OR REPLACE FUNCTION links_datenorm_reset() RETURNS trigger AS $$ \
+    BEGIN \
+        IF TG_OP = 'INSERT' THEN \
+            NEW.datenorm := 0; \
+        ELSIF NEW.date IS DISTINCT FROM OLD.date \
+            AND NEW.datenorm IS NOT DISTINCT FROM OLD.datenorm THEN \
+            NEW.datenorm := 0; \
+        END IF; \
+        RETURN NEW; \
+    END; \
+    $$ LANGUAGE plpgsql",
+    'DROP TRIGGER IF EXISTS links_datenorm_reset ON links',
+    'CREATE TRIGGER links_datenorm_reset \
+    BEFORE INSERT OR UPDATE OF date ON links \
+    FOR EACH ROW EXECUTE FUNCTION links_datenorm_reset()'
+]
+count_cmd = '\
+    SELECT count(*) AS n, count(*) FILTER (WHERE datenorm = 0) AS ntodo FROM links'
+
+##########################################################
+
+def main():
+    print('Adding datenorm column, index and trigger ...')
+    with engine.connect() as conn:
+        for cmd in setup_cmds:
+            conn.execute(text(cmd))
+        conn.commit()
+        counts = conn.execute(text(count_cmd)).one()
+
+    print(f'{counts.ntodo} of {counts.n} records await date normalisation by fix_dates.py')
+    return 0
+
+##########################################################
+
+if __name__ == '__main__':
+	main()
+
+# DONE
\ No newline at end of file
@@ -0,0 +1,69 @@
+"""
+One-off migration adding two-tier PDF reading to the links table.
+
+Adds the flag column 'donefulltext' (0 for a PDF read only for date, title and abstract
+by an 'abstract' pass of the PDF scripts, 1 once its full text is in pdftext - or given
+up on), with a partial index on the rows awaiting their full text, and the counter
+'fulltexttries' of failed downloads in the 'fulltext' pass of get_pdf_text.py.
+
+Existing rows start with donefulltext = 1, as their pdftext was read in full.
+
+Safe to run again: every step checks what is already there.
+
+E.g.
+
+open -g $AZURE_VOLUME
+pgfile="/Volumes/blitshare/pg/param.txt"
+
+./process/migrate_fulltext.py $pgfile
+
+"""
+
+import sys
+from sqlalchemy import create_engine, text
+
+# read command line
+try:
+	pgfile = sys.argv[1];			        del sys.argv[1]
+except:
+	print("Usage:", sys.argv[0], "pgfile")
+	sys.exit(1)
+
+# read Postgres parameters
+try:
+	exec(open(pgfile).read())
+except:
+	print(f'Cannot open file {pgfile}')
+	sys.exit(1)
+
+# open connection to database
+engine = create_engine(f"postgresql://{PGUSER}:{PGPASSWORD}@{PGHOST}:5432/{PGDATABASE}", echo=False)
+
+# SQL command strings
+setup_cmds = [
+    'ALTER TABLE links ADD COLUMN IF NOT EXISTS donefulltext INTEGER DEFAULT 1',
+    'ALTER TABLE links ADD COLUMN IF NOT EXISTS fulltexttries INTEGER DEFAULT 0',
+    'CREATE INDEX IF NOT EXISTS links_donefulltext ON links (link) WHERE donefulltext = 0'
+]
+count_cmd = '\
+    SELECT count(*) AS n, count(*) FILTER (WHERE donefulltext = 0) AS ntodo FROM links'
+
+##########################################################
+
+def main():
+    print('Adding donefulltext and fulltexttries columns and index ...')
+    with engine.connect() as conn:
+        for cmd in setup_cmds:
+            conn.execute(text(cmd))
+        conn.commit()
+        counts = conn.execute(text(count_cmd)).one()
+
+    print(f'{counts.ntodo} of {counts.n} records await their full text')
+    return 0
+
+##########################################################
+
+if __name__ == '__main__':
+	main()
+
+# DONE
\ No newline at end of file
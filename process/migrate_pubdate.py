@@ -0,0 +1,131 @@
+"""
+One-off migration adding a typed publication date to the links table.
+
+Adds the column 'pubdate' (DATE) with a btree index, and a trigger that sets it
+from the normalised 'date' string (yyyy-mm-dd, see fix_dates.py) whenever a row is
+inserted or its date is written - so the ingest scripts, CrossRef alignment and
+fix_dates.py all keep it populated with no change to how they write dates. Existing
+rows are then backfilled in batches of BATCHSIZE, keyed on link, each batch in its
+own transaction.
+
+Date-range filters (webapp recent items, dashboard, pg_views.sh) use pubdate
+and so become index range scans rather than string comparisons over the whole table.
+
+Safe to run again: every step checks what is already there, and the backfill only
+touches rows whose pubdate disagrees with their date.
+
+E.g.
+
+open -g $AZURE_VOLUME
+pgfile="/Volumes/blitshare/pg/param.txt"
+
+./process/migrate_pubdate.py $pgfile
+
+"""
+
+import sys
+import time
+from sqlalchemy import create_engine, text
+
+# read command line
+try:
+	pgfile = sys.argv[1];			        del sys.argv[1]
+except:
+	print("Usage:", sys.argv[0], "pgfile")
+	sys.exit(1)
+
+# read Postgres parameters
+try:
+	exec(open(pgfile).read())
+except:
+	print(f'Cannot open file {pgfile}')
+	sys.exit(1)
+
+# open connection to database
+engine = create_engine(f"postgresql://{PGUSER}:{PGPASSWORD}@{PGHOST}:5432/{PGDATABASE}", echo=False)
+
+# rows per backfill transaction
+BATCHSIZE = 20000
+
+# SQL command strings
+setup_cmds = [
+    'ALTER TABLE links ADD COLUMN IF NOT EXISTS pubdate DATE',
+    'CREATE INDEX IF NOT EXISTS links_pubdate ON links (pubdate)',
+    # yyyy-mm-dd string to date, NULL if not of that form or not a valid date
+    "CREATE OR REPLACE FUNCTION to_pubdate(d text) RETURNS date AS $$ \
+    BEGIN \
+        IF d ~ '^\\d{4}-\\d{2}-\\d{2}$' THEN \
+            RETURN d::date; \
+        END IF; \
+        RETURN NULL; \
+    EXCEPTION WHEN others THEN \
+        RETURN NULL; \
+    END; \
+    $$ LANGUAGE plpgsql IMMUTABLE",
+    "CREATE OR REPLACE FUNCTION links_pubdate_sync() RETURNS trigger AS $$ \
+    BEGIN \
+        NEW.pubdate := to_pubdate(NEW.date); \
+        RETURN NEW; \
+    END; \
+    $$ LANGUAGE plpgsql",
+    'DROP TRIGGER IF EXISTS links_pubdate_sync ON links',
+    'CREATE TRIGGER links_pubdate_sync \
+    BEFORE INSERT OR UPDATE OF date, pubdate ON links \
+    FOR EACH ROW EXECUTE FUNCTION links_pubdate_sync()'
+]
+batch_cmd = '\
+    SELECT max(link) AS last, count(*) AS n FROM ( \
+        SELECT link FROM links \
+        WHERE link > :first \
+        ORDER BY link \
+        LIMIT :batchsize \
+        ) AS batch'
+backfill_cmd = '\
+    UPDATE links \
+        SET pubdate = to_pubdate(date) \
+    WHERE link > :first \
+    AND link <= :last \
+    AND pubdate IS DISTINCT FROM to_pubdate(date)'
+count_cmd = '\
+    SELECT count(*) AS n, count(pubdate) AS ndated FROM links'
+
+##########################################################
+
+def main():
+    # (1) column, index and trigger
+    print('Adding pubdate column, index and trigger ...')
+    with engine.connect() as conn:
+        for cmd in setup_cmds:
+            conn.execute(text(cmd))
+        conn.commit()
+
+    # (2) backfill in batches of links
+    print('Backfilling pubdate from date ...')
+    first = ''
+    nread = 0
+    nupdates = 0
+    start = time.time()
+    with engine.connect() as conn:
+        while True:
+            batch = conn.execute(text(batch_cmd), {'first': first, 'batchsize': BATCHSIZE}).one()
+            if batch.n == 0:
+                break
+            result = conn.execute(text(backfill_cmd), {'first': first, 'last': batch.last})
+            conn.commit()
+            nread += batch.n
+            nupdates += result.rowcount
+            first = batch.last
+            print(f'{nread} rows read, {nupdates} updated, {time.time() - start:.1f}s')
+        conn.execute(text('ANALYZE links'))
+        conn.commit()
+        counts = conn.execute(text(count_cmd)).one()
+
+    print(f'{counts.ndated} of {counts.n} records have a pubdate, {nupdates} updates written')
+    return 0
+
+##########################################################
+
+if __name__ == '__main__':
+	main()
+
+# DONE
\ No newline at end of file
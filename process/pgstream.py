@@ -0,0 +1,101 @@
+"""
+Package of routines for streaming a backlog of database records through a process stage.
+
+Records are read through a server-side cursor, CHUNKSIZE rows at a time, and updates
+are committed chunk by chunk on a separate connection. Memory stays bounded whatever
+the size of the backlog, and a run that dies keeps everything up to its last commit.
+A run stops when it has used up its record budget or its time budget, whichever
+comes first (None meaning no limit).
+
+E.g.
+
+import pgstream
+update_list = []
+for row in pgstream.stream_records(engine, selecter, time_budget=3600):
+    update_list += [{...}]
+    if len(update_list) >= pgstream.CHUNKSIZE:
+        pgstream.write_chunk(engine, updater, update_list)
+        update_list = []
+pgstream.write_chunk(engine, updater, update_list)
+"""
+
+import time
+
+
+##############################################################
+# parameters
+
+CHUNKSIZE = 500
+
+
+##############################################################
+# reading
+
+def stream_chunks(engine, selecter, chunk_size = CHUNKSIZE, max_records = None, time_budget = None):
+    """
+    Public
+    Generator of lists of at most chunk_size rows returned by selecter,
+    read through a server-side cursor
+    """
+    start = time.time()
+    nrecords = 0
+    with engine.connect() as conn:
+        result = conn.execution_options(yield_per=chunk_size).execute(selecter)
+        for rows in result.partitions():
+            if max_records is not None:
+                rows = rows[:max_records - nrecords]
+            if len(rows) == 0:
+                break
+            nrecords += len(rows)
+            yield rows
+            if max_records is not None and nrecords >= max_records:
+                break
+            if time_budget is not None and time.time() - start > time_budget:
+                print(f'Time budget of {time_budget}s used up after {nrecords} records')
+                break
+        result.close()
+
+def stream_records(engine, selecter, chunk_size = CHUNKSIZE, max_records = None, time_budget = None):
+    """
+    Public
+    Generator of single rows returned by selecter, subject to the same budgets
+    as stream_chunks() but checking the time budget on every row
+    """
+    start = time.time()
+    nrecords = 0
+    for rows in stream_chunks(engine, selecter, chunk_size, max_records):
+        for row in rows:
+            if time_budget is not None and time.time() - start > time_budget:
+                print(f'Time budget of {time_budget}s used up after {nrecords} records')
+                return
+            nrecords += 1
+            yield row
+
+
+##############################################################
+# writing
+
+def write_chunk(engine, updater, update_list):
+    """
+    Public
+    Execute updater over update_list (a list of bindparam dicts) and commit
+    Outputs number of updates written
+    """
+    return write_statements(engine, [(updater, update_list)])[0]
+
+def write_statements(engine, statements):
+    """
+    Public
+    statements is a list of (statement, update_list) pairs, all executed in a single
+    transaction so that related tables stay in sync
+    Outputs list of numbers of updates written per statement
+    """
+    out = [len(update_list) for _, update_list in statements]
+    if sum(out) == 0:
+        return out
+    with engine.connect() as conn:
+        for statement, update_list in statements:
+            if update_list != []:
+                conn.execute(statement, update_list)
+        conn.commit()
+    return out
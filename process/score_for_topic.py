@@ -11,23 +11,53 @@ pgfile="/Volumes/blitshare/pg/param.txt"
 
 ./process/score_for_topic.py $pgfile $blimodelfile
 
+Titles and abstracts are parsed in batches through nlp.pipe() (with each abstract
+sentence re-parsed alone for the verb-phrase filter, see topic_model.py), and each chunk
+is scored in one vectorized call against the compiled model (see topic_model.py).
+
+The filtered lemmas of each document, sentence by sentence, are stored in the table
+'link_lemmas'. After retraining the BOW model, rescore mode applies the new model to
+the stored lemmas of every scored record without running spaCy at all:
+
+./process/score_for_topic.py $pgfile $newmodelfile rescore
+
+To compare candidate models, give a comma-separated list of model files. Every
+document is parsed and tokenized once and scored against all of them: the first model gives
+the score in 'links', and the scores of all models go to the table 'model_scores'
+keyed by (link, model_id), model_id being the model file name without extension.
+See compare_models.py for a report on the differences:
+
+./process/score_for_topic.py $pgfile $blimodelfile,$newmodelfile
+
+Model ids must be distinct; models whose file names clash are given ids explicitly:
+
+./process/score_for_topic.py $pgfile v1=models/v1/bli.json,v2=models/v2/bli.json
 
 """
 
+import os
 import sys
-import json 
+import time
 import spacy
-from spacy.matcher import Matcher                                                                                                                                                                                         
-from sqlalchemy import create_engine, update, select, bindparam
-from sqlalchemy import Table, Column, String, Integer, Float, MetaData
-from math import log, isnan
+import pgstream
+import topic_model as tm
+from sqlalchemy import create_engine, update, select, bindparam, func, exists
+from sqlalchemy import Table, Column, String, Integer, Float, MetaData, LargeBinary
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 # read command line
 try:
 	pgfile = sys.argv[1];			    del sys.argv[1]
 	modelfile = sys.argv[1];			del sys.argv[1]	
 except:
-	print("Usage:", sys.argv[0], "pg_file model_file")
+	print("Usage:", sys.argv[0], "pg_file [model_id=]model_file[,[model_id=]model_file...] [rescore]")
+	sys.exit(1)
+
+# optional mode
+MODES = ['score', 'rescore']
+mode = sys.argv[1] if len(sys.argv) > 1 else 'score'
+if mode not in MODES:
+	print("Usage:", sys.argv[0], "pg_file [model_id=]model_file[,[model_id=]model_file...] [rescore]")
 	sys.exit(1)
 
 # read Postgres parameters
@@ -55,78 +85,157 @@ links = Table('links', metadata_obj,
               Column('gottranslation', Integer),
               Column('language', String)
              )
+model_scores = Table('model_scores', metadata_obj,
+              Column('link', String, primary_key=True),
+              Column('model_id', String, primary_key=True),
+              Column('score', Float)
+             )
+link_lemmas = Table('link_lemmas', metadata_obj,
+              Column('link', String, primary_key=True),
+              Column('bags', LargeBinary)
+             )
+
+# model ids, from 'model_id=model_file' or else the file name without extension
+model_ids = [f.split('=', 1)[0] if '=' in f else os.path.splitext(os.path.basename(f))[0] for f in modelfile.split(',')]
+model_files = [f.split('=', 1)[1] if '=' in f else f for f in modelfile.split(',')]
+if len(set(model_ids)) < len(model_ids):
+	print(f"Duplicate model ids {model_ids} - give them as model_id=model_file")
+	sys.exit(1)
 
-# read pre-computed BLI model
-with open(modelfile, 'r') as jf:
-    bli_loglik = json.load(jf)
-jf.close()    
+# read pre-computed BLI models, compiled for vectorized scoring
+# (the first one gives the score in links)
+models = [(model_id, tm.compile_model(f)) for model_id, f in zip(model_ids, model_files)]
 
-# load NLP pipeline
-nlp = spacy.load('en_core_web_md') 
+# load NLP pipeline and compile verb-phrase matcher (not needed to rescore)
+if mode == 'score':
+    nlp = spacy.load('en_core_web_md') 
+    matcher = tm.make_verb_matcher(nlp)
 
 # global constants
-LOGZERO = -20.0
-MAXCALLS = 2000
+LOGZERO = tm.LOGZERO
+BATCH_SIZE = 64
+
+# run budget (None for no limit) and commit size
+MAXRECORDS = None
+TIMEBUDGET = 3600
+CHUNKSIZE = 500
+RESCORE_CHUNK = 20000
 
 ##########################################################
 # functions
 
-def get_tokens(doc):
+def texts_to_score(row):
     """
-    extract text tokens from doc
+    (title, abstract) to score - translations if the record is non-English,
+    or None if it still awaits translation
     """
-    removal = ['ADV','PRON','CCONJ','PUNCT','PART','DET','ADP','SPACE', 'NUM', 'SYM']
-    txt_words = [token.lemma_.lower() for token in doc
-               if token.pos_ not in removal 
-               and not token.is_stop 
-               and token.is_alpha]
-    return list(set(txt_words))
-
-def bli_score(sentence, MINWORDS = 6):
+    if row.language != 'en' and row.gottranslation == 0:
+        return None
+    if row.language != 'en' and row.gottranslation == 1:
+        return row.title_translation, row.abstract_translation
+    return row.title, row.abstract
+
+def bad_record(link):
     """
-    Compute score of a sentence.
-    Override if length is less than MINWORDS
+    update for a record that cannot be scored
     """
-    if isinstance(sentence, str):
-        doc = nlp(sentence)
-    else:
-        doc = sentence
-    tokens = get_tokens(doc)
-    ct = 0
-    if len(tokens) < MINWORDS:
-        return LOGZERO
-    else:
-        for tok in tokens:
-            if tok in bli_loglik.keys():
-                ct += bli_loglik[tok]
-            else:
-                ct += LOGZERO
-        return ct / len(tokens)
-
-def verbs(sent):
-    pattern=[
-        {'POS': 'VERB', 'OP': '?'},
-        {'POS': 'ADV', 'OP': '*'},
-        {'POS': 'VERB', 'OP': '+'}
-    ]
-    # instantiate a Matcher instance
-    matcher = Matcher(nlp.vocab) 
-    # add pattern to matcher
-    matcher.add('verb-phrases', [pattern])
-    d = nlp(sent.text)
-    # call the matcher to find matches 
-    matches = matcher(d)
-    spans = [d[start:end] for _, start, end in matches] 
-    return spans
-
-def clean_sentences(sents):
-    sentences = [s for s in sents if len(verbs(s)) > 0 and
-                    len(s) > 3]
-    return sentences
+    return {
+            'linkvalue': link,
+            'scorevalue': LOGZERO,
+            'badflagvalue': 1,
+            'scoreflagvalue': 1
+            }
+
+def tokenize(to_score):
+    """
+    to_score is a list of (row, (title, abstract))
+    Outputs list of sentence tokens per record, parsed in batches
+    """
+    docs = list(nlp.pipe([text for _, texts in to_score for text in texts], batch_size=BATCH_SIZE))
+    parsed = [(docs[2*i], docs[2*i + 1]) for i in range(len(to_score))]
+    return tm.sentence_tokens(nlp, matcher, parsed, BATCH_SIZE)
+
+def model_score_list(links_list, all_scores):
+    """
+    bindparam dicts for model_scores, all_scores being a list of
+    score arrays as ordered in models
+    """
+    return [{
+            'linkvalue': link,
+            'modelvalue': model_id,
+            'scorevalue': float(score)
+            } for (model_id, _), scores in zip(models, all_scores)
+              for link, score in zip(links_list, scores)]
+
+def make_model_scorer():
+    """
+    upsert instruction for model_scores
+    """
+    scorer = pg_insert(model_scores).\
+            values(
+                link = bindparam('linkvalue'),
+                model_id = bindparam('modelvalue'),
+                score = bindparam('scorevalue')
+                )
+    return scorer.on_conflict_do_update(
+                index_elements = ['link', 'model_id'],
+                set_ = {'score': scorer.excluded.score}
+                )
+
+def rescore():
+    """
+    apply the model to stored lemma bags, writing scores only
+    """
+    # initialise counters
+    nread = 0
+    nupdates = 0
+    # select stored lemmas of scored records
+    selecter = select(link_lemmas).\
+        join(links, links.c.link == link_lemmas.c.link).\
+        where(
+            links.c.gotscore == 1,
+            links.c.badlink == 0
+            )
+    # make update instructions
+    updater = links.update().\
+            where(links.c.link == bindparam('linkvalue')).\
+            values(score = bindparam('scorevalue'))
+    scorer = make_model_scorer()
+
+    start = time.time()
+    for rows in pgstream.stream_chunks(engine, selecter, RESCORE_CHUNK, MAXRECORDS, TIMEBUDGET):
+        bags = [tm.decode_bags(row.bags) for row in rows]
+        all_scores = [tm.score_batch(model, bags) for _, model in models]
+        update_list = [{
+                    'linkvalue': row.link,
+                    'scorevalue': float(score)
+                    } for row, score in zip(rows, all_scores[0])]
+        score_list = model_score_list([row.link for row in rows], all_scores)
+        nupdates += pgstream.write_statements(engine, [(updater, update_list), (scorer, score_list)])[0]
+        nread += len(rows)
+        print(f'{nread} records rescored, {time.time() - start:.1f}s')
+
+    # records scored before lemmas were stored keep their old score
+    with engine.connect() as conn:
+        nmissing = conn.execute(select(func.count()).select_from(links).\
+            where(
+                links.c.gotscore == 1,
+                links.c.badlink == 0,
+                ~exists().where(link_lemmas.c.link == links.c.link)
+                )).scalar()
+    print(f'Rescored {nread} records, {nupdates} updates written')
+    if nmissing > 0:
+        print(f'{nmissing} scored records have no stored lemmas - reset gotscore to score them afresh')
+    return 0
 
 ##########################################################
 
 def main():
+    # make sure lemma store exists
+    metadata_obj.create_all(engine, tables = [link_lemmas, model_scores], checkfirst = True)
+    if mode == 'rescore':
+        return rescore()
+
     # initialise counters
     ncalls = 0
     ngood = 0
@@ -138,78 +247,83 @@ def main():
             links.c.gotscore == 0,
             links.c.badlink == 0
             )
-    # initialise update list for this domain
-    update_list = []
+    # make update instructions
+    updater = links.update().\
+            where(links.c.link == bindparam('linkvalue')).\
+            values(
+                score = bindparam('scorevalue'),
+                badlink = bindparam('badflagvalue'),
+                gotscore = bindparam('scoreflagvalue')
+                )
+    storer = pg_insert(link_lemmas).\
+            values(
+                link = bindparam('linkvalue'),
+                bags = bindparam('bagsvalue')
+                )
+    storer = storer.on_conflict_do_update(
+                index_elements = ['link'],
+                set_ = {'bags': storer.excluded.bags}
+                )
+    scorer = make_model_scorer()
+    # initialise counters for updates
+    nupdates = 0
 
-    # connect to database
-    with engine.connect() as conn:
-        records = conn.execute(selecter)
-    # MAIN LOOP
-    for row in records:
-        thislink = row.link
-        # stop if reached MAXCALLS
-        if ncalls >= MAXCALLS:
-            break
-        # filter out bad records
-        if row.title == "" or row.title == None or row.abstract == "" or row.abstract == None:
-            update_list += [{
-                        'linkvalue': thislink,
-                        'scorevalue': LOGZERO, 
-                        'badflagvalue': 1,
-                        'scoreflagvalue': 1
-                        }]
-            continue
-        # skip for now if non-English with no translation
-        if row.language != 'en' and row.gottranslation == 0:
-            continue
-        # ... otherwise proceed
-        ncalls += 1
-        # set text to score
-        try:
-            if row.language != 'en' and row.gottranslation == 1:
-                doc = nlp( row.abstract_translation )
-                sents = clean_sentences(list(doc.sents)) + [row.title_translation]
+    # MAIN LOOP - over chunks streamed from the database
+    for rows in pgstream.stream_chunks(engine, selecter, CHUNKSIZE, MAXRECORDS, TIMEBUDGET):
+        update_list = []
+        lemma_list = []
+        to_score = []
+        for row in rows:
+            # filter out bad records
+            if row.title == "" or row.title == None or row.abstract == "" or row.abstract == None:
+                update_list += [bad_record(row.link)]
+                continue
+            texts = texts_to_score(row)
+            # skip for now if non-English with no translation
+            if texts == None:
+                continue
+            # flag as bad if translation is missing
+            if not isinstance(texts[0], str) or not isinstance(texts[1], str):
+                update_list += [bad_record(row.link)]
             else:
-                doc = nlp( row.abstract )
-                sents = clean_sentences(list(doc.sents)) + [row.title]
-            # ... and score
-            score = sum( [bli_score(s) for s in sents] ) / len(sents)
+                to_score += [(row, texts)]
+        # parse documents in batches and score
+        ncalls += len(to_score)
+        try:
+            all_tokens = tokenize(to_score)
+        except Exception:
+            # retry record by record, flagging those that fail as bad
+            all_tokens, scored = [], []
+            for item in to_score:
+                try:
+                    all_tokens += tokenize([item])
+                except Exception as ex:
+                    print(f'{item[0].link}: cannot score ({type(ex).__name__}: {ex})')
+                    update_list += [bad_record(item[0].link)]
+                    continue
+                scored += [item]
+            to_score = scored
+        all_scores = [tm.score_batch(model, all_tokens) for _, model in models]
+        score_list = model_score_list([row.link for row, _ in to_score], all_scores)
+        for (row, _), sent_tokens, score in zip(to_score, all_tokens, all_scores[0]):
+            lemma_list += [{
+                        'linkvalue': row.link,
+                        'bagsvalue': tm.encode_bags(sent_tokens)
+                        }]
             update_list += [{
-                        'linkvalue': thislink,
-                        'scorevalue': score, 
+                        'linkvalue': row.link,
+                        'scorevalue': float(score), 
                         'badflagvalue': 0,
                         'scoreflagvalue': 1
                         }]
             ngood += 1
             # verbose 
-            print(f'{ncalls}: {row.title}')
-        except:
-            update_list += [{
-                        'linkvalue': thislink,
-                        'scorevalue': LOGZERO, 
-                        'badflagvalue': 1,
-                        'scoreflagvalue': 1
-                        }]
+            print(f'{ngood}: {row.title}')
+        # commit this chunk, scores and lemmas together
+        nupdates += pgstream.write_statements(engine, [(updater, update_list), (storer, lemma_list), (scorer, score_list)])[0]
     # END OF MAIN LOOP
 
-    # finish if no output
-    if update_list == []:
-        print(f'No updates to make - read {ncalls} records, successfully scored {ngood}')
-        return 0
-    # ... otherwise make update instructions
-    updater = links.update().\
-            where(links.c.link == bindparam('linkvalue')).\
-            values(
-                score = bindparam('scorevalue'),
-                badlink = bindparam('badflagvalue'),
-                gotscore = bindparam('scoreflagvalue')
-                )
-    # ... and commit to remote table
-    with engine.connect() as conn:
-        conn.execute(updater, update_list)
-        conn.commit()
-
-    print(f'Read {ncalls} records, successfully scored {ngood}')
+    print(f'Read {ncalls} records, successfully scored {ngood}, {nupdates} updates written')
     return 0
 
 ##########################################################
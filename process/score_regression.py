@@ -0,0 +1,202 @@
+"""
+Regression check for the batched scorer in topic_model.py.
+
+Takes a sample of already-scored English records, scores each one with the previous
+implementation of score_for_topic.py (kept verbatim below, one document at a time)
+and with the batched scorer - title and abstract parsed through nlp.pipe(), lemmas
+taken from that parse and the verb filter run on each sentence re-parsed alone, so
+N+2 parses for an abstract of N sentences - both in float64 (score_tokens) and
+with the float32 weights of score_batch(), which gives the scores written to links.
+For each path it reports the largest and mean difference from the previous scores
+and the number of records differing by more than the tolerance. Nothing is written
+to the database.
+
+E.g.
+
+pgfile="/Volumes/blitshare/pg/param.txt"
+
+./process/score_regression.py $pgfile $blimodelfile 500
+
+"""
+
+import sys
+import time
+import spacy
+from spacy.matcher import Matcher
+import topic_model as tm
+from sqlalchemy import create_engine, select, func
+from sqlalchemy import Table, Column, String, Integer, Float, MetaData
+
+# read command line
+try:
+	pgfile = sys.argv[1];			    del sys.argv[1]
+	modelfile = sys.argv[1];			del sys.argv[1]
+except:
+	print("Usage:", sys.argv[0], "pg_file model_file [n]")
+	sys.exit(1)
+
+# optional sample size
+try:
+	NSAMPLE = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+except:
+	print("Usage:", sys.argv[0], "pg_file model_file [n]")
+	sys.exit(1)
+
+# read Postgres parameters
+try:
+	exec(open(pgfile).read())
+except:
+	print(f'Cannot open file {pgfile}')
+	sys.exit(1)
+
+# open connection to database
+engine = create_engine(f"postgresql://{PGUSER}:{PGPASSWORD}@{PGHOST}:5432/{PGDATABASE}", echo=False)
+
+# create SQL table
+metadata_obj = MetaData()
+links = Table('links', metadata_obj,
+              Column('link', String, primary_key=True),
+              Column('title', String),
+              Column('abstract', String),
+              Column('score', Float),
+              Column('badlink', Integer),
+              Column('gotscore', Integer),
+              Column('language', String)
+             )
+
+# read pre-computed BLI model
+bli_loglik = tm.load_model(modelfile)
+
+# load NLP pipeline
+nlp = spacy.load('en_core_web_md')
+
+# global constants
+LOGZERO = -20.0
+TOLERANCE = 1e-9
+# float32 weights are accurate to ~1e-7 relative, scores are of order -10
+TOLERANCE_32 = 1e-5
+
+##########################################################
+# previous implementation, verbatim
+
+def get_tokens(doc):
+    """
+    extract text tokens from doc
+    """
+    removal = ['ADV','PRON','CCONJ','PUNCT','PART','DET','ADP','SPACE', 'NUM', 'SYM']
+    txt_words = [token.lemma_.lower() for token in doc
+               if token.pos_ not in removal
+               and not token.is_stop
+               and token.is_alpha]
+    return list(set(txt_words))
+
+def bli_score(sentence, MINWORDS = 6):
+    """
+    Compute score of a sentence.
+    Override if length is less than MINWORDS
+    """
+    if isinstance(sentence, str):
+        doc = nlp(sentence)
+    else:
+        doc = sentence
+    tokens = get_tokens(doc)
+    ct = 0
+    if len(tokens) < MINWORDS:
+        return LOGZERO
+    else:
+        for tok in tokens:
+            if tok in bli_loglik.keys():
+                ct += bli_loglik[tok]
+            else:
+                ct += LOGZERO
+        return ct / len(tokens)
+
+def verbs(sent):
+    pattern=[
+        {'POS': 'VERB', 'OP': '?'},
+        {'POS': 'ADV', 'OP': '*'},
+        {'POS': 'VERB', 'OP': '+'}
+    ]
+    # instantiate a Matcher instance
+    matcher = Matcher(nlp.vocab)
+    # add pattern to matcher
+    matcher.add('verb-phrases', [pattern])
+    d = nlp(sent.text)
+    # call the matcher to find matches
+    matches = matcher(d)
+    spans = [d[start:end] for _, start, end in matches]
+    return spans
+
+def clean_sentences(sents):
+    sentences = [s for s in sents if len(verbs(s)) > 0 and
+                    len(s) > 3]
+    return sentences
+
+def old_score(title, abstract):
+    doc = nlp( abstract )
+    sents = clean_sentences(list(doc.sents)) + [title]
+    return sum( [bli_score(s) for s in sents] ) / len(sents)
+
+##########################################################
+
+def compare(label, rows, old_scores, scores, tolerance):
+    nmismatch = 0
+    maxdiff = 0.0
+    sumdiff = 0.0
+    for row, x, y in zip(rows, old_scores, scores):
+        diff = abs(x - float(y))
+        maxdiff = max(maxdiff, diff)
+        sumdiff += diff
+        if diff > tolerance:
+            nmismatch += 1
+            print(f'{row.link}: {x:.6f} --> {float(y):.6f}')
+    print(f'{label}: {nmismatch} of {len(rows)} scores differ by more than {tolerance:.0e}, '
+          f'max abs difference {maxdiff:.2e}, mean abs difference {sumdiff/max(len(rows), 1):.2e}')
+    return nmismatch
+
+##########################################################
+
+def main():
+    # sample of scored English records
+    selecter = select(links.c.link, links.c.title, links.c.abstract).\
+        where(
+            links.c.gotscore == 1,
+            links.c.badlink == 0,
+            links.c.language == 'en'
+            ).\
+        order_by(func.random()).\
+        limit(NSAMPLE)
+    with engine.connect() as conn:
+        rows = conn.execute(selecter).fetchall()
+    documents = [(row.title, row.abstract) for row in rows]
+    print(f'Scoring {len(documents)} records')
+
+    # previous implementation
+    start = time.time()
+    old_scores = [old_score(title, abstract) for title, abstract in documents]
+    old_time = time.time() - start
+
+    # batched implementation, float64 weights
+    start = time.time()
+    matcher = tm.make_verb_matcher(nlp)
+    all_tokens = list(tm.document_tokens(nlp, matcher, documents))
+    new_scores = [tm.score_tokens(sent_tokens, bli_loglik) for sent_tokens in all_tokens]
+    new_time = time.time() - start
+
+    # vectorized scoring against the compiled model (float32 weights)
+    start = time.time()
+    batch_scores = tm.score_batch(tm.compile_model(modelfile), all_tokens)
+    batch_time = time.time() - start
+
+    # compare each path with the previous scores
+    print(f'Previous: {old_time:.1f}s, batched: {new_time:.1f}s, vectorized: {batch_time:.3f}s')
+    compare('Batched (float64)', rows, old_scores, new_scores, TOLERANCE)
+    compare('Vectorized (float32)', rows, old_scores, batch_scores, TOLERANCE_32)
+    return 0
+
+##########################################################
+
+if __name__ == '__main__':
+    main()
+
+# DONE
\ No newline at end of file
@@ -0,0 +1,351 @@
+"""
+Package of routines for species name matching.
+
+Names from the BirdLife taxonomy (common, alternative, scientific, synonyms) are
+compiled into a token trie, which is then used to scan text for exact lower-case
+matches on word boundaries. This replaces the spaCy EntityRuler for the purpose of
+find_species.py - no NLP model is needed, so long texts scan in linear time.
+
+The compiled taxonomy (names, id_dict, EntityRuler patterns and trie) is cached
+on disk, keyed on a content hash of the species file, so it is only rebuilt
+when BirdLife publishes a new list.
+
+E.g.
+
+import species_matcher as sm
+taxonomy = sm.compile_taxonomy(birdfile)
+trie, id_dict = taxonomy['trie'], taxonomy['id_dict']
+sm.find_names(trie, 'The Black-browed Albatross (Thalassarche melanophris) ...')
+"""
+
+import os
+import re
+import pickle
+import hashlib
+
+
+##############################################################
+# parameters
+
+# text and names are tokenized the same way: runs of word characters,
+# or single punctuation characters
+token_patt = re.compile(r'\w+|[^\w\s]')
+space_patt = re.compile(r'\s')
+word_patt = re.compile(r'\w')
+
+# trie key marking the end of a name (tokens are never empty)
+_LEAF = ''
+
+# long texts are matched in windows of at most WINDOWSIZE characters
+WINDOWSIZE = 100000
+
+# compiled taxonomy format - bump whenever the content of compile_taxonomy() changes
+CACHE_VERSION = 3
+
+# SISRecIDs are written to integer columns (link_species), so must be integers
+id_patt = re.compile(r'^\d+$')
+
+
+##############################################################
+# taxonomy functions
+
+def read_taxonomy(filepath):
+    """
+    Public
+    Reads BirdLife species file (Excel) to data frame with
+    columns comName, sciName, syn, alt, id
+    """
+    import pandas as pd
+    taxonomy_df = pd.read_excel(filepath, header=0, dtype=str).fillna('')
+    new_tax_columns = {
+    'Common name': 'comName',
+    'Scientific name': 'sciName',
+    'Synonyms': 'syn',
+    'Alternative common names' : 'alt',
+    'SISRecID' : 'id'
+    }
+    taxonomy_df.rename(columns=new_tax_columns, inplace=True)
+    return taxonomy_df.iloc[:,0:5]
+
+def _clean_name(txt):
+    """
+    Private
+    lower-case with whitespace normalised
+    """
+    return ' '.join(txt.lower().split())
+
+def _split_names(txt):
+    """
+    Private
+    comma-separated list of names to list of cleaned names
+    """
+    return [_clean_name(x) for x in txt.split(',')]
+
+def taxonomy_names(taxonomy_df):
+    """
+    Public
+    taxonomy_df as output by read_taxonomy()
+    Outputs list of (label, name, SISRecID) in a single pass over the taxonomy:
+    all common/alternative names first, then all scientific names/synonyms.
+    Rows whose SISRecID is not an integer are skipped, and reported.
+    """
+    com_names = []
+    sci_names = []
+    for i in range(taxonomy_df.shape[0]):
+        sisrecid = taxonomy_df.at[i,'id'].strip()
+        if not id_patt.match(sisrecid):
+            print(f"Skipping taxonomy row {i + 2} ({taxonomy_df.at[i,'sciName']}): bad SISRecID '{sisrecid}'")
+            continue
+        for x in [_clean_name(taxonomy_df.at[i,'comName'])] + _split_names(taxonomy_df.at[i,'alt']):
+            com_names += [('comName', x, sisrecid)]
+        for x in [_clean_name(taxonomy_df.at[i,'sciName'])] + _split_names(taxonomy_df.at[i,'syn']):
+            sci_names += [('sciName', x, sisrecid)]
+    return [x for x in com_names + sci_names if x[1] != '']
+
+def make_id_dict(names):
+    """
+    Public
+    names as output by taxonomy_names()
+    Outputs dict of lower-case name --> SISRecID
+    (a name shared by two species resolves to the later one)
+    """
+    return {name: sisrecid for _, name, sisrecid in names}
+
+def make_patterns(names):
+    """
+    Public
+    names as output by taxonomy_names()
+    Outputs list of token patterns for the spaCy EntityRuler
+    """
+    return [{'label': label, 'pattern': [{'LOWER': x} for x in name.split()]}
+            for label, name, _ in names]
+
+##############################################################
+# trie functions
+
+def tokenize(txt):
+    """
+    Public
+    Outputs list of (start, end, token) with token lower-cased
+    """
+    return [(m.start(), m.end(), m.group().lower()) for m in token_patt.finditer(txt)]
+
+def make_trie(id_dict):
+    """
+    Public
+    id_dict as output by make_id_dict()
+    Outputs nested dict token --> subtrie, with leaves holding the matched name
+    """
+    trie = dict()
+    for name in id_dict:
+        node = trie
+        for _, _, tok in tokenize(name):
+            node = node.setdefault(tok, dict())
+        node[_LEAF] = name
+    return trie
+
+def match_tokens(trie, tokens):
+    """
+    Public
+    trie as output by make_trie(), tokens as output by tokenize()
+    Outputs list of (start, end, name) for all leftmost-longest, non-overlapping
+    matches, with start/end character offsets into the tokenized text
+    """
+    n = len(tokens)
+    out = []
+    i = 0
+    while i < n:
+        node = trie.get(tokens[i][2])
+        if node is None:
+            i += 1
+            continue
+        last = None
+        j = i + 1
+        while True:
+            if _LEAF in node:
+                last = (j, node[_LEAF])
+            if j == n or tokens[j][2] not in node:
+                break
+            node = node[tokens[j][2]]
+            j += 1
+        if last is None:
+            i += 1
+            continue
+        out += [(tokens[i][0], tokens[last[0]-1][1], last[1])]
+        i = last[0]
+    return out
+
+def find_names(trie, txt):
+    """
+    Public
+    trie as output by make_trie()
+    Outputs list of (start, end, name) for all matches in txt
+    """
+    return match_tokens(trie, tokenize(txt))
+
+def find_species(trie, id_dict, txt):
+    """
+    Public
+    Outputs (list of SISRecID, list of names) found in txt, both deduplicated
+    """
+    sp_list = list(set([name for _, _, name in find_names(trie, txt)]))
+    id_list = list(set([id_dict[s] for s in sp_list]))
+    return id_list, sp_list
+
+
+##############################################################
+# token index functions
+
+def name_vocab(id_dict):
+    """
+    Public
+    set of all word tokens occurring in names
+    """
+    return set([tok for name in id_dict for _, _, tok in tokenize(name) if word_patt.match(tok)])
+
+def index_tokens(vocab, txt):
+    """
+    Public
+    sorted list of the distinct tokens of txt in vocab (as output by name_vocab())
+    """
+    return sorted(set([tok for _, _, tok in tokenize(txt) if tok in vocab]))
+
+def scan_text(trie, id_dict, vocab, txt, skip = 0):
+    """
+    Public
+    Outputs (id_counts, sp_list, tok_list) from a single tokenization of txt:
+        id_counts   dict SISRecID --> number of mentions, not counting those that
+                    end within the first skip characters (the overlap with the
+                    previous window, see text_windows())
+        sp_list     deduplicated names found
+        tok_list    as output by index_tokens()
+    """
+    tokens = tokenize(txt)
+    matches = match_tokens(trie, tokens)
+    id_counts = dict()
+    for _, end, name in matches:
+        if end > skip:
+            id_counts[id_dict[name]] = id_counts.get(id_dict[name], 0) + 1
+    sp_list = list(set([name for _, _, name in matches]))
+    tok_list = sorted(set([tok for _, _, tok in tokens if tok in vocab]))
+    return id_counts, sp_list, tok_list
+
+def diff_taxonomies(old_id_dict, new_id_dict):
+    """
+    Public
+    Outputs sorted list of names added, removed or with a changed SISRecID
+    (a renamed species shows up as one name removed and one added)
+    """
+    names = set(old_id_dict.keys()) | set(new_id_dict.keys())
+    return sorted([name for name in names if old_id_dict.get(name) != new_id_dict.get(name)])
+
+
+##############################################################
+# windowing of long texts
+
+def max_name_length(id_dict):
+    """
+    Public
+    length in characters of the longest name, a lower bound for window overlap
+    """
+    return max([len(name) for name in id_dict])
+
+def _window_end(txt, start, end):
+    """
+    Private
+    best place to cut txt in the second half of [start, end):
+    after a paragraph break, else after a sentence, else at whitespace
+    """
+    lo = start + (end - start) // 2
+    for sep in ['\n\n', '. ', '\n', ' ']:
+        k = txt.rfind(sep, lo, end)
+        if k >= 0:
+            return k + len(sep)
+    return end
+
+def text_windows(txt, size = WINDOWSIZE, overlap = 200):
+    """
+    Public
+    Generator of (offset, window) covering txt, each window at most size characters.
+    Windows are cut at paragraph/sentence/word boundaries and each one starts on a
+    word boundary up to overlap characters before the end of the previous one,
+    so a name no longer than overlap is always wholly inside some window.
+    """
+    if overlap >= size // 2:
+        raise ValueError(f'Window overlap {overlap} too large for size {size}')
+    n = len(txt)
+    start = 0
+    while start < n:
+        if start + size >= n:
+            yield start, txt[start:]
+            return
+        cut = _window_end(txt, start, start + size)
+        yield start, txt[start:cut]
+        # back up by overlap, then forward to the next word
+        m = space_patt.search(txt, cut - overlap, cut)
+        start = m.end() if m else cut
+
+##############################################################
+# compiled taxonomy cache
+
+def file_hash(filepath):
+    """
+    Public
+    sha256 of file content
+    """
+    h = hashlib.sha256()
+    with open(filepath, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def cache_path(filepath, cachedir = None):
+    """
+    Public
+    location of the compiled taxonomy for a species file,
+    by default alongside the species file itself
+    """
+    if cachedir is None:
+        cachedir = os.path.dirname(os.path.abspath(filepath))
+    return os.path.join(cachedir, f'taxonomy_{file_hash(filepath)[:16]}_v{CACHE_VERSION}.pkl')
+
+def compile_taxonomy(filepath, cachedir = None):
+    """
+    Public
+    Outputs dict with keys
+        version, hash       cache format and sha256 of the species file
+        names               as output by taxonomy_names()
+        id_dict             as output by make_id_dict()
+        patterns            as output by make_patterns()
+        trie                as output by make_trie()
+        vocab               as output by name_vocab()
+    Read from the cache if present for this species file, otherwise built
+    from the species file and written to the cache.
+    """
+    path = cache_path(filepath, cachedir)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            taxonomy = pickle.load(f)
+        if taxonomy.get('version') == CACHE_VERSION:
+            return taxonomy
+    # build from scratch
+    names = taxonomy_names(read_taxonomy(filepath))
+    id_dict = make_id_dict(names)
+    taxonomy = {
+        'version': CACHE_VERSION,
+        'hash': file_hash(filepath),
+        'names': names,
+        'id_dict': id_dict,
+        'patterns': make_patterns(names),
+        'trie': make_trie(id_dict),
+        'vocab': name_vocab(id_dict)
+    }
+    # write via temp file so a broken run never leaves a partial cache
+    tmp = f'{path}.{os.getpid()}.tmp'
+    try:
+        with open(tmp, 'wb') as f:
+            pickle.dump(taxonomy, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+    except OSError:
+        print(f'Cannot write taxonomy cache {path}')
+    return taxonomy
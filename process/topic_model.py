@@ -0,0 +1,280 @@
+"""
+Package of routines for scoring text against the BLI bag-of-words model.
+
+A document's abstract and title are parsed together with those of other documents
+through nlp.pipe(), and each abstract sentence (and the title) is reduced to its set
+of lemmas from that parse. Abstract sentences are kept only if they contain a verb
+phrase, found by a Matcher compiled once per process. As in the original scorer,
+the verb phrase is matched on a parse of the sentence text on its own - tags of a
+sentence parsed alone can differ from those in context - so an abstract of N
+sentences still takes N+2 parses, but all of them are batched through nlp.pipe().
+The score of a document is the mean over these sentences of the average
+log-likelihood of their lemmas under the model.
+
+For batch scoring the JSON model is compiled once into a sorted vocabulary and a
+float32 array of log-likelihoods (memory-mapped on load), and scores are computed
+with array gathers and per-sentence/per-document sums - see score_batch().
+
+E.g.
+
+import topic_model as tm
+bli_loglik = tm.load_model(modelfile)
+matcher = tm.make_verb_matcher(nlp)
+for sent_tokens in tm.document_tokens(nlp, matcher, [(title, abstract)]):
+    score = tm.score_tokens(sent_tokens, bli_loglik)
+
+model = tm.compile_model(modelfile)
+scores = tm.score_batch(model, list(tm.document_tokens(nlp, matcher, documents)))
+"""
+
+import os
+import json
+import zlib
+import hashlib
+import numpy as np
+from itertools import islice
+from spacy.matcher import Matcher
+
+
+##############################################################
+# parameters
+
+LOGZERO = -20.0
+MINWORDS = 6
+
+# parts of speech excluded from sentence tokens
+REMOVAL = ['ADV','PRON','CCONJ','PUNCT','PART','DET','ADP','SPACE', 'NUM', 'SYM']
+
+# sentences are kept only if they contain a verb phrase
+VERB_PATTERN = [
+    {'POS': 'VERB', 'OP': '?'},
+    {'POS': 'ADV', 'OP': '*'},
+    {'POS': 'VERB', 'OP': '+'}
+]
+
+
+##############################################################
+# model
+
+def load_model(modelfile):
+    """
+    Public
+    Outputs dict lemma --> log-likelihood
+    """
+    with open(modelfile, 'r') as jf:
+        return json.load(jf)
+
+
+##############################################################
+# spacy-dependent functions
+
+def make_verb_matcher(nlp):
+    """
+    Public
+    nlp is the pipeline used to parse documents
+    """
+    matcher = Matcher(nlp.vocab)
+    matcher.add('verb-phrases', [VERB_PATTERN])
+    return matcher
+
+def get_tokens(doc):
+    """
+    Public
+    doc is a Doc or Span
+    Outputs list of distinct lower-case lemmas
+    """
+    txt_words = [token.lemma_.lower() for token in doc
+               if token.pos_ not in REMOVAL
+               and not token.is_stop
+               and token.is_alpha]
+    return list(set(txt_words))
+
+def clean_sentences(nlp, matcher, abstract_docs, batch_size = 64):
+    """
+    Public
+    abstract_docs is a list of parsed abstracts, matcher as output by make_verb_matcher()
+    Outputs for each abstract the list of its sentences (Spans) with more than 3
+    tokens and a verb phrase in the sentence text parsed alone
+    """
+    sents = [[s for s in doc.sents if len(s) > 3] for doc in abstract_docs]
+    alone = nlp.pipe([s.text for doc_sents in sents for s in doc_sents], batch_size=batch_size)
+    verbs = iter([len(matcher(d)) > 0 for d in alone])
+    return [[s for s in doc_sents if next(verbs)] for doc_sents in sents]
+
+def sentence_tokens(nlp, matcher, parsed, batch_size = 64):
+    """
+    Public
+    parsed is a list of (title_doc, abstract_doc)
+    Outputs for each document its list of sentence tokens: the cleaned abstract
+    sentences followed by the title, each as output by get_tokens()
+    """
+    all_sents = clean_sentences(nlp, matcher, [abstract_doc for _, abstract_doc in parsed], batch_size)
+    return [[get_tokens(s) for s in sents + [title_doc]]
+            for (title_doc, _), sents in zip(parsed, all_sents)]
+
+def document_tokens(nlp, matcher, documents, batch_size = 64):
+    """
+    Public
+    documents is an iterable of (title, abstract) strings
+    Generator of lists of sentence tokens, one list per document,
+    as output by sentence_tokens()
+    """
+    def texts():
+        for title, abstract in documents:
+            yield abstract
+            yield title
+    docs = nlp.pipe(texts(), batch_size=batch_size)
+    while True:
+        parsed = [(title_doc, abstract_doc) for abstract_doc, title_doc in islice(zip(docs, docs), batch_size)]
+        if parsed == []:
+            return
+        yield from sentence_tokens(nlp, matcher, parsed, batch_size)
+
+
+##############################################################
+# scoring
+
+def bli_score(tokens, bli_loglik, minwords = MINWORDS):
+    """
+    Public
+    Score of one sentence, as the average log-likelihood of its tokens.
+    Override if length is less than minwords
+    """
+    if len(tokens) < minwords:
+        return LOGZERO
+    ct = 0
+    for tok in tokens:
+        ct += bli_loglik.get(tok, LOGZERO)
+    return ct / len(tokens)
+
+def score_tokens(sent_tokens, bli_loglik):
+    """
+    Public
+    sent_tokens as output by document_tokens()
+    Score of a document, as the mean score of its sentences
+    """
+    return sum([bli_score(t, bli_loglik) for t in sent_tokens]) / len(sent_tokens)
+
+
+##############################################################
+# compiled model
+
+def model_paths(modelfile, cachedir = None):
+    """
+    Public
+    (vocabulary file, weights file) of the compiled model for a JSON model file,
+    by default alongside the model file itself
+    """
+    if cachedir is None:
+        cachedir = os.path.dirname(os.path.abspath(modelfile))
+    h = hashlib.sha256()
+    with open(modelfile, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    stem = os.path.join(cachedir, f'bow_{h.hexdigest()[:16]}')
+    return f'{stem}.vocab.txt', f'{stem}.weights.npy'
+
+def _write_atomic(path, write):
+    """
+    Private
+    write(f) to a temp file, then move into place
+    """
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        write(f)
+    os.replace(tmp, path)
+
+def compile_model(modelfile, cachedir = None):
+    """
+    Public
+    Outputs dict with keys
+        vocab       dict lemma --> index into weights
+        weights     float32 array of log-likelihoods, memory-mapped, with a final
+                    slot LOGZERO for lemmas not in the model
+    Read from the compiled files if present for this model file, otherwise built
+    from the JSON model and written alongside it.
+    """
+    vocabfile, weightsfile = model_paths(modelfile, cachedir)
+    if not (os.path.exists(vocabfile) and os.path.exists(weightsfile)):
+        bli_loglik = load_model(modelfile)
+        lemmas = sorted(bli_loglik)
+        weights = np.array([bli_loglik[x] for x in lemmas] + [LOGZERO], dtype=np.float32)
+        try:
+            _write_atomic(weightsfile, lambda f: np.save(f, weights))
+            _write_atomic(vocabfile, lambda f: f.write('\n'.join(lemmas).encode('utf-8')))
+        except OSError:
+            print(f'Cannot write compiled model {vocabfile}')
+            return {'vocab': {x: i for i, x in enumerate(lemmas)}, 'weights': weights}
+    with open(vocabfile, 'r', encoding='utf-8') as f:
+        lemmas = f.read().split('\n')
+    return {
+        'vocab': {x: i for i, x in enumerate(lemmas)},
+        'weights': np.load(weightsfile, mmap_mode='r')
+    }
+
+
+##############################################################
+# vectorized scoring
+
+def index_documents(documents, vocab):
+    """
+    Public
+    documents is a list of sent_tokens as output by document_tokens()
+    Outputs (idx, sent_len, doc_len) as integer arrays:
+        idx         vocabulary index of every token, len(vocab) if not in the model
+        sent_len    number of tokens in each sentence
+        doc_len     number of sentences in each document
+    """
+    unknown = len(vocab)
+    idx = [vocab.get(tok, unknown) for sent_tokens in documents for tokens in sent_tokens for tok in tokens]
+    sent_len = [len(tokens) for sent_tokens in documents for tokens in sent_tokens]
+    doc_len = [len(sent_tokens) for sent_tokens in documents]
+    return (np.array(idx, dtype=np.int64),
+            np.array(sent_len, dtype=np.int64),
+            np.array(doc_len, dtype=np.int64))
+
+def score_indexed(weights, idx, sent_len, doc_len, minwords = MINWORDS):
+    """
+    Public
+    weights as output by compile_model(), idx etc. as output by index_documents()
+    Outputs array of document scores - the mean over sentences of the average
+    log-likelihood of their tokens, LOGZERO for sentences shorter than minwords
+    """
+    nsents = len(sent_len)
+    sent_id = np.repeat(np.arange(nsents), sent_len)
+    sent_sum = np.bincount(sent_id, weights=weights[idx], minlength=nsents)
+    sent_score = np.full(nsents, LOGZERO)
+    ok = sent_len >= minwords
+    sent_score[ok] = sent_sum[ok] / sent_len[ok]
+    doc_id = np.repeat(np.arange(len(doc_len)), doc_len)
+    doc_sum = np.bincount(doc_id, weights=sent_score, minlength=len(doc_len))
+    return doc_sum / np.maximum(doc_len, 1)
+
+def score_batch(model, documents, minwords = MINWORDS):
+    """
+    Public
+    model as output by compile_model(), documents as for index_documents()
+    Outputs array of document scores, as score_tokens() for each document
+    """
+    idx, sent_len, doc_len = index_documents(documents, model['vocab'])
+    return score_indexed(model['weights'], idx, sent_len, doc_len, minwords)
+
+
+##############################################################
+# stored lemma bags
+
+def encode_bags(sent_tokens):
+    """
+    Public
+    sent_tokens as output by document_tokens()
+    Outputs compressed bytes - one line per sentence, lemmas separated by spaces
+    (lemmas are alphabetic, so never contain either separator)
+    """
+    return zlib.compress('\n'.join([' '.join(tokens) for tokens in sent_tokens]).encode('utf-8'))
+
+def decode_bags(blob):
+    """
+    Public
+    inverse of encode_bags()
+    """
+    return [line.split() for line in zlib.decompress(blob).decode('utf-8').split('\n')]
@@ -0,0 +1,253 @@
+"""
+Take database records in a language other than English (title/abstract already
+translated) that have full PDF text, and fill 'pdftext_translation' using Azure Translator.
+
+Each pdftext is split at sentence boundaries into parts of at most PARTCHARS characters.
+The sentences of parts from several documents go through the translation memory (see
+translation_memory.py), so boilerplate repeated across papers is paid for only once,
+and the rest are packed together into Translator requests (see translator.py).
+Translated parts are kept in the table 'pdftext_translation_parts' until a document is
+complete, when they are joined in order into pdftext_translation - so a document left
+unfinished by one run is resumed by the next, without paying for its translated parts
+again. Stored parts are keyed on a hash of the pdftext and PARTCHARS, so they are only
+reused if both are unchanged. A completed translation resets 'gotspecies', so that
+find_species.py rescans the record with its pdftext_translation.
+
+Each run sends at most CHARBUDGET characters to Azure, on records with species mentions
+first and then in order of decreasing score.
+
+E.g.
+
+open -g $AZURE_VOLUME
+pgfile="/Volumes/blitshare/pg/param.txt"
+
+python3 ./process/translate_pdftext.py $pgfile
+
+"""
+
+import os, sys
+import time
+import hashlib
+import pgstream
+import translator as tr
+import translation_memory as tmem
+from sqlalchemy import create_engine, select, delete, bindparam, or_, func
+from sqlalchemy import Table, Column, String, Integer, Float, MetaData
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+
+# read command line
+try:
+	pgfile = sys.argv[1];			        del sys.argv[1]
+except:
+	print("Usage:", sys.argv[0], "pg_file")
+	sys.exit(1)
+
+# read Postgres parameters
+try:
+	exec(open(pgfile).read())
+except:
+	print(f'Cannot open file {pgfile}')
+	sys.exit(1)
+
+# run budgets (None for no limit), documents per batch of requests and part size
+CHARBUDGET = 2000000
+TIMEBUDGET = 1800
+BATCHDOCS = 20
+PARTCHARS = 10000
+
+# Subscription key endpoint, parameters etc
+subscription_key = os.environ['AZURE_TRANSLATION_SUBSCRIPTION_KEY']
+endpoint = os.environ['AZURE_TRANSLATION_ENDPOINT']
+location = os.environ['AZURE_TRANSLATION_LOCATION']
+client = tr.make_client(endpoint, subscription_key, location)
+
+# open connection to database
+engine = create_engine(f"postgresql://{PGUSER}:{PGPASSWORD}@{PGHOST}:5432/{PGDATABASE}", echo=False)
+
+# create SQL tables
+metadata_obj = MetaData()
+links = Table('links', metadata_obj,
+              Column('link', String, primary_key=True),
+              Column('pdftext', String),
+              Column('pdftext_translation', String),
+              Column('gottext', Integer),
+              Column('gottranslation', Integer),
+              Column('gotspecies', Integer),
+              Column('species', String),
+              Column('score', Float),
+              Column('language', String)
+             )
+parts_table = Table('pdftext_translation_parts', metadata_obj,
+              Column('link', String, primary_key=True),
+              Column('part', Integer, primary_key=True),
+              Column('nparts', Integer),
+              Column('texthash', String),
+              Column('translation', String)
+             )
+
+##########################################################
+# functions
+
+def text_hash(text, partchars = PARTCHARS):
+    """
+    sha256 of text and part size, truncated - parts split at another
+    PARTCHARS fall at other boundaries, so must not be reused
+    """
+    return hashlib.sha256(f'{partchars}:{text}'.encode('utf-8')).hexdigest()[:32]
+
+def done_parts(rows):
+    """
+    dict link --> dict part --> translation, of parts already translated
+    from the current pdftext of each row
+    """
+    hashes = {row.link: text_hash(row.pdftext) for row in rows}
+    out = dict()
+    selecter = select(parts_table).where(parts_table.c.link.in_(list(hashes)))
+    with engine.connect() as conn:
+        for row in conn.execute(selecter):
+            if row.texthash == hashes[row.link]:
+                out.setdefault(row.link, dict())[row.part] = row.translation
+    return out
+
+##########################################################
+
+def main():
+    # initialise counters
+    ndocs = 0
+    ncomplete = 0
+    nchars = 0
+    total = {'requests': 0, 'elements': 0, 'chars': 0, 'failed': 0,
+             'retries': 0, 'throttled': 0, 'waited': 0.0, 'latency': [],
+             'segments': 0, 'hits': 0, 'saved': 0}
+
+    # make sure parts and memory tables exist
+    metadata_obj.create_all(engine, tables = [parts_table], checkfirst = True)
+    tmem.ensure_table(engine)
+
+    # select database records - species mentions first, then by score
+    selecter = select(links.c.link, links.c.pdftext).\
+        where(
+            links.c.gottext == 1,
+            links.c.gottranslation == 1,
+            links.c.language != 'en',
+            links.c.pdftext != '',
+            links.c.pdftext != None,
+            or_(links.c.pdftext_translation == None, links.c.pdftext_translation == '')
+            ).\
+        order_by(
+            (func.coalesce(links.c.species, '') != '').desc(),
+            links.c.score.desc().nulls_last()
+            )
+    # make update instructions
+    part_writer = pg_insert(parts_table).\
+            values(
+                link = bindparam('linkvalue'),
+                part = bindparam('partvalue'),
+                nparts = bindparam('npartsvalue'),
+                texthash = bindparam('hashvalue'),
+                translation = bindparam('transvalue')
+                )
+    part_writer = part_writer.on_conflict_do_update(
+                index_elements = ['link', 'part'],
+                set_ = {
+                    'nparts': part_writer.excluded.nparts,
+                    'texthash': part_writer.excluded.texthash,
+                    'translation': part_writer.excluded.translation
+                    }
+                )
+    updater = links.update().\
+            where(links.c.link == bindparam('linkvalue')).\
+            values(
+                pdftext_translation = bindparam('transvalue'),
+                gotspecies = 0
+                )
+    part_deleter = delete(parts_table).\
+            where(parts_table.c.link == bindparam('linkvalue'))
+
+    # MAIN LOOP - over batches of documents in priority order
+    start = time.time()
+    for rows in pgstream.stream_chunks(engine, selecter, BATCHDOCS, None, TIMEBUDGET):
+        done = done_parts(rows)
+        # split each document into parts and collect those still to translate,
+        # as far as the character budget allows (counting parts in full, before
+        # any are found in memory)
+        docs = []
+        todo = []
+        over = False
+        planned = nchars
+        for row in rows:
+            parts = tr.split_text(row.pdftext, PARTCHARS)
+            doc_done = done.get(row.link, dict())
+            for k, part in enumerate(parts):
+                if k in doc_done:
+                    continue
+                if CHARBUDGET is not None and planned + len(part) > CHARBUDGET:
+                    over = True
+                    break
+                todo += [(row.link, k, len(parts), text_hash(row.pdftext), part)]
+                planned += len(part)
+            docs += [(row.link, parts, doc_done)]
+            if over:
+                break
+        ndocs += len(set([x[0] for x in todo]))
+
+        # translate parts of all documents together, sentence by sentence through memory
+        results, stats = tmem.translate_texts(engine, client, [x[4] for x in todo], [True] * len(todo))
+        for k in total:
+            total[k] += stats[k]
+        nchars += stats['chars']
+        part_list = []
+        for (thislink, k, n, h, _), r in zip(todo, results):
+            if r == None:
+                continue
+            part_list += [{
+                        'linkvalue': thislink,
+                        'partvalue': k,
+                        'npartsvalue': n,
+                        'hashvalue': h,
+                        'transvalue': r[1]
+                        }]
+            done.setdefault(thislink, dict())[k] = r[1]
+
+        # reassemble complete documents in order
+        update_list = []
+        for thislink, parts, doc_done in docs:
+            doc_done.update(done.get(thislink, dict()))
+            if all([k in doc_done for k in range(len(parts))]):
+                update_list += [{
+                            'linkvalue': thislink,
+                            'transvalue': ' '.join([doc_done[k] for k in range(len(parts))])
+                            }]
+                print(f'{ncomplete + len(update_list)}: {thislink} ({len(parts)} parts)')
+        ncomplete += len(update_list)
+
+        # commit this batch: new parts, complete documents and their parts cleared
+        pgstream.write_statements(engine, [
+                    (part_writer, part_list),
+                    (updater, update_list),
+                    (part_deleter, [{'linkvalue': x['linkvalue']} for x in update_list])
+                    ])
+        if over:
+            print(f'Character budget of {CHARBUDGET} used up')
+            break
+    # END OF MAIN LOOP
+    elapsed = max(time.time() - start, 1e-6)
+
+    nreq = max(total['requests'], 1)
+    print(f"{total['requests']} requests ({total['failed']} failed): "
+          f"{total['elements']/nreq:.1f} segments and {total['chars']/nreq:.0f} characters per request, "
+          f"{total['chars']/elapsed:.0f} characters/sec")
+    print(f"{total['retries']} retries, {total['throttled']} throttled, {tr.latency_summary(total['latency'])}")
+    nevicted = tmem.evict(engine)
+    print(f"Translation memory: {total['hits']} of {total['segments']} segments found "
+          f"({100*total['hits']/max(total['segments'], 1):.1f}%), {total['saved']} characters saved, "
+          f"{nevicted} entries evicted")
+    print(f'Sent {nchars} characters of {ndocs} documents, {ncomplete} documents completed')
+    return 0
+
+##########################################################
+
+if __name__ == '__main__':
+	main()
+
+# DONE
\ No newline at end of file
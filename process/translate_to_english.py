@@ -10,10 +10,20 @@ pgfile="/Volumes/blitshare/pg/param.txt"
 
 python3 ./process/translate_to_english.py $pgfile
 
+Titles and abstracts of a whole chunk of records are packed into as few Translator
+requests as its element/character limits allow, sent concurrently within a
+characters-per-minute budget and retried when throttled (see translator.py).
+Abstracts are translated sentence by sentence, titles whole, and every segment goes
+through the translation memory (see translation_memory.py) so that text seen before
+is never sent to Azure again.
+
 """
 
 import os, sys
-import requests, uuid
+import time
+import pgstream
+import translator as tr
+import translation_memory as tmem
 from sqlalchemy import create_engine, update, select, bindparam
 from sqlalchemy import Table, Column, String, Integer, MetaData
 
@@ -31,24 +41,16 @@ except:
 	print(f'Cannot open file {pgfile}')
 	sys.exit(1)
 
-# global constants
-MAXCALLS = 1000
+# run budget (None for no limit) and commit size
+MAXRECORDS = None
+TIMEBUDGET = 1800
+CHUNKSIZE = 500
 
 # Subscription key endpoint, parameters etc
 subscription_key = os.environ['AZURE_TRANSLATION_SUBSCRIPTION_KEY']
 endpoint = os.environ['AZURE_TRANSLATION_ENDPOINT']
 location = os.environ['AZURE_TRANSLATION_LOCATION']
-constructed_url = endpoint + '/translate'
-params = {
-    'api-version': '3.0',
-    'to': 'en'
-}
-headers = {
-    'Ocp-Apim-Subscription-Key': subscription_key,
-    'Ocp-Apim-Subscription-Region': location,
-    'Content-type': 'application/json',
-    'X-ClientTraceId': str(uuid.uuid4())
-}
+client = tr.make_client(endpoint, subscription_key, location)
 
 # open connection to database  
 engine = create_engine(f"postgresql://{PGUSER}:{PGPASSWORD}@{PGHOST}:5432/{PGDATABASE}", echo=False)
@@ -83,36 +85,48 @@ def main():
             links.c.species != '',
             links.c.species != None
             )
-    # initialise update list for this domain
-    update_list = []
-
-    # connect to database
-    with engine.connect() as conn:
-        records = conn.execute(selecter)
-    # MAIN LOOP
-    for row in records:
-        thislink = row.link
-        # stop if reached MAXCALLS
-        if ncalls >= MAXCALLS:
-            break
+    # make update instructions
+    updater = links.update().\
+            where(links.c.link == bindparam('linkvalue')).\
+            values(
+                language = bindparam('langvalue'),
+                title_translation = bindparam('ttransvalue'),
+                abstract_translation = bindparam('atransvalue'),
+                gottranslation = bindparam('transflagvalue')
+                )
+    # initialise counters for updates and requests
+    nupdates = 0
+    total = {'requests': 0, 'elements': 0, 'chars': 0, 'failed': 0,
+             'retries': 0, 'throttled': 0, 'waited': 0.0, 'latency': [],
+             'segments': 0, 'hits': 0, 'saved': 0}
+    tmem.ensure_table(engine)
+
+    # MAIN LOOP - over chunks streamed from the database, translated together
+    start = time.time()
+    for rows in pgstream.stream_chunks(engine, selecter, CHUNKSIZE, MAXRECORDS, TIMEBUDGET):
         # skip bad records
-        if row.title == "" or row.title == None or row.abstract == "" or row.abstract == None:
-            continue
-        ncalls += 1
+        rows = [row for row in rows
+                if not (row.title == "" or row.title == None or row.abstract == "" or row.abstract == None)]
+        ncalls += len(rows)
         # package text for translation
-        body = [
-            {'text': row.title},
-            {'text': row.abstract},
-            ]
-        try:
-            request = requests.post(constructed_url, params=params, headers=headers, json=body)
-            response = request.json()
-            langs = [r['detectedLanguage']['language'] for r in response]
+        texts = []
+        for row in rows:
+            texts += [row.title, row.abstract]
+        results, stats = tmem.translate_texts(engine, client, texts, [False, True] * len(rows))
+        for k in total:
+            total[k] += stats[k]
+        update_list = []
+        for i, row in enumerate(rows):
+            title_result, abstract_result = results[2*i], results[2*i + 1]
+            # skip if its request failed
+            if title_result == None or abstract_result == None:
+                continue
+            langs = title_result[0] + abstract_result[0]
             language = '|'.join(list(set(langs)))
             # skip next bit if language is all English
             if language == 'en':
                 update_list += [{
-                        'linkvalue': thislink,
+                        'linkvalue': row.link,
                         'ttransvalue': '',
                         'atransvalue': '', 
                         'langvalue': 'en',
@@ -120,49 +134,36 @@ def main():
                         }]
                 continue
             # otherwise proceed
-            title_translation = response[0]["translations"][0]["text"]
-            abstract_translation = response[1]["translations"][0]["text"]
-            transflag = 1
+            title_translation = title_result[1]
+            abstract_translation = abstract_result[1]
             ngood += 1
             # verbose
-            print(f'{ncalls}: {row.title}')
+            print(f'{ngood}: {row.title}')
             print(f'{language} --> {title_translation}')
-        except Exception as ex:
-            print(response['error']['message'])
-            title_translation = ""
-            abstract_translation = ""
-            language = row.language
-            transflag = 0
-            continue
-        # record updates
-        update_list += [{
-                        'linkvalue': row.link,
-                        'ttransvalue': title_translation,
-                        'atransvalue': abstract_translation, 
-                        'langvalue': language,
-                        'transflagvalue': transflag
-                        }]
+            # record updates
+            update_list += [{
+                            'linkvalue': row.link,
+                            'ttransvalue': title_translation,
+                            'atransvalue': abstract_translation, 
+                            'langvalue': language,
+                            'transflagvalue': 1
+                            }]
+        # commit this chunk
+        nupdates += pgstream.write_chunk(engine, updater, update_list)
     # END OF MAIN LOOP
-    # finish if no output
-    if update_list == []:
-        print(f'Made total {ngood} translations out of {ncalls} calls')
-        return 0
-
-    # ... otherwise make update instructions
-    updater = links.update().\
-            where(links.c.link == bindparam('linkvalue')).\
-            values(
-                language = bindparam('langvalue'),
-                title_translation = bindparam('ttransvalue'),
-                abstract_translation = bindparam('atransvalue'),
-                gottranslation = bindparam('transflagvalue')
-                )
-    # ... and commit to remote table
-    with engine.connect() as conn:
-        conn.execute(updater, update_list)
-        conn.commit()
-
-    print(f'Made total {ngood} translations out of {ncalls} calls')
+    elapsed = max(time.time() - start, 1e-6)
+
+    nreq = max(total['requests'], 1)
+    print(f"{total['requests']} requests ({total['failed']} failed) for {ncalls} records: "
+          f"{total['elements']/nreq:.1f} elements and {total['chars']/nreq:.0f} characters per request, "
+          f"{ncalls/elapsed:.2f} records/sec")
+    print(f"{total['retries']} retries, {total['throttled']} throttled, {total['waited']:.1f}s waiting, "
+          f"{tr.latency_summary(total['latency'])}")
+    nevicted = tmem.evict(engine)
+    print(f"Translation memory: {total['hits']} of {total['segments']} segments found "
+          f"({100*total['hits']/max(total['segments'], 1):.1f}%), {total['saved']} characters saved, "
+          f"{nevicted} entries evicted")
+    print(f'Made total {ngood} translations out of {ncalls} calls, {nupdates} updates written')
     return 0
 
 ##########################################################
@@ -0,0 +1,220 @@
+"""
+Package of routines for a translation memory in the database.
+
+Text is translated segment by segment - titles whole, abstracts sentence by sentence -
+and every segment translated is kept in the table 'translation_memory', keyed by a
+hash of the normalised source segment (Unicode NFC, whitespace collapsed) and the
+target language. The memory is consulted before any call to the Translator, so a
+title seen before from another source, or boilerplate repeated across a journal's
+abstracts, is never paid for twice. Entries record when they were last used, and
+evict() keeps the memory to about MAXENTRIES entries, dropping the least recently used.
+
+E.g.
+
+import translation_memory as tmem
+tmem.ensure_table(engine)
+results, stats = tmem.translate_texts(engine, client, [title, abstract], [False, True])
+tmem.evict(engine)
+"""
+
+import hashlib
+import unicodedata
+from datetime import datetime
+from sqlalchemy import select, delete, bindparam
+from sqlalchemy import Table, Column, String, Integer, DateTime, MetaData
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+import translator as tr
+
+
+##############################################################
+# parameters
+
+MAXENTRIES = 2000000
+
+metadata_obj = MetaData()
+translation_memory = Table('translation_memory', metadata_obj,
+              Column('hash', String, primary_key=True),
+              Column('target', String, primary_key=True),
+              Column('source', String),
+              Column('language', String),
+              Column('translation', String),
+              Column('hits', Integer),
+              Column('last_used', DateTime)
+             )
+
+
+##############################################################
+# segments
+
+def normalize(text):
+    """
+    Public
+    NFC with whitespace collapsed
+    """
+    return unicodedata.normalize('NFC', ' '.join(text.split()))
+
+def segment_hash(text):
+    """
+    Public
+    sha256 of normalised text, truncated
+    """
+    return hashlib.sha256(normalize(text).encode('utf-8')).hexdigest()[:32]
+
+def split_segments(text, by_sentence = True):
+    """
+    Public
+    text as a list of segments: sentences (at most MAXCHARS each) or the whole text
+    """
+    if not by_sentence:
+        return tr.split_text(text)
+    segments = []
+    for sent in tr.sentence_patt.split(text):
+        if sent.strip() != '':
+            segments += tr.split_text(sent)
+    return segments
+
+
+##############################################################
+# memory
+
+def ensure_table(engine):
+    """
+    Public
+    create the memory table if not already there
+    """
+    metadata_obj.create_all(engine, tables = [translation_memory], checkfirst = True)
+
+def lookup(engine, hashes, target):
+    """
+    Public
+    Outputs dict hash --> (language, translation) of the hashes found in memory,
+    marking them as used
+    """
+    found = dict()
+    if hashes == []:
+        return found
+    selecter = select(translation_memory).\
+        where(
+            translation_memory.c.target == target,
+            translation_memory.c.hash.in_(hashes)
+            )
+    toucher = translation_memory.update().\
+            where(
+                translation_memory.c.hash == bindparam('hashvalue'),
+                translation_memory.c.target == target
+                ).\
+            values(
+                hits = translation_memory.c.hits + 1,
+                last_used = datetime.now()
+                )
+    with engine.connect() as conn:
+        for row in conn.execute(selecter):
+            found[row.hash] = (row.language, row.translation)
+        if len(found) > 0:
+            conn.execute(toucher, [{'hashvalue': h} for h in found])
+        conn.commit()
+    return found
+
+def store(engine, entries, target):
+    """
+    Public
+    entries is a dict hash --> (source, language, translation)
+    """
+    if len(entries) == 0:
+        return
+    writer = pg_insert(translation_memory).\
+            values(
+                hash = bindparam('hashvalue'),
+                target = target,
+                source = bindparam('sourcevalue'),
+                language = bindparam('langvalue'),
+                translation = bindparam('transvalue'),
+                hits = 0,
+                last_used = datetime.now()
+                )
+    writer = writer.on_conflict_do_update(
+                index_elements = ['hash', 'target'],
+                set_ = {
+                    'language': writer.excluded.language,
+                    'translation': writer.excluded.translation,
+                    'last_used': writer.excluded.last_used
+                    }
+                )
+    with engine.connect() as conn:
+        conn.execute(writer, [{
+                    'hashvalue': h,
+                    'sourcevalue': source,
+                    'langvalue': language,
+                    'transvalue': translation
+                    } for h, (source, language, translation) in entries.items()])
+        conn.commit()
+
+def evict(engine, max_entries = MAXENTRIES):
+    """
+    Public
+    drop least recently used entries beyond max_entries (entries last used at
+    the same time as the max_entries-th are kept)
+    Outputs number of entries dropped
+    """
+    keep = select(translation_memory.c.last_used).\
+        order_by(translation_memory.c.last_used.desc()).\
+        offset(max_entries).\
+        limit(1).\
+        scalar_subquery()
+    with engine.connect() as conn:
+        result = conn.execute(delete(translation_memory).where(translation_memory.c.last_used < keep))
+        conn.commit()
+    return result.rowcount
+
+
+##############################################################
+# translation
+
+def translate_texts(engine, client, texts, by_sentence, post = tr.post_batch):
+    """
+    Public
+    As translator.translate_texts(), with by_sentence a list of booleans saying
+    which texts to translate sentence by sentence. Segments are looked up in
+    memory first; only the distinct segments not found are sent to the
+    Translator, and their translations added to memory.
+    Outputs (results, stats) where results is a list aligned with texts of
+    ([language with most characters], translation), or None if some segment
+    failed, and stats as for translator.translate_texts() plus counts of
+    segments, memory hits and characters saved
+    """
+    target = client['params']['to']
+    # split into segments
+    segments = [split_segments(text, s) for text, s in zip(texts, by_sentence)]
+    hashes = [[segment_hash(x) for x in segs] for segs in segments]
+
+    # consult memory, translate the rest once each
+    distinct = dict()
+    for segs, hs in zip(segments, hashes):
+        for x, h in zip(segs, hs):
+            distinct.setdefault(h, x)
+    found = lookup(engine, list(distinct), target)
+    missing = [h for h in distinct if h not in found]
+    missing_set = set(missing)
+    results, stats = tr.translate_texts(client, [distinct[h] for h in missing], post)
+    new_entries = {h: (distinct[h], r[0][0], r[1]) for h, r in zip(missing, results) if r != None}
+    store(engine, new_entries, target)
+    for h, (_, language, translation) in new_entries.items():
+        found[h] = (language, translation)
+
+    # reassemble, with each text's language the one covering most characters
+    out = []
+    for segs, hs in zip(segments, hashes):
+        if any([h not in found for h in hs]):
+            out += [None]
+            continue
+        nchars = dict()
+        for x, h in zip(segs, hs):
+            nchars[found[h][0]] = nchars.get(found[h][0], 0) + len(x)
+        out += [([max(nchars, key=nchars.get)] if len(nchars) > 0 else [],
+                 ' '.join([found[h][1] for h in hs]))]
+
+    nsegments = sum([len(hs) for hs in hashes])
+    stats['segments'] = nsegments
+    stats['hits'] = nsegments - sum([1 for hs in hashes for h in hs if h in missing_set])
+    stats['saved'] = sum([len(x) for segs, hs in zip(segments, hashes) for x, h in zip(segs, hs)]) - stats['chars']
+    return out, stats
@@ -0,0 +1,334 @@
+"""
+Package of routines for calls to the Azure Translator (v3) API.
+
+The API accepts up to MAXELEMENTS text elements and MAXCHARS characters per request,
+and latency per request rather than the number of characters is what limits a run.
+Texts from many records are therefore packed into as few requests as the limits
+allow, and the responses unpacked back to the texts they came from. A text longer
+than the character limit is split at sentence boundaries (or failing that at
+whitespace) and its parts translated separately and rejoined in order.
+
+Requests are sent from a pool of CONCURRENCY threads, all drawing on one token
+bucket of CHARS_PER_MINUTE characters so as to stay within the Azure tier. Each
+request has a timeout; a throttled (429) or failed (5xx, timeout) request is retried
+after the Retry-After delay if given, otherwise with exponential backoff, waiting
+at most BACKOFF_MAX seconds. Latency of every call is recorded in the run statistics.
+translator_stub.py serves a local imitation of the API, throttling included, to run
+all this against.
+
+E.g.
+
+import translator as tr
+client = tr.make_client(endpoint, subscription_key, location)
+results, stats = tr.translate_texts(client, [title, abstract, ...])
+for langs, translation in results:
+    ...
+"""
+
+import re
+import time
+import uuid
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import requests
+
+
+##############################################################
+# parameters
+
+MAXELEMENTS = 100
+MAXCHARS = 50000
+
+# concurrency and throughput - S1 tier allows 40 million characters per hour
+CONCURRENCY = 4
+CHARS_PER_MINUTE = 40000000 // 60
+BURST_SECONDS = 10
+
+# (connect, read) timeout in seconds, and retries of throttled or failed requests
+TIMEOUT = (10, 120)
+MAXRETRIES = 5
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 60.0
+
+# sentence ends, for splitting long texts
+sentence_patt = re.compile(r'(?<=[.!?;。！？])\s+')
+space_patt = re.compile(r'\s+')
+
+
+##############################################################
+# splitting and packing
+
+def _hard_split(text, maxchars):
+    """
+    Private
+    split at the last whitespace before each maxchars, or at maxchars if none
+    """
+    parts = []
+    while len(text) > maxchars:
+        cut = max([m.start() for m in space_patt.finditer(text, 0, maxchars + 1)] + [0])
+        if cut == 0:
+            cut = maxchars
+        parts += [text[:cut]]
+        text = text[cut:].lstrip()
+    return parts + [text]
+
+def split_text(text, maxchars = MAXCHARS):
+    """
+    Public
+    Outputs list of parts of text, each at most maxchars, made up of whole
+    sentences where possible - joined by single spaces they give text back
+    up to whitespace
+    """
+    if len(text) <= maxchars:
+        return [text]
+    parts = []
+    current = ''
+    for sent in sentence_patt.split(text):
+        for piece in _hard_split(sent, maxchars):
+            if current == '':
+                current = piece
+            elif len(current) + 1 + len(piece) <= maxchars:
+                current = current + ' ' + piece
+            else:
+                parts += [current]
+                current = piece
+    return parts + [current]
+
+def pack(lengths, max_elements = MAXELEMENTS, max_chars = MAXCHARS):
+    """
+    Public
+    lengths is a list of element lengths, each at most max_chars
+    Outputs list of requests, each a list of consecutive element indices
+    within both limits
+    """
+    requests_list = []
+    current = []
+    nchars = 0
+    for i, n in enumerate(lengths):
+        if len(current) == max_elements or nchars + n > max_chars:
+            requests_list += [current]
+            current = []
+            nchars = 0
+        current += [i]
+        nchars += n
+    if current != []:
+        requests_list += [current]
+    return requests_list
+
+
+##############################################################
+# rate limiting
+
+class TokenBucket:
+    """
+    Public
+    Thread-safe token bucket refilled at rate tokens per minute, holding at most
+    burst seconds' worth - so no minute ever sees more than (1 + burst/60) * rate
+    """
+    def __init__(self, rate, burst = BURST_SECONDS):
+        self.rate = rate
+        self.capacity = rate * burst / 60
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, n):
+        """
+        block until n tokens are available, or the bucket is full if n is larger
+        than it can hold (then it goes into debt for the difference)
+        Outputs seconds waited
+        """
+        need = min(n, self.capacity)
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate / 60)
+                self.last = now
+                if self.tokens >= need:
+                    self.tokens -= n
+                    return waited
+                wait = (need - self.tokens) * 60 / self.rate
+            time.sleep(wait)
+            waited += wait
+
+
+##############################################################
+# API calls
+
+class RetryableError(Exception):
+    """
+    Public
+    throttled (HTTP 429) or transient failure, with the server's Retry-After
+    (seconds) if any
+    """
+    def __init__(self, message, retry_after = None, throttled = False):
+        super().__init__(message)
+        self.retry_after = retry_after
+        self.throttled = throttled
+
+def make_client(endpoint, subscription_key, location, to = 'en',
+                concurrency = CONCURRENCY, chars_per_minute = CHARS_PER_MINUTE):
+    """
+    Public
+    Outputs dict of url, params, headers, concurrency and rate limiter for translation calls
+    """
+    return {
+        'concurrency': concurrency,
+        'bucket': TokenBucket(chars_per_minute),
+        'url': endpoint + '/translate',
+        'params': {
+            'api-version': '3.0',
+            'to': to
+        },
+        'headers': {
+            'Ocp-Apim-Subscription-Key': subscription_key,
+            'Ocp-Apim-Subscription-Region': location,
+            'Content-type': 'application/json',
+            'X-ClientTraceId': str(uuid.uuid4())
+        }
+    }
+
+_local = threading.local()
+
+def _session():
+    """
+    Private
+    one HTTP session (connection pool) per thread
+    """
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+def _retry_after(request):
+    """
+    Private
+    Retry-After header in seconds, or None
+    """
+    try:
+        return float(request.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+def post_batch(client, texts):
+    """
+    Public
+    One request translating texts (within the API limits)
+    Outputs list of (detected language, translation), raising RetryableError if
+    throttled, timed out or the server fails, and RuntimeError for other errors
+    """
+    try:
+        request = _session().post(client['url'], params=client['params'], headers=client['headers'],
+                                  json=[{'text': text} for text in texts], timeout=TIMEOUT)
+    except (requests.Timeout, requests.ConnectionError) as ex:
+        raise RetryableError(f'{type(ex).__name__}: {ex}')
+    if request.status_code == 429 or request.status_code >= 500:
+        raise RetryableError(f'HTTP {request.status_code}: {request.text[:200]}',
+                             _retry_after(request), request.status_code == 429)
+    response = request.json()
+    if isinstance(response, dict) and 'error' in response:
+        raise RuntimeError(response['error']['message'])
+    return [(r['detectedLanguage']['language'], r['translations'][0]['text']) for r in response]
+
+def backoff(attempt, retry_after = None):
+    """
+    Public
+    seconds to wait before retry number attempt (from 0): Retry-After if given,
+    otherwise exponential with jitter, at most BACKOFF_MAX either way
+    """
+    if retry_after is not None:
+        return min(BACKOFF_MAX, max(0.0, retry_after))
+    return min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt) * random.uniform(0.5, 1.0)
+
+def post_with_retry(client, texts, post = post_batch):
+    """
+    Public
+    post() within the client's rate limit, retrying throttled or failed requests
+    Outputs (list of (detected language, translation), dict of call statistics:
+    latency of each attempt in seconds, retries, throttled, seconds waited)
+    """
+    calls = {'latency': [], 'retries': 0, 'throttled': 0, 'waited': 0.0}
+    calls['waited'] += client['bucket'].acquire(sum([len(t) for t in texts]))
+    for attempt in range(MAXRETRIES + 1):
+        start = time.monotonic()
+        try:
+            result = post(client, texts)
+            calls['latency'] += [time.monotonic() - start]
+            return result, calls
+        except RetryableError as ex:
+            calls['latency'] += [time.monotonic() - start]
+            if attempt == MAXRETRIES:
+                raise
+            calls['retries'] += 1
+            if ex.throttled:
+                calls['throttled'] += 1
+            wait = backoff(attempt, ex.retry_after)
+            print(f'Retrying in {wait:.1f}s after {ex}')
+            time.sleep(wait)
+            calls['waited'] += wait
+
+def latency_summary(latency):
+    """
+    Public
+    Outputs string of mean, median, 95th percentile and max of a list of latencies
+    """
+    if latency == []:
+        return 'no calls'
+    x = sorted(latency)
+    p = lambda q: x[min(len(x) - 1, int(q * len(x)))]
+    return f'latency mean {sum(x)/len(x):.2f}s, median {p(0.5):.2f}s, 95% {p(0.95):.2f}s, max {x[-1]:.2f}s'
+
+def translate_texts(client, texts, post = post_batch):
+    """
+    Public
+    Translates texts in as few requests as the API limits allow
+    Outputs (results, stats) where results is a list aligned with texts of
+    (list of detected languages of its parts, translation), or None if any
+    request holding part of the text failed, and stats is a dict of counts
+    of requests, elements, characters, failed requests, retries, throttled
+    requests, seconds waited and latency of each call. Requests are sent
+    concurrently over the client's thread pool.
+    """
+    # split long texts into parts
+    parts = []
+    owner = []
+    for i, text in enumerate(texts):
+        for part in split_text(text):
+            parts += [part]
+            owner += [i]
+    stats = {'requests': 0, 'elements': len(parts), 'chars': sum([len(p) for p in parts]),
+             'failed': 0, 'retries': 0, 'throttled': 0, 'waited': 0.0, 'latency': []}
+
+    # pack parts into requests and send them concurrently
+    def send(request_ids):
+        try:
+            return post_with_retry(client, [parts[i] for i in request_ids], post)
+        except Exception as ex:
+            print(f'Translation request failed: {ex}')
+            return None, None
+    translated = [None] * len(parts)
+    packed = pack([len(p) for p in parts])
+    with ThreadPoolExecutor(max_workers=client['concurrency']) as executor:
+        for request_ids, (response, calls) in zip(packed, executor.map(send, packed)):
+            stats['requests'] += 1
+            if response == None:
+                stats['failed'] += 1
+                continue
+            for k in ['retries', 'throttled', 'waited', 'latency']:
+                stats[k] += calls[k]
+            for i, r in zip(request_ids, response):
+                translated[i] = r
+
+    # reassemble texts from their parts, in order
+    results = [([], []) for _ in texts]
+    for i, r in zip(owner, translated):
+        if results[i] == None:
+            continue
+        if r == None:
+            results[i] = None
+            continue
+        results[i][0].append(r[0])
+        results[i][1].append(r[1])
+    results = [None if r == None else (r[0], ' '.join(r[1])) for r in results]
+    return results, stats
@@ -0,0 +1,150 @@
+"""
+Local stand-in for the Azure Translator (v3) API, for exercising translator.py.
+
+Serves POST /translate, returning each text upper-cased as its 'translation' with
+detected language 'fr', after a configurable delay. Throttling is simulated in two
+ways: every THROTTLE_EVERY-th request gets a 429 with Retry-After, and a request
+taking the characters of the last minute over CHARS_PER_MINUTE gets a 429 with
+Retry-After set to when it would fit, as Azure does.
+Request size limits are checked as in the real API.
+
+Run as a server, then point the translation stage at it:
+
+python3 ./process/translator_stub.py 8089
+AZURE_TRANSLATION_ENDPOINT=http://localhost:8089 python3 ./process/translate_to_english.py $pgfile
+
+or run a self-check of translator.py against it (nothing touches the database):
+
+python3 ./process/translator_stub.py 8089 check
+
+"""
+
+import sys
+import json
+import math
+import time
+import random
+import threading
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import translator as tr
+
+# read command line
+try:
+	port = int(sys.argv[1]);			del sys.argv[1]
+except:
+	print("Usage:", sys.argv[0], "port [check]")
+	sys.exit(1)
+check = len(sys.argv) > 1 and sys.argv[1] == 'check'
+
+# simulated service behaviour
+DELAY = 0.2
+THROTTLE_EVERY = 7
+RETRY_AFTER = 1
+CHARS_PER_MINUTE = 600000
+
+##########################################################
+
+lock = threading.Lock()
+state = {'requests': 0, 'throttled': 0, 'chars': deque()}
+
+class Handler(BaseHTTPRequestHandler):
+
+    def reply(self, status, body, headers = dict()):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def throttle(self, message, retry_after = RETRY_AFTER):
+        with lock:
+            state['throttled'] += 1
+        self.reply(429, {'error': {'code': 429001, 'message': message}}, {'Retry-After': str(retry_after)})
+
+    def do_POST(self):
+        if not self.path.startswith('/translate'):
+            self.reply(404, {'error': {'code': 404000, 'message': 'Not found'}})
+            return
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        nchars = sum([len(x['text']) for x in body])
+        if len(body) > tr.MAXELEMENTS or nchars > tr.MAXCHARS:
+            self.reply(400, {'error': {'code': 400077, 'message': 'The maximum request size has been exceeded.'}})
+            return
+        now = time.time()
+        with lock:
+            state['requests'] += 1
+            n = state['requests']
+            # characters accepted in the last minute
+            window = state['chars']
+            while len(window) > 0 and window[0][0] < now - 60:
+                window.popleft()
+            # ... and when enough of them drop out of the window for this request
+            excess = sum([c for _, c in window]) + nchars - CHARS_PER_MINUTE
+            wait = 0
+            for t, c in window:
+                if excess <= 0:
+                    break
+                excess -= c
+                wait = t + 60 - now
+            over = wait > 0
+            if not over and n % THROTTLE_EVERY != 0:
+                window.append((now, nchars))
+        if n % THROTTLE_EVERY == 0:
+            self.throttle('The server rejected the request because the client has exceeded request limits.')
+            return
+        if over:
+            self.throttle('The server rejected the request because the client is sending too many characters.',
+                          math.ceil(wait))
+            return
+        time.sleep(DELAY * random.uniform(0.5, 1.5))
+        self.reply(200, [{
+            'detectedLanguage': {'language': 'fr', 'score': 1.0},
+            'translations': [{'text': x['text'].upper(), 'to': 'en'}]
+            } for x in body])
+
+    def log_message(self, format, *args):
+        return
+
+##########################################################
+
+def self_check():
+    """
+    translate a batch of texts, long ones included, and check what comes back
+    """
+    words = 'le la les des oiseaux marins de l océan. population espèce! nid'.split()
+    texts = [' '.join(random.choices(words, k=random.randint(5, 200))) for _ in range(400)]
+    texts += [' '.join(random.choices(words, k=12000)) for _ in range(2)]
+    # the bucket keeps within the stub's limit, counting the burst allowance
+    rate = CHARS_PER_MINUTE / (1 + tr.BURST_SECONDS / 60)
+    client = tr.make_client(f'http://localhost:{port}', 'key', 'location', chars_per_minute=rate)
+    start = time.time()
+    results, stats = tr.translate_texts(client, texts)
+    elapsed = time.time() - start
+    ok = all([r != None and r[1].split() == t.upper().split() for r, t in zip(results, texts)])
+    print(f"{'OK' if ok else 'FAILED'}: {len(texts)} texts, {stats['elements']} elements in {stats['requests']} requests, {elapsed:.1f}s")
+    print(f"{stats['retries']} retries, {stats['throttled']} throttled ({state['throttled']} at the stub), "
+          f"{stats['failed']} failed, {stats['waited']:.1f}s waiting over all threads")
+    print(tr.latency_summary(stats['latency']))
+    return 0 if ok else 1
+
+def main():
+    server = ThreadingHTTPServer(('localhost', port), Handler)
+    if not check:
+        print(f'Translator stub listening on port {port}')
+        server.serve_forever()
+        return 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    out = self_check()
+    server.shutdown()
+    return out
+
+##########################################################
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# DONE
\ No newline at end of file
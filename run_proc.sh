@@ -5,6 +5,8 @@ azurepath='../blitstore/blitshare'
 wileypdf="$azurepath/data/wiley/pdf"
 wileyhtml="$azurepath/data/wiley/html"
 tmppath="$azurepath/data/tmp"
+pdfpath="$azurepath/data/pdf"
+wwwpath="./webapp/www/upload"
 reportpath="$azurepath/reports/scraper"
 
 # postgres
@@ -33,5 +35,14 @@ python3 ./process/translate_to_english.py $pgfile
 # (5) score title/abstract (not pdftext at this stage) on BLI text model
 python3 ./process/score_for_topic.py $pgfile $blimodelfile
 
+# (6) translate full text of non-English records, within a character budget
+python3 ./process/translate_pdftext.py $pgfile
+
+# (7) full text of PDFs read only for title/abstract by the scan, at low priority -
+# species found in it are picked up (and translations made) on the next run
+nice python3 ./scrape/read_pdf_uploads.py $pgfile $pdfpath $wwwpath fulltext
+nice python3 ./scrape/read_wiley_pdf.py $pgfile $wileypdf fulltext
+nice python3 ./scrape/get_pdf_text.py $pgfile $tmppath fulltext
+
 # report 
 echo "Processing complete."
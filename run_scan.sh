@@ -66,13 +66,14 @@ Rscript ./scrape/get_html_text.R $pgfile
 # both run locally in 'run_app_update.sh'
 
 # (4a) scan manually uploaded PDFs
-python3 ./scrape/read_pdf_uploads.py $pgfile $pdfpath $wwwpath
+# (first pages only - full text is read after processing, see run_proc.sh)
+python3 ./scrape/read_pdf_uploads.py $pgfile $pdfpath $wwwpath abstract
 
 # (4b) scan Wiley PDFs and get text
-python3 ./scrape/read_wiley_pdf.py $pgfile $wileypdf
+python3 ./scrape/read_wiley_pdf.py $pgfile $wileypdf abstract
 
 # (5) ... and PDF links for other domains
-python3 ./scrape/get_pdf_text.py $pgfile $tmppath
+python3 ./scrape/get_pdf_text.py $pgfile $tmppath abstract
 
 # (6) remove duplicate records 
 # i.e. different links for same title/abstract,
@@ -0,0 +1,308 @@
+"""
+Package of routines for downloading PDF files politely and concurrently.
+
+URLs are fetched from a pool of WORKERS threads, each with its own pooled HTTP
+session, so that a slow host holds up only its own downloads. Every host is
+limited to PER_DOMAIN requests at a time, and successive requests to it start at
+least DOMAIN_DELAY seconds apart. A download has (connect, read) timeouts, an
+overall time limit and a maximum size, and its body must look like a PDF - by its
+Content-Type and by the '%PDF-' magic bytes near the start - before it is handed
+on to the parser. Each result says why a download failed and whether it is worth
+trying again on a later run. downloader_stub.py serves slow, huge and non-PDF
+responses to run all this against.
+
+E.g.
+
+import downloader as dl
+client = dl.make_downloader()
+for result in dl.fetch_all(client, urls):
+    if result['ok']:
+        ... result['content'] ...
+"""
+
+import time
+import socket
+import threading
+from itertools import zip_longest
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import requests
+from urllib3.exceptions import ReadTimeoutError
+
+
+##############################################################
+# parameters
+
+# concurrency and politeness
+WORKERS = 16
+PER_DOMAIN = 2
+DOMAIN_DELAY = 1.0
+
+# (connect, read) timeout and overall time limit in seconds, size limit in bytes
+TIMEOUT = (10, 30)
+MAXSECONDS = 120
+MAXBYTES = 50 * 1024 * 1024
+CHUNKBYTES = 64 * 1024
+
+# a PDF header may follow some junk, but must come within the first kilobyte
+MAGIC = b'%PDF-'
+MAGIC_WITHIN = 1024
+
+# content types that may be a PDF - anything else (text/html ...) is not
+PDF_TYPES = ['application/pdf', 'application/x-pdf', 'application/octet-stream',
+             'binary/octet-stream', 'application/download', 'application/force-download']
+
+# failures worth retrying on a later run
+TRANSIENT = ['timeout', 'connection', 'server error', 'stopped']
+
+# seconds between checks for a stopped run during a download
+POLL = 0.5
+
+
+##############################################################
+# politeness
+
+class DomainLimiter:
+    """
+    Public
+    Thread-safe limit of per_domain requests at a time to each domain, with
+    request starts at least delay seconds apart
+    """
+    def __init__(self, per_domain = PER_DOMAIN, delay = DOMAIN_DELAY):
+        self.per_domain = per_domain
+        self.delay = delay
+        self.slots = dict()
+        self.next_start = dict()
+        self.lock = threading.Lock()
+
+    def acquire(self, domain):
+        """
+        block until a request to domain may start
+        Outputs seconds waited
+        """
+        start = time.monotonic()
+        with self.lock:
+            slot = self.slots.setdefault(domain, threading.Semaphore(self.per_domain))
+        slot.acquire()
+        with self.lock:
+            now = time.monotonic()
+            go = max(now, self.next_start.get(domain, 0.0))
+            self.next_start[domain] = go + self.delay
+        time.sleep(go - now)
+        return time.monotonic() - start
+
+    def release(self, domain):
+        self.slots[domain].release()
+
+
+##############################################################
+# downloads
+
+def make_downloader(workers = WORKERS, per_domain = PER_DOMAIN, delay = DOMAIN_DELAY,
+                    timeout = TIMEOUT, maxseconds = MAXSECONDS, maxbytes = MAXBYTES):
+    """
+    Public
+    Outputs dict of limits, domain limiter and stop event for fetch() and fetch_all()
+    - once stop is set, downloads under way are cut off and no more are started
+    """
+    return {
+        'workers': workers,
+        'limiter': DomainLimiter(per_domain, delay),
+        'timeout': timeout,
+        'maxseconds': maxseconds,
+        'maxbytes': maxbytes,
+        'stop': threading.Event()
+    }
+
+_local = threading.local()
+
+def _session():
+    """
+    Private
+    one HTTP session (connection pool) per thread
+    """
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+def domain_of(url):
+    """
+    Public
+    host name of url, as used for the per-domain limits
+    """
+    return urlparse(url).netloc.lower()
+
+def is_pdf_type(content_type):
+    """
+    Public
+    True if a Content-Type header (or its absence) allows a PDF
+    """
+    if content_type is None or content_type.strip() == '':
+        return True
+    return content_type.split(';')[0].strip().lower() in PDF_TYPES
+
+def _result(url, reason, status = None, content = None, content_type = None, start = None):
+    """
+    Private
+    """
+    return {
+        'url': url,
+        'ok': reason == 'ok',
+        'reason': reason,
+        'transient': reason in TRANSIENT,
+        'status': status,
+        'content': content,
+        'content_type': content_type,
+        'elapsed': 0.0 if start is None else time.monotonic() - start
+    }
+
+def _read_body(client, response, start):
+    """
+    Private
+    Outputs (body bytes, reason) reading no more than the size and time limits
+    allow, and checking for the PDF magic as soon as enough has arrived
+    """
+    length = response.headers.get('Content-Length')
+    if length is not None and length.isdigit() and int(length) > client['maxbytes']:
+        return None, 'too large'
+    chunks = []
+    nbytes = 0
+    checked = False
+    for chunk in response.iter_content(CHUNKBYTES):
+        chunks += [chunk]
+        nbytes += len(chunk)
+        if nbytes > client['maxbytes']:
+            return None, 'too large'
+        if not checked and nbytes >= MAGIC_WITHIN:
+            if MAGIC not in b''.join(chunks)[:MAGIC_WITHIN]:
+                return None, 'not pdf'
+            checked = True
+    body = b''.join(chunks)
+    if MAGIC not in body[:MAGIC_WITHIN]:
+        return None, 'not pdf'
+    return body, 'ok'
+
+def _abort(response):
+    """
+    Private
+    shut down the connection of a response, so that a read blocked on it returns
+    at once (closing the response from another thread would wait for the read)
+    """
+    connection = getattr(response.raw, 'connection', None)
+    sock = getattr(connection, 'sock', None)
+    try:
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+        else:
+            response.close()
+    except OSError:
+        pass
+
+def fetch(client, url):
+    """
+    Public
+    Download url within the client's limits (but ignoring the domain limiter),
+    giving up if the client is stopped
+    Outputs dict of url, ok, reason ('ok', 'timeout', 'connection', 'server error',
+    'http <status>', 'not pdf', 'too large' or 'stopped'), transient (worth retrying
+    later), status, content (bytes if ok), content_type and elapsed seconds
+    """
+    start = time.monotonic()
+    stop = client['stop']
+    try:
+        with _session().get(url, allow_redirects=True, stream=True, timeout=client['timeout']) as response:
+            content_type = response.headers.get('Content-Type')
+            if response.status_code >= 500:
+                return _result(url, 'server error', response.status_code, None, content_type, start)
+            if response.status_code != 200:
+                return _result(url, f'http {response.status_code}', response.status_code, None, content_type, start)
+            if not is_pdf_type(content_type):
+                return _result(url, 'not pdf', response.status_code, None, content_type, start)
+            # a server dripping out bytes within the read timeout is cut off at
+            # maxseconds, and any download is cut off when the run is stopped
+            expired = threading.Event()
+            finished = threading.Event()
+            def watch():
+                while not finished.wait(POLL):
+                    if stop.is_set() or time.monotonic() - start > client['maxseconds']:
+                        expired.set()
+                        _abort(response)
+                        return
+            watchdog = threading.Thread(target=watch, daemon=True)
+            watchdog.start()
+            try:
+                body, reason = _read_body(client, response, start)
+            except Exception:
+                if not expired.is_set():
+                    raise
+                body, reason = None, 'timeout'
+            finally:
+                finished.set()
+            if expired.is_set():
+                body, reason = None, 'stopped' if stop.is_set() else 'timeout'
+            return _result(url, reason, response.status_code, body, content_type, start)
+    except requests.Timeout:
+        return _result(url, 'timeout', start=start)
+    except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError) as ex:
+        # a read timeout while streaming the body comes wrapped as a connection error
+        if isinstance(ex.args[0] if len(ex.args) > 0 else None, ReadTimeoutError):
+            return _result(url, 'timeout', start=start)
+        return _result(url, 'connection', start=start)
+    except requests.RequestException as ex:
+        return _result(url, f'error {type(ex).__name__}', start=start)
+
+def polite_fetch(client, url):
+    """
+    Public
+    fetch() within the per-domain limits, not starting if the client
+    is stopped by the time the domain limiter lets it go
+    """
+    domain = domain_of(url)
+    client['limiter'].acquire(domain)
+    try:
+        if client['stop'].is_set():
+            return _result(url, 'stopped')
+        return fetch(client, url)
+    finally:
+        client['limiter'].release(domain)
+
+def interleave(urls):
+    """
+    Public
+    urls reordered round-robin over their domains, so that the workers are
+    spread across hosts rather than queued on one
+    """
+    by_domain = dict()
+    for url in urls:
+        by_domain.setdefault(domain_of(url), []).append(url)
+    return [url for group in zip_longest(*by_domain.values()) for url in group if url is not None]
+
+def fetch_all(client, urls):
+    """
+    Public
+    Generator of polite_fetch() results for urls, in order of completion. At most
+    twice as many downloads as workers are in hand at once, so a slow consumer
+    holds back the downloads rather than letting them pile up in memory.
+    The generator ends as soon as the client is stopped; stopping the client or
+    closing the generator early cancels the queued downloads and cuts off those
+    under way, without waiting for them.
+    """
+    todo = iter(interleave(urls))
+    pending = set()
+    executor = ThreadPoolExecutor(max_workers=client['workers'])
+    try:
+        while not client['stop'].is_set():
+            while len(pending) < 2 * client['workers']:
+                url = next(todo, None)
+                if url is None:
+                    break
+                pending.add(executor.submit(polite_fetch, client, url))
+            if len(pending) == 0:
+                return
+            done, pending = wait(pending, timeout=POLL, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+    finally:
+        if len(pending) > 0:
+            client['stop'].set()
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,230 @@
+"""
+Local web server of awkward PDF links, for exercising downloader.py.
+
+Serves GET requests by path:
+
+/pdf/<name>     a small PDF
+/octet/<name>   a small PDF as application/octet-stream
+/junk/<name>    a small PDF after a few bytes of junk, with no Content-Type
+/html/<name>    an HTML page (a paywall, say)
+/fake/<name>    HTML claiming to be application/pdf
+/huge/<name>    a PDF larger than any sensible limit, with Content-Length
+/endless/<name> a PDF streamed without end or Content-Length
+/slow/<name>    a PDF after a pause longer than the read timeout
+/drip/<name>    a PDF dripped out a few bytes at a time, within the read timeout
+/error/<name>   HTTP 503
+anything else   HTTP 404
+
+Every request is logged with its host and start time, so that the self-check can
+see the per-domain delay was kept, and the self-check counts downloads in hand per
+domain (it uses both 'localhost' and '127.0.0.1' as domains). Finally it stops a
+client in the middle of dripped downloads, which must end at once.
+
+Run as a server:
+
+python3 ./scrape/downloader_stub.py 8090
+
+or run a self-check of downloader.py against it (nothing touches the database):
+
+python3 ./scrape/downloader_stub.py 8090 check
+
+"""
+
+import sys
+import time
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import downloader as dl
+
+# read command line
+try:
+	port = int(sys.argv[1]);			del sys.argv[1]
+except:
+	print("Usage:", sys.argv[0], "port [check]")
+	sys.exit(1)
+check = len(sys.argv) > 1 and sys.argv[1] == 'check'
+
+# simulated server behaviour
+DELAY = 0.2
+SLOW_DELAY = 5
+DRIP_BYTES = 64
+DRIP_DELAY = 0.05
+HUGE_BYTES = 200 * 1024 * 1024
+
+# limits for the self-check
+CHECK_TIMEOUT = (2, 2)
+CHECK_MAXSECONDS = 4
+CHECK_MAXBYTES = 1024 * 1024
+CHECK_DELAY = 0.3
+CHECK_PER_DOMAIN = 2
+CHECK_STOP = 1.0
+
+# a minimal one-page PDF
+PDF = b'%PDF-1.4\n' + \
+    b'1 0 obj << /Type /Catalog /Pages 2 0 R >> endobj\n' + \
+    b'2 0 obj << /Type /Pages /Kids [3 0 R] /Count 1 >> endobj\n' + \
+    b'3 0 obj << /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] >> endobj\n' + \
+    b'trailer << /Root 1 0 R >>\n' + \
+    b'%%EOF\n'
+HTML = b'<html><head><title>Access denied</title></head><body>' + b'Please log in. ' * 200 + b'</body></html>'
+
+##########################################################
+
+lock = threading.Lock()
+state = {'log': [], 'active': dict(), 'max_active': dict()}
+
+class CountingLimiter(dl.DomainLimiter):
+    """
+    domain limiter keeping count of the most downloads in hand at once per domain
+    """
+    def acquire(self, domain):
+        waited = super().acquire(domain)
+        with lock:
+            state['active'][domain] = state['active'].get(domain, 0) + 1
+            state['max_active'][domain] = max(state['max_active'].get(domain, 0), state['active'][domain])
+        return waited
+
+    def release(self, domain):
+        with lock:
+            state['active'][domain] -= 1
+        super().release(domain)
+
+class Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    def reply(self, status, body, content_type, length = True):
+        self.send_response(status)
+        if content_type is not None:
+            self.send_header('Content-Type', content_type)
+        if length:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        host = self.headers.get('Host', '').split(':')[0]
+        with lock:
+            state['log'].append((host, time.monotonic()))
+        try:
+            self.serve(self.path.split('/')[1])
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def serve(self, kind):
+        time.sleep(DELAY)
+        if kind == 'pdf':
+            self.reply(200, PDF, 'application/pdf')
+        elif kind == 'octet':
+            self.reply(200, PDF, 'application/octet-stream')
+        elif kind == 'junk':
+            self.reply(200, b'\r\n\r\n' + PDF, None)
+        elif kind == 'html':
+            self.reply(200, HTML, 'text/html; charset=utf-8')
+        elif kind == 'fake':
+            self.reply(200, HTML, 'application/pdf')
+        elif kind == 'huge':
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', str(HUGE_BYTES))
+            self.end_headers()
+            self.wfile.write(PDF)
+        elif kind == 'endless':
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            self.wfile.write(PDF)
+            while True:
+                self.wfile.write(b'0' * 65536)
+        elif kind == 'slow':
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', str(len(PDF)))
+            self.end_headers()
+            self.wfile.flush()
+            time.sleep(SLOW_DELAY)
+            self.wfile.write(PDF)
+        elif kind == 'drip':
+            body = PDF + b'0' * (4 * DRIP_BYTES * int(CHECK_MAXSECONDS / DRIP_DELAY))
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/pdf')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            for i in range(0, len(body), DRIP_BYTES):
+                self.wfile.write(body[i:(i + DRIP_BYTES)])
+                self.wfile.flush()
+                time.sleep(DRIP_DELAY)
+        elif kind == 'error':
+            self.reply(503, b'Service unavailable', 'text/plain')
+        else:
+            self.reply(404, b'Not found', 'text/plain')
+
+    def log_message(self, format, *args):
+        return
+
+##########################################################
+
+def self_check():
+    """
+    download every kind of response from two domains, and check the outcomes
+    and the per-domain limits
+    """
+    expected = {'pdf': 'ok', 'octet': 'ok', 'junk': 'ok', 'html': 'not pdf', 'fake': 'not pdf',
+                'huge': 'too large', 'endless': 'too large', 'slow': 'timeout', 'drip': 'timeout',
+                'error': 'server error', 'missing': 'http 404'}
+    urls = [f'http://{host}:{port}/{kind}/{i}' for host in ['localhost', '127.0.0.1']
+            for kind in expected for i in range(3 if kind == 'pdf' else 1)]
+    client = dl.make_downloader(workers=8, per_domain=CHECK_PER_DOMAIN, delay=CHECK_DELAY,
+                                timeout=CHECK_TIMEOUT, maxseconds=CHECK_MAXSECONDS,
+                                maxbytes=CHECK_MAXBYTES)
+    client['limiter'] = CountingLimiter(CHECK_PER_DOMAIN, CHECK_DELAY)
+    start = time.time()
+    results = list(dl.fetch_all(client, urls))
+    elapsed = time.time() - start
+    ok = len(results) == len(urls)
+    for r in sorted(results, key=lambda r: r['url']):
+        want = expected[r['url'].split('/')[3]]
+        good = r['reason'] == want and (not r['ok'] or r['content'].find(dl.MAGIC) >= 0)
+        ok = ok and good
+        print(f"{'ok' if good else 'WRONG'}: {r['url']} -> {r['reason']} (expected {want}), {r['elapsed']:.1f}s")
+    # per-domain limits
+    for host in ['localhost', '127.0.0.1']:
+        starts = sorted([t for h, t in state['log'] if h == host])
+        gap = min([b - a for a, b in zip(starts, starts[1:])])
+        polite = state['max_active'][f'{host}:{port}'] <= CHECK_PER_DOMAIN and gap >= CHECK_DELAY * 0.95
+        ok = ok and polite
+        print(f"{'ok' if polite else 'WRONG'}: {host} {len(starts)} requests, at most {state['max_active'][f'{host}:{port}']} "
+              f"at a time, at least {gap:.2f}s apart")
+    # stopping the client cuts off the downloads under way
+    client = dl.make_downloader(workers=4, per_domain=4, delay=0.0, maxseconds=60)
+    threading.Timer(CHECK_STOP, client['stop'].set).start()
+    start = time.time()
+    finished = list(dl.fetch_all(client, [f'http://localhost:{port}/drip/stop{i}' for i in range(8)]))
+    gap = time.time() - start - CHECK_STOP
+    good = gap < 3 * dl.POLL and len(finished) == 0
+    ok = ok and good
+    print(f"{'ok' if good else 'WRONG'}: 8 dripped downloads stopped {gap:.1f}s after the stop, {len(finished)} finished")
+    print(f"{'OK' if ok else 'FAILED'}: {len(results)} downloads in {elapsed:.1f}s")
+    return 0 if ok else 1
+
+def main():
+    server = ThreadingHTTPServer(('localhost', port), Handler)
+    server.daemon_threads = True
+    # clients hanging up on awkward responses is expected
+    server.handle_error = lambda request, client_address: None
+    if not check:
+        print(f'Downloader stub listening on port {port}')
+        server.serve_forever()
+        return 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    out = self_check()
+    server.shutdown()
+    return out
+
+##########################################################
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+# DONE
\ No newline at end of file
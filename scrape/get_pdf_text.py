@@ -1,6 +1,29 @@
 """
-Get unread pdf_links from 'links' table; attempt to download to tmp folder; extract text and
-update 'links' table; delete PDF.
+Get unread pdf_links from 'links' table; attempt to download; extract text and
+update 'links' table.
+
+Downloads run concurrently across domains (see downloader.py), at most MAXCALLS per
+minable domain, with per-host politeness limits, timeouts, a size limit and a check
+that what comes back is a PDF. Responses that are not PDFs (paywalls, error pages) or
+too large are flagged badlink, as a PDF that can't be read always was; timeouts and
+server errors are left to try again on the next run.
+
+Downloads feed a pool of text extraction processes, and updates are written in
+batches of WRITECHUNK as they come (see ingest_pipeline.py), so the network, the CPUs
+and the database are all kept busy at once. Ctrl-C stops the run cleanly, writing
+updates for the documents already read. Downloaded PDFs are read in memory (see
+pdf2txt.py) - only one larger than pdf2txt.SPILLBYTES goes to a temporary file in
+pdf_path, removed once read.
+
+Two-tier mode: with 'abstract', only the first pdf2txt.FIRSTPAGES pages of each PDF are
+read - enough for date, title and abstract - so that new documents can be scored and
+shown in the same run. pdftext of a longer document is left empty and its flag
+'donefulltext' 0, for a later, lower-priority 'fulltext' pass that fills pdftext and
+marks it for species detection again. The abstract pass keeps each such PDF in
+pdf_path/KEEPDIR, so the fulltext pass reads it from there rather than downloading it
+again; kept files are removed once their full text (or failure) is written. A PDF
+that has to be downloaded again (its file lost) is given up after MAXTRIES failed
+downloads. Flag and counter columns are added by process/migrate_fulltext.py.
 
 
 E.g.
@@ -10,24 +33,40 @@ pdfpath="data/tmp"
 
 python3 ./scrape/get_pdf_text.py $pgfile $pdfpath
 
+or, splitting sentences with a rule-based sentencizer rather than the full spaCy model
+(quicker, see pdf2txt_benchmark.py):
+
+python3 ./scrape/get_pdf_text.py $pgfile $pdfpath fast
+
+or in two tiers, title/abstract now and full text later:
+
+python3 ./scrape/get_pdf_text.py $pgfile $pdfpath fast abstract
+...
+python3 ./scrape/get_pdf_text.py $pgfile $pdfpath fast fulltext
+
 """
 
 import os, sys
-import re
-import requests
+import hashlib
 import pdf2txt
-from sqlalchemy import create_engine, update, select, bindparam
+import downloader as dl
+import ingest_pipeline as ip
+from sqlalchemy import create_engine, update, select, bindparam, case
 from sqlalchemy import Table, Column, String, Integer, MetaData
 from datetime import datetime
 
 # read command line
+usage = "pg_file pdf_path [fast] [abstract|fulltext]"
 try:
 	pgfile = sys.argv[1];			        del sys.argv[1]
 	pdfpath = sys.argv[1];			        del sys.argv[1]
 except:
-	print("Usage:", sys.argv[0], "pg_file pdf_path")
+	print("Usage:", sys.argv[0], usage)
 	sys.exit(1)
 
+# optional modes (see ingest_pipeline.py)
+fast, abstract, fulltext = ip.parse_modes(sys.argv, usage)
+
 # read Postgres parameters
 try:
 	exec(open(pgfile).read())
@@ -37,36 +76,12 @@ except:
 
 # parameters
 MAXCALLS = 100
-MAXFNAMESIZE = 128
-
-#  global constants - filename regex
-fn_patt = re.compile(" |=|\?|\:|/|\.")
+WRITECHUNK = 50
 
-# PDF download functions
-def download_path(url):
-    filename = fn_patt.sub('_', url)[-MAXFNAMESIZE:] + ".pdf"
-    return f'{pdfpath}/{filename}'
-
-def run_download(url):
-    """
-    return code:
-    0 success
-    -1 file already exists
-    -2 download failure
-    """
-    # set filename/path and check if it already exists
-    dp = download_path(url)
-    if os.path.exists(dp): 
-        return -1
-    # attempt to download pdf
-    try: 
-        download = requests.get(url, allow_redirects=True)
-    except:
-        return -2
-    # if successful, write pdf to disk
-    with open(dp, 'wb') as ptr:
-        ptr.write(download.content)
-    return 0
+# PDFs read in part are kept in this folder of pdf_path for the fulltext pass,
+# which gives up on one it has to download after MAXTRIES failures
+KEEPDIR = 'fulltext'
+MAXTRIES = 3
 
 # open connection to database  
 engine = create_engine(f"postgresql://{PGUSER}:{PGPASSWORD}@{PGHOST}:5432/{PGDATABASE}", echo=False)
@@ -88,152 +103,196 @@ links = Table('links', metadata_obj,
               Column('gottranslation', Integer),
               Column('donepdf', Integer),
               Column('donecrossref', Integer),
-              Column('datecheck', Integer)
+              Column('datecheck', Integer),
+              Column('donefulltext', Integer),
+              Column('fulltexttries', Integer)
              )
 domains = Table('domains', metadata_obj,
               Column('domain', String),
               Column('minable', Integer),
              )
 
-def main():
-    # initialise counters
-    totalcalls = 0
-    totalfiles = 0
-    totalgood = 0
-
-    # make NLP model/pipeline
-    nlp = pdf2txt.make_nlp_pipeline()
-
+def get_pdf_links():
+    """
+    dict pdf_link --> domain, of at most MAXCALLS unread links per minable domain -
+    or in fulltext mode, links read only in part
+    """
     # select minable domains
     domain_selecter = select(domains).\
         where(domains.c.minable == 1)
-
-    # get domains from database
     with engine.connect() as conn:
-        domain_set = conn.execute(domain_selecter)
-    # LOOP over domains 
+        domain_set = conn.execute(domain_selecter).all()
+    # get links for each domain
+    pdf_links = dict()
     for drow in domain_set:
-        thisdomain = drow.domain    
-        print(f'Domain {thisdomain} ...')
-        # initialise update list for this domain
-        update_list = []
-        # get links for this domain
-        link_selecter = select(links).\
+        link_selecter = select(links.c.pdf_link).\
             where(
-                links.c.domain.like(f'%{thisdomain}%'),
+                links.c.domain.like(f'%{drow.domain}%'),
                 links.c.badlink == 0,
-                links.c.donepdf == 0,
                 links.c.pdf_link != None
-            )
-        # LOOP over links for this domain
-        ncalls = 0
-        nfiles = 0
-        ngood = 0
+            ).\
+            limit(MAXCALLS)
+        if fulltext:
+            link_selecter = link_selecter.where(links.c.donepdf == 1, links.c.donefulltext == 0)
+        else:
+            link_selecter = link_selecter.where(links.c.donepdf == 0)
         with engine.connect() as conn:
-            link_set = conn.execute(link_selecter)
-        for lrow in link_set:
-            # check how many calls made to this domain
-            if ncalls >= MAXCALLS:
-                totalcalls += ncalls
-                totalfiles += nfiles
-                break
-            # download file
-            pdflink = lrow.pdf_link
-            infile = download_path(pdflink)
-            res = run_download(pdflink)
-            ncalls += 1
-            # skip if not got new file
-            if res < 0:
-                continue
-            nfiles += 1
-            # get text from file
-            try:
-                date = pdf2txt.parse_creation_date(infile)
-                title = pdf2txt.get_title(infile)
-                text_list = pdf2txt.get_text(nlp, infile)
-                if title == "":
-                    title = pdf2txt.guess_title(text_list)
-                abstract = pdf2txt.guess_abstract(text_list)
-                # verbose output
-                print(date)
-                print(title)
-                print('--->')
-                print(abstract)
-                print()
-                ngood += 1
-                # record updates
-                update_list += [{
-                    'pdflinkvalue': pdflink,
-                    'datevalue': date, 
-                    'titlevalue': title,
-                    'abstractvalue': abstract,
-                    'pdftextvalue': '\n'.join(text_list),
-                    # flags:
-                    'textflagvalue': 1,
-                    'scoreflagvalue': 0,
-                    'speciesflagvalue': 0,
-                    'transflagvalue': 0,
-                    'crflagvalue': 0,
-                    'dateflagvalue': 1,
-                    'pdfflagvalue': 1,
-                    'badlinkvalue': 0
-                }]
-            except:
-                update_list += [{
-                    'pdflinkvalue': pdflink,
-                    'datevalue': "", 
-                    'titlevalue': "",
-                    'abstractvalue': "",
-                    'pdftextvalue': "",
-                    # flags:
-                    'textflagvalue': 0,
-                    'scoreflagvalue': 0,
-                    'speciesflagvalue': 0,
-                    'transflagvalue': 0,
-                    'crflagvalue': 0,
-                    'dateflagvalue': 0,
-                    'pdfflagvalue': 1,
-                    'badlinkvalue': 1
-                }]
-        # END OF LOOP over links for this domain
-        print(f'{thisdomain}: {ngood} texts, {nfiles} files, {ncalls} rows')
-        totalcalls += ncalls
-        totalfiles += nfiles
-        totalgood += ngood
-
-        # skip to next domain if no output
-        if update_list == []:
-            continue
-    
-        # else make update instructions to capture data for this domain
-        updater = links.update().\
-                where(links.c.pdf_link == bindparam('pdflinkvalue')).\
-                values(
-                    date = bindparam('datevalue'), 
-                    title = bindparam('titlevalue'),
-                    abstract = bindparam('abstractvalue'),
-                    pdftext = bindparam('pdftextvalue'),
-                    # flags:
-                    gottext = bindparam('textflagvalue'),
-                    gotscore = bindparam('scoreflagvalue'),
-                    gotspecies = bindparam('speciesflagvalue'),
-                    gottranslation = bindparam('transflagvalue'),
-                    donepdf = bindparam('pdfflagvalue'),
-                    badlink = bindparam('badlinkvalue'),
-                    donecrossref = bindparam('crflagvalue'),
-                    datecheck = bindparam('dateflagvalue')
-                    )        
-        # ... and commit to remote table
-        with engine.connect() as conn:
-            conn.execute(updater, update_list)
-            conn.commit()
+            for lrow in conn.execute(link_selecter):
+                pdf_links.setdefault(lrow.pdf_link, drow.domain)
+    return pdf_links
+
+def keep_path(pdflink):
+    """
+    file for the PDF of pdflink between abstract and fulltext passes
+    """
+    return os.path.join(pdfpath, KEEPDIR, hashlib.sha256(pdflink.encode('utf-8')).hexdigest()[:32] + '.pdf')
+
+def keep(pdflink, content):
+    """
+    write PDF bytes to the keep folder, via a temp file so a broken run never
+    leaves a partial PDF
+    """
+    path = keep_path(pdflink)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(f'{path}.tmp', 'wb') as ptr:
+        ptr.write(content)
+    os.replace(f'{path}.tmp', path)
+
+def discard(pdflink):
+    """
+    remove a kept PDF, if any
+    """
+    if os.path.exists(keep_path(pdflink)):
+        os.remove(keep_path(pdflink))
+
+def downloads(client, pdf_links):
+    """
+    (download result less content, PDF bytes or None) as downloads complete -
+    in abstract mode keeping each PDF for the fulltext pass
+    """
+    results = dl.fetch_all(client, list(pdf_links))
+    try:
+        for result in results:
+            content = result.pop('content')
+            if abstract and content != None:
+                keep(result['url'], content)
+            yield result, content
+    finally:
+        results.close()
+
+def fulltext_documents(client, pdf_links):
+    """
+    (download result, kept PDF file) for the links whose PDF was kept by the
+    abstract pass, then as downloads() for the rest
+    """
+    missing = []
+    for pdflink in pdf_links:
+        if os.path.exists(keep_path(pdflink)):
+            yield {'url': pdflink, 'ok': True, 'reason': 'kept', 'transient': False}, keep_path(pdflink)
+        else:
+            missing += [pdflink]
+    yield from downloads(client, missing)
+
+def main():
+    # initialise counters
+    counts = dict()
+    reasons = dict()
+
+    # make downloader - the NLP pipeline is made in each extraction worker
+    client = dl.make_downloader()
+
+    # make update instructions - text (or flagged bad), and for the fulltext pass
+    updater = links.update().\
+            where(links.c.pdf_link == bindparam('pdflinkvalue')).\
+            values(
+                date = bindparam('datevalue'), 
+                title = bindparam('titlevalue'),
+                abstract = bindparam('abstractvalue'),
+                pdftext = bindparam('pdftextvalue'),
+                # flags:
+                gottext = bindparam('textflagvalue'),
+                gotscore = bindparam('scoreflagvalue'),
+                gotspecies = bindparam('speciesflagvalue'),
+                gottranslation = bindparam('transflagvalue'),
+                donepdf = bindparam('pdfflagvalue'),
+                badlink = bindparam('badlinkvalue'),
+                donecrossref = bindparam('crflagvalue'),
+                datecheck = bindparam('dateflagvalue'),
+                donefulltext = bindparam('fulltextflagvalue')
+                )
+    fulltext_updater = links.update().\
+            where(links.c.pdf_link == bindparam('pdflinkvalue')).\
+            values(
+                pdftext = bindparam('pdftextvalue'),
+                # flags:
+                gotspecies = bindparam('speciesflagvalue'),
+                donefulltext = 1
+                )
+    fulltext_done_updater = links.update().\
+            where(links.c.pdf_link == bindparam('pdflinkvalue')).\
+            values(donefulltext = 1)
+    fulltext_retry_updater = links.update().\
+            where(links.c.pdf_link == bindparam('pdflinkvalue')).\
+            values(
+                fulltexttries = links.c.fulltexttries + 1,
+                donefulltext = case((links.c.fulltexttries + 1 >= MAXTRIES, 1), else_ = 0)
+                )
+    statements = {
+        'text': updater,
+        'fulltext': fulltext_updater,
+        'fulltext_done': fulltext_done_updater,
+        'fulltext_retry': fulltext_retry_updater
+        }
+
+    # get links from database
+    pdf_links = get_pdf_links()
+    print(f'Reading {len(pdf_links)} PDFs ...')
+
+    def to_update(download, result, error):
+        """
+        (updater, update) for a download and what was extracted from it
+        """
+        pdflink = download['url']
+        reasons[download['reason']] = reasons.get(download['reason'], 0) + 1
+        domain_counts = counts.setdefault(pdf_links[pdflink], {'calls': 0, 'files': 0, 'good': 0})
+        domain_counts['calls'] += 1
+        if not download['ok']:
+            print(f"{pdflink}: {download['reason']}")
+            # timeouts etc - try next run, up to MAXTRIES times in fulltext mode
+            if download['transient']:
+                return ('fulltext_retry', {'pdflinkvalue': pdflink}) if fulltext else None
+            # not a PDF or too large - flag bad, or in fulltext mode keep the text
+            # already read from the first pages and don't try again
+            if fulltext:
+                return ('fulltext_done', {'pdflinkvalue': pdflink})
+            return ('text', ip.text_update({'pdflinkvalue': pdflink}, None))
+        domain_counts['files'] += 1
+        if result != None:
+            domain_counts['good'] += 1
+        return ip.to_update(pdflink, {'pdflinkvalue': pdflink}, result, error, fulltext)
+
+    def discard_done(updates):
+        """
+        remove kept PDFs no longer needed, once their updates are committed
+        """
+        for kind, u in updates:
+            if kind in ['fulltext', 'fulltext_done'] or (kind == 'text' and u['fulltextflagvalue'] == 1):
+                discard(u['pdflinkvalue'])
 
-        # clean up ...
-        os.system(f'rm {pdfpath}/*.pdf')
-    # END OF LOOP over domains 
+    # MAIN LOOP - downloads feed the extraction workers, updates are written in batches
+    sources = fulltext_documents(client, pdf_links) if fulltext else downloads(client, pdf_links)
+    stats = ip.run(sources, to_update, ip.make_writer(engine, statements, after = discard_done),
+                   fast = fast, max_pages = pdf2txt.FIRSTPAGES if abstract else None,
+                   spill_dir = pdfpath, batch_size = WRITECHUNK, stop = client['stop'])
 
-    # ... and report
-    print(f'Got {totalgood} texts from {totalfiles} files out of {totalcalls} rows')
+    # ... and report
+    for thisdomain, c in counts.items():
+        print(f"{thisdomain}: {c['good']} texts, {c['files']} files, {c['calls']} rows")
+    print('Downloads: ' + ', '.join([f'{n} {reason}' for reason, n in reasons.items()]))
+    print(ip.summary(stats))
+    totalgood = sum([c['good'] for c in counts.values()])
+    totalfiles = sum([c['files'] for c in counts.values()])
+    print(f'Got {totalgood} texts from {totalfiles} files out of {stats["read"]} rows')
     return 0
 
 #############################################################
@@ -0,0 +1,376 @@
+"""
+Package of routines running PDF ingest as a producer/consumer pipeline.
+
+    fetcher thread --> bounded queue --> process pool --> writer thread
+    (downloads,        (QUEUESIZE)      (WORKERS, NLP    (batches of
+     file reads)                         loaded once      BATCHSIZE)
+                                         per worker)
+
+The fetcher iterates over the documents given - pairs (key, document), document
+being PDF bytes, a file path, or None for something with nothing to extract (a failed
+download, say) - and hands them on through a bounded queue, so that a fetcher running
+ahead of extraction blocks rather than filling memory. The main thread submits
+documents to a pool of worker processes, each of which makes its NLP pipeline once,
+keeping no more than twice as many documents in the pool as there are workers. Each
+result is turned into a database update by the caller's to_update(), in the main
+process, and a writer thread drains the updates in batches through the caller's
+write(). So downloads, text extraction and database writes all overlap.
+
+For a quick first pass, run() can read only the first pages of each document (see
+pdf2txt.extract()), leaving the full text for a later pass: the ingest scripts keep
+track of this in the column 'donefulltext' of the links table (added by the migration
+process/migrate_fulltext.py).
+
+Ctrl-C stops the fetcher and cancels documents not yet started; documents already being
+extracted are finished, and their updates written, before run() returns. Worker
+processes ignore Ctrl-C and are shut down by the main process. Given the downloader's
+stop event, run() stops the downloads with it (see downloader.fetch_all()).
+
+Worker processes are forked, all of them before the fetcher and writer threads start,
+so that no lock held by another thread is copied into a worker. (A spawned worker would
+re-run the calling script's top-level code - command line, database connection.)
+
+The ingest scripts share the rest: their optional modes (parse_modes()), the updates
+made from what is extracted (to_update()), and a write() committing each batch of
+updates, grouped by kind, in one transaction (make_writer()). Each script supplies
+only its documents and the statements for each kind of update.
+
+E.g.
+
+import ingest_pipeline as ip
+
+def to_update(key, result, error):
+    ... dict for the updater, or None ...
+
+def write(updates):
+    with engine.connect() as conn:
+        conn.execute(updater, updates)
+        conn.commit()
+
+stats = ip.run(((path, path) for path in files), to_update, write, fast = True)
+print(ip.summary(stats))
+
+or, in an ingest script,
+
+fast, abstract, fulltext = ip.parse_modes(sys.argv, "pg_file pdf_path [fast] [abstract|fulltext]")
+...
+write = ip.make_writer(engine, {'text': updater, 'fulltext': fulltext_updater, 'fulltext_done': done_updater})
+stats = ip.run(files, lambda doi, result, error: ip.to_update(doi, {'doivalue': doi}, result, error, fulltext),
+               write, fast = fast, max_pages = pdf2txt.FIRSTPAGES if abstract else None)
+"""
+
+import os, sys
+import time
+import multiprocessing
+import queue
+import signal
+import threading
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import pdf2txt
+
+
+##############################################################
+# parameters
+
+WORKERS = max(1, (os.cpu_count() or 2) - 1)
+QUEUESIZE = 32
+BATCHSIZE = 50
+
+# seconds between checks for Ctrl-C or a stopped pipeline
+POLL = 0.5
+
+# end of queue marker
+_DONE = object()
+
+
+##############################################################
+# worker processes
+
+_nlp = None
+
+def _init_worker(fast):
+    """
+    Private
+    runs once in each worker process
+    """
+    global _nlp
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _nlp = pdf2txt.make_fast_pipeline() if fast else pdf2txt.make_nlp_pipeline()
+
+def _extract(document, spill_dir, max_pages):
+    """
+    Private
+    runs in a worker process
+    Outputs (pdf2txt.extract() result less page texts, None) or (None, error message)
+    """
+    try:
+        result = pdf2txt.extract(document, _nlp, spill_dir, max_pages)
+    except Exception as ex:
+        return None, f'{type(ex).__name__}: {ex}'
+    del result['pages']
+    return result, None
+
+
+##############################################################
+# fetcher and writer threads
+
+def _fetch(sources, inbox, stop, errors):
+    """
+    Private
+    put (key, document) pairs from sources on the inbox until done or stopped
+    """
+    try:
+        for item in sources:
+            while not stop.is_set():
+                try:
+                    inbox.put(item, timeout=POLL)
+                    break
+                except queue.Full:
+                    continue
+            if stop.is_set():
+                break
+    except Exception as ex:
+        errors += [ex]
+        stop.set()
+    finally:
+        if hasattr(sources, 'close'):
+            sources.close()
+    if not stop.is_set():
+        inbox.put(_DONE)
+
+def _write(outbox, write, batch_size, stats, stop, errors):
+    """
+    Private
+    drain updates from the outbox in batches until the end marker; after a failed
+    write the pipeline is stopped and the remaining updates dropped
+    """
+    batch = []
+    while True:
+        update = outbox.get()
+        if update is not _DONE:
+            batch += [update]
+        if len(errors) == 0 and batch != [] and (len(batch) >= batch_size or update is _DONE):
+            try:
+                write(batch)
+                stats['written'] += len(batch)
+            except Exception as ex:
+                errors += [ex]
+                stop.set()
+        if len(batch) >= batch_size or update is _DONE:
+            batch = []
+        if update is _DONE:
+            return
+
+
+##############################################################
+# pipeline
+
+def run(sources, to_update, write, fast = False, max_pages = None, workers = WORKERS,
+        spill_dir = None, queue_size = QUEUESIZE, batch_size = BATCHSIZE, stop = None):
+    """
+    Public
+    sources is an iterable of (key, document), document PDF bytes, a file path or None
+    to_update(key, result, error) is called in this process for each key, with result
+        as output by pdf2txt.extract() less page texts (None if document was None
+        or couldn't be read) and error a message if it couldn't be read
+        Outputs an update for write(), or None for nothing to write
+    write(updates) writes a list of updates
+    fast and max_pages choose the NLP pipeline and pages read, as in pdf2txt
+    stop is a threading.Event set when the run stops (Ctrl-C, failed write, or done),
+        by default a new one
+    Outputs dict of counts of documents read, extracted, failed, updates written,
+    whether interrupted, and seconds elapsed
+    """
+    stats = {'read': 0, 'extracted': 0, 'failed': 0, 'written': 0, 'interrupted': False, 'elapsed': 0.0}
+    errors = []
+    stop = threading.Event() if stop is None else stop
+    inbox = queue.Queue(maxsize=queue_size)
+    outbox = queue.Queue(maxsize=queue_size)
+    fetcher = threading.Thread(target=_fetch, args=(sources, inbox, stop, errors), daemon=True)
+    writer = threading.Thread(target=_write, args=(outbox, write, batch_size, stats, stop, errors))
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                   initializer=_init_worker, initargs=(fast,))
+    pending = dict()
+
+    def deliver(key, result, error):
+        update = to_update(key, result, error)
+        if update is not None:
+            outbox.put(update)
+
+    def collect(done):
+        for future in done:
+            key = pending.pop(future)
+            result, error = future.result()
+            stats['extracted' if error is None else 'failed'] += 1
+            deliver(key, result, error)
+
+    start = time.time()
+    # a first task forks all the workers, before any thread is started here
+    executor.submit(int)
+    fetcher.start()
+    writer.start()
+    try:
+        feeding = True
+        while (feeding or len(pending) > 0) and not stop.is_set():
+            # keep the pool busy, but no more than twice over
+            while feeding and len(pending) < 2 * workers:
+                try:
+                    item = inbox.get(block=len(pending) == 0, timeout=POLL)
+                except queue.Empty:
+                    break
+                if item is _DONE:
+                    feeding = False
+                    break
+                key, document = item
+                stats['read'] += 1
+                if document is None:
+                    deliver(key, None, None)
+                else:
+                    pending[executor.submit(_extract, document, spill_dir, max_pages)] = key
+            if len(pending) > 0:
+                done, _ = wait(list(pending), timeout=POLL, return_when=FIRST_COMPLETED)
+                collect(done)
+    except KeyboardInterrupt:
+        print('Interrupted: finishing documents being read and writing their updates ...')
+        stats['interrupted'] = True
+        stop.set()
+        for future in list(pending):
+            if future.cancel():
+                pending.pop(future)
+        collect(wait(list(pending)).done)
+    finally:
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+        outbox.put(_DONE)
+        writer.join()
+        fetcher.join(POLL)
+        stats['elapsed'] = time.time() - start
+    if len(errors) > 0:
+        raise errors[0]
+    return stats
+
+def summary(stats):
+    """
+    Public
+    Outputs string of run() stats
+    """
+    out = f"{stats['read']} documents, {stats['extracted']} read, {stats['failed']} unreadable, " + \
+        f"{stats['written']} updates written in {stats['elapsed']:.1f}s " + \
+        f"({stats['extracted']/max(stats['elapsed'], 1e-6):.2f} documents/sec)"
+    if stats['interrupted']:
+        out += ' - interrupted'
+    return out
+
+
+##############################################################
+# shared by the ingest scripts
+
+# optional modes - fast splits PDF text into sentences without the full spaCy model,
+# abstract reads only the first pages leaving the rest to a later fulltext pass
+MODES = ['full', 'fast', 'abstract', 'fulltext']
+
+def parse_modes(argv, usage):
+    """
+    Public
+    Outputs (fast, abstract, fulltext) from the modes left on the command line
+    argv, or prints usage and exits if they are not valid
+    """
+    modes = argv[1:]
+    if any([m not in MODES for m in modes]) or ('abstract' in modes and 'fulltext' in modes):
+        print("Usage:", argv[0], usage)
+        sys.exit(1)
+    return 'fast' in modes, 'abstract' in modes, 'fulltext' in modes
+
+def text_update(key, result, values = None):
+    """
+    Public
+    update for the text extracted from a PDF, or flagged bad if it couldn't be
+    read (result None), where key is a dict of the key bind parameter and values
+    a dict of any other values, overriding the defaults here
+    """
+    if result != None:
+        update = {
+            'datevalue': result['date'],
+            'titlevalue': result['title'],
+            'abstractvalue': result['abstract'],
+            'pdftextvalue': '\n'.join(result['text_list']) if result['complete'] else "",
+            # flags:
+            'textflagvalue': 1,
+            'scoreflagvalue': 0,
+            'speciesflagvalue': 0,
+            'transflagvalue': 0,
+            'crflagvalue': 0,
+            'dateflagvalue': 1,
+            'pdfflagvalue': 1,
+            'badlinkvalue': 0,
+            'fulltextflagvalue': 1 if result['complete'] else 0
+        }
+    else:
+        update = {
+            'datevalue': "",
+            'titlevalue': "",
+            'abstractvalue': "",
+            'pdftextvalue': "",
+            # flags:
+            'textflagvalue': 0,
+            'scoreflagvalue': 0,
+            'speciesflagvalue': 0,
+            'transflagvalue': 0,
+            'crflagvalue': 0,
+            'dateflagvalue': 0,
+            'pdfflagvalue': 1,
+            'badlinkvalue': 1,
+            'fulltextflagvalue': 1
+        }
+    update.update(values or dict())
+    update.update(key)
+    return update
+
+def fulltext_update(key, result):
+    """
+    Public
+    update for the full text of a PDF read in part before
+    """
+    return dict(key, pdftextvalue = '\n'.join(result['text_list']), speciesflagvalue = 0)
+
+def to_update(name, key, result, error, fulltext = False, values = None):
+    """
+    Public
+    (kind, update) for what run() extracted from the document name: kind 'text',
+    or in fulltext mode 'fulltext', or 'fulltext_done' if it couldn't be read -
+    printing what was found; key and values as for text_update()
+    """
+    if result == None:
+        print(f'{name}: {error}')
+        if fulltext:
+            return 'fulltext_done', key
+    elif fulltext:
+        print(f"{name}: {len(result['text_list'])} sentences from {result['npages']} pages")
+        return 'fulltext', fulltext_update(key, result)
+    else:
+        # verbose output
+        print(result['date'])
+        print(result['title'])
+        print('--->')
+        print(result['abstract'])
+        print()
+    return 'text', text_update(key, result, values)
+
+def make_writer(engine, statements, after = None):
+    """
+    Public
+    Outputs write() for run(), committing each batch of (kind, update) in one
+    transaction, kind being a key of the dict statements of SQLAlchemy
+    statements, and then calling after(batch) if given
+    """
+    def write(updates):
+        with engine.connect() as conn:
+            for kind, statement in statements.items():
+                update_list = [u for k, u in updates if k == kind]
+                if update_list != []:
+                    conn.execute(statement, update_list)
+            conn.commit()
+        if after != None:
+            after(updates)
+    return write
@@ -1,12 +1,26 @@
 """
 Package of routines for PDF text extraction
+
+A document is either the PDF bytes (as downloaded) or the path of a PDF file. Bytes
+are opened in memory with fitz.open(stream=...), except above SPILLBYTES, when they
+are written to a temporary file first (in spill_dir if given) and removed again
+afterwards - so nothing is left behind on disk whatever happens to the run.
+
+E.g.
+
+nlp = pdf2txt.make_nlp_pipeline()           # ... or make_fast_pipeline()
+result = pdf2txt.extract(pdf_bytes, nlp)    # ... or a file path
+print(result['title'], result['abstract'])
 """
 
+import os
 import spacy
 import re
 import fitz
+import tempfile
+from contextlib import contextmanager
 from spacy.matcher import Matcher                                                                                                
-from spacypdfreader import pdf_reader
+from spacy.tokens import Doc
                                                               
 
 ##############################################################
@@ -14,6 +28,12 @@ from spacypdfreader import pdf_reader
 
 ABSTRACT_COUNT = 15
 
+# pages read for title and abstract only (see extract())
+FIRSTPAGES = 3
+
+# PDFs larger than this are parsed from a temporary file rather than in memory
+SPILLBYTES = 32 * 1024 * 1024
+
 # regex to filter out stuff we're not interested in
 # used in is_good_chunk() below
 filter_string = "^Copyright:|" + \
@@ -76,25 +96,52 @@ def guess_title(text_list):
 ##############################################################
 # fitz-dependent functions
 
-def parse_creation_date(filepath):
+@contextmanager
+def open_pdf(document, spill_dir = None):
     """
     Public
+    document is PDF bytes or a file path
+    Yields the fitz document, spilling bytes over SPILLBYTES to a temporary file
     """
-    pdf_doc = fitz.open(filepath)
-    date = pdf_doc.metadata['creationDate']
+    if not isinstance(document, (bytes, bytearray)):
+        with fitz.open(document) as pdf_doc:
+            yield pdf_doc
+    elif len(document) <= SPILLBYTES:
+        with fitz.open(stream=document, filetype='pdf') as pdf_doc:
+            yield pdf_doc
+    else:
+        with tempfile.TemporaryDirectory(dir=spill_dir) as tmpdir:
+            filepath = os.path.join(tmpdir, 'document.pdf')
+            with open(filepath, 'wb') as ptr:
+                ptr.write(document)
+            with fitz.open(filepath) as pdf_doc:
+                yield pdf_doc
+
+def _creation_date(metadata):
+    """
+    Private
+    yyyy-mm-dd from the metadata creation date D:yyyymmdd...
+    """
+    date = metadata['creationDate']
     return f'{date[2:6]}-{date[6:8]}-{date[8:10]}'
 
-def get_title(filepath):
+def _title_candidates(metadata, toc):
     """
-    Public
+    Private
+    Outputs dict of the formal (metadata) title and the first table of contents entry
     """
-    pdf_doc = fitz.open(filepath)
-    formal_title = ""
-    guess_title = ""
-    if 'title' in pdf_doc.metadata:
-        formal_title = pdf_doc.metadata['title']
-    if len(pdf_doc.get_toc()) > 0:
-        guess_title = pdf_doc.get_toc()[0][1]
+    return {
+        'metadata': metadata.get('title') or "",
+        'toc': toc[0][1] if len(toc) > 0 else ""
+    }
+
+def _choose_title(candidates):
+    """
+    Private
+    the formal title unless the table of contents offers a longer one
+    """
+    formal_title = candidates['metadata']
+    guess_title = candidates['toc']
     if formal_title.lower() == guess_title.lower():
         title = formal_title
     elif len(formal_title) > len(guess_title):
@@ -103,6 +150,28 @@ def get_title(filepath):
         title = guess_title
     return title
 
+def parse_creation_date(document, spill_dir = None):
+    """
+    Public
+    """
+    with open_pdf(document, spill_dir) as pdf_doc:
+        return _creation_date(pdf_doc.metadata)
+
+def get_title(document, spill_dir = None):
+    """
+    Public
+    """
+    with open_pdf(document, spill_dir) as pdf_doc:
+        return _choose_title(_title_candidates(pdf_doc.metadata, pdf_doc.get_toc()))
+
+def get_page_texts(document, spill_dir = None):
+    """
+    Public
+    Outputs list of text of each page
+    """
+    with open_pdf(document, spill_dir) as pdf_doc:
+        return [page.get_text() for page in pdf_doc]
+
 
 ##############################################################
 # spacy-dependent functions
@@ -116,6 +185,16 @@ def make_nlp_pipeline(model = 'en_core_web_md'):
     nlp.add_pipe('sentencizer')
     return nlp
 
+def make_fast_pipeline():
+    """
+    Public
+    Blank English tokenizer and rule-based sentencizer only - sentence boundaries
+    are all get_text() uses, so this skips tagging and parsing every page
+    """
+    nlp = spacy.blank('en')
+    nlp.add_pipe('sentencizer')
+    return nlp
+
 def _make_sentence_list(nlp_doc):
     """
     Private
@@ -127,14 +206,12 @@ def _make_sentence_list(nlp_doc):
     groups = [s.split('\n\n') for s in sent2]
     return [s.replace('\n', ' ') for s in sum(groups, []) if _is_good_chunk(s)]
 
-def get_text(nlp, filepath):
+def locate_abstract(text):
     """
     Public
-    nlp as output by make_nlp_pipeline()
+    text is a list of sentences
+    Outputs the list from the start of the abstract if found, else all of it
     """
-    doc = pdf_reader(filepath, nlp)
-    text = _make_sentence_list(doc)
-    # so far so good - now locate start of the abstract
     idx = -1
     for i in range(len(text)):
         x = text[i]
@@ -146,4 +223,65 @@ def get_text(nlp, filepath):
     # if successful, start from here
     if idx >= 0:
         text = [init.capitalize()] + text[(idx+1):]
-    return text
\ No newline at end of file
+    return text
+
+def _sentences(nlp, page_texts):
+    """
+    Private
+    Outputs list of sentence strings, each page run through nlp separately and
+    the pages joined (as spacypdfreader does), starting from the abstract if found
+    """
+    doc = Doc.from_docs(list(nlp.pipe(page_texts)))
+    return locate_abstract(_make_sentence_list(doc))
+
+def get_text(nlp, document, spill_dir = None):
+    """
+    Public
+    nlp as output by make_nlp_pipeline() or make_fast_pipeline()
+    """
+    return _sentences(nlp, get_page_texts(document, spill_dir))
+
+
+##############################################################
+# single-pass ingest
+
+def extract(document, nlp, spill_dir = None, max_pages = None):
+    """
+    Public
+    document is PDF bytes or a file path, nlp as output by make_nlp_pipeline()
+    or make_fast_pipeline()
+    The PDF is opened and parsed once for everything. With max_pages (e.g.
+    FIRSTPAGES) only that many pages are read - enough for title and abstract.
+    Outputs dict of
+        date             metadata creation date yyyy-mm-dd
+        title_candidates dict of metadata, toc (first contents entry) and text
+                         (first sentences) titles
+        title            the formal or contents title, else the text title
+        pages            list of page texts
+        text_list        list of sentences, as output by get_text()
+        abstract         first sentences from the abstract on, if found
+        npages           number of pages in the document
+        complete         True if all pages were read
+    """
+    with open_pdf(document, spill_dir) as pdf_doc:
+        metadata = pdf_doc.metadata
+        toc = pdf_doc.get_toc()
+        npages = pdf_doc.page_count
+        nread = npages if max_pages is None else min(npages, max_pages)
+        pages = [pdf_doc[i].get_text() for i in range(nread)]
+    text_list = _sentences(nlp, pages)
+    candidates = _title_candidates(metadata, toc)
+    candidates['text'] = guess_title(text_list)
+    title = _choose_title(candidates)
+    if title == "":
+        title = candidates['text']
+    return {
+        'date': _creation_date(metadata),
+        'title_candidates': candidates,
+        'title': title,
+        'pages': pages,
+        'text_list': text_list,
+        'abstract': guess_abstract(text_list),
+        'npages': npages,
+        'complete': nread == npages
+    }
@@ -0,0 +1,170 @@
+"""
+Speed and output benchmark of the PDF text extraction paths in pdf2txt.py, on a
+sample of the PDF files in a folder (e.g. the Wiley PDFs).
+
+Three paths are run over the same files:
+
+legacy  spacypdfreader (pdfminer page text) with the full spaCy model, as used
+        before extraction moved to pdf2txt.extract()
+full    pdf2txt.extract() with make_nlp_pipeline() - fitz page text, full model
+fast    pdf2txt.extract() with make_fast_pipeline() - fitz page text, blank English
+        tokenizer and rule-based sentencizer
+
+Reports documents and pages per second for each, and how far the fast and full outputs
+differ from each other and from legacy: identical titles and abstracts, and the mean
+similarity of abstracts (by words) and of sentence lists. If a report file is given,
+the abstract and sentence list diffs of every document are written to it. Nothing
+touches the database.
+
+E.g.
+
+pdfpath="/Volumes/blitshare/data/wiley/pdf"
+
+python3 ./scrape/pdf2txt_benchmark.py $pdfpath 50 pdf2txt_diff.txt
+
+"""
+
+import sys
+import time
+import random
+import difflib
+from os import listdir
+from os.path import isfile, join
+from spacypdfreader import pdf_reader
+import pdf2txt
+
+# read command line
+try:
+	pdfpath = sys.argv[1];			    del sys.argv[1]
+except:
+	print("Usage:", sys.argv[0], "pdf_path [n [report_file]]")
+	sys.exit(1)
+
+# optional sample size and report file
+try:
+	NSAMPLE = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+	reportfile = sys.argv[2] if len(sys.argv) > 2 else None
+except:
+	print("Usage:", sys.argv[0], "pdf_path [n [report_file]]")
+	sys.exit(1)
+
+SEED = 42
+PATHS = ['legacy', 'full', 'fast']
+
+##########################################################
+
+def legacy_extract(filepath, nlp):
+    """
+    the extraction previously used by the ingest scripts
+    """
+    text_list = pdf2txt.locate_abstract(pdf2txt._make_sentence_list(pdf_reader(filepath, nlp)))
+    title = pdf2txt.get_title(filepath)
+    if title == "":
+        title = pdf2txt.guess_title(text_list)
+    return {
+        'title': title,
+        'abstract': pdf2txt.guess_abstract(text_list),
+        'text_list': text_list
+    }
+
+def similarity(a, b):
+    """
+    difflib ratio of two lists
+    """
+    if a == [] and b == []:
+        return 1.0
+    return difflib.SequenceMatcher(None, a, b, autojunk=False).ratio()
+
+def compare(outputs, a, b):
+    """
+    dict of counts and mean similarities of path b against path a, over
+    the documents both read
+    """
+    both = [x for x in outputs if x[a] is not None and x[b] is not None]
+    n = max(len(both), 1)
+    return {
+        'n': len(both),
+        'title': sum([x[a]['title'] == x[b]['title'] for x in both]),
+        'abstract': sum([x[a]['abstract'] == x[b]['abstract'] for x in both]),
+        'abstract_sim': sum([similarity(x[a]['abstract'].split(), x[b]['abstract'].split()) for x in both]) / n,
+        'sentence_sim': sum([similarity(x[a]['text_list'], x[b]['text_list']) for x in both]) / n,
+        'sentences': (sum([len(x[a]['text_list']) for x in both]) / n, sum([len(x[b]['text_list']) for x in both]) / n)
+    }
+
+def write_report(outputs):
+    """
+    abstract and sentence list diffs of fast against full and full against legacy
+    """
+    with open(reportfile, 'w') as ptr:
+        for x in outputs:
+            ptr.write(f"##### {x['file']}\n")
+            for a, b in [('legacy', 'full'), ('full', 'fast')]:
+                if x[a] is None or x[b] is None:
+                    ptr.write(f'{a} / {b}: not read\n')
+                    continue
+                for field in ['title', 'abstract']:
+                    if x[a][field] != x[b][field]:
+                        ptr.write(f'{field} ({a}): {x[a][field]}\n{field} ({b}): {x[b][field]}\n')
+                ptr.writelines([line + '\n' for line in difflib.unified_diff(
+                    x[a]['text_list'], x[b]['text_list'], fromfile=a, tofile=b, lineterm='', n=0)])
+            ptr.write('\n')
+
+def main():
+    # sample of PDF files
+    filelist = sorted([f for f in listdir(pdfpath) if isfile(join(pdfpath, f)) and f.lower().endswith('.pdf')])
+    random.seed(SEED)
+    filelist = random.sample(filelist, min(NSAMPLE, len(filelist)))
+    print(f'Extracting text from {len(filelist)} PDFs')
+
+    # pipelines
+    full_nlp = pdf2txt.make_nlp_pipeline()
+    fast_nlp = pdf2txt.make_fast_pipeline()
+
+    # run each path over each file
+    outputs = []
+    times = {p: 0.0 for p in PATHS}
+    failed = {p: 0 for p in PATHS}
+    npages = 0
+    for file in filelist:
+        filepath = join(pdfpath, file)
+        with open(filepath, 'rb') as ptr:
+            content = ptr.read()
+        out = {'file': file}
+        for p in PATHS:
+            start = time.time()
+            try:
+                if p == 'legacy':
+                    out[p] = legacy_extract(filepath, full_nlp)
+                else:
+                    out[p] = pdf2txt.extract(content, fast_nlp if p == 'fast' else full_nlp)
+            except Exception as ex:
+                print(f'{file}: {p} failed ({ex})')
+                out[p] = None
+                failed[p] += 1
+            times[p] += time.time() - start
+        if out['full'] is not None:
+            npages += len(out['full']['pages'])
+        outputs += [out]
+
+    # report speed ...
+    for p in PATHS:
+        t = max(times[p], 1e-6)
+        print(f'{p}: {len(filelist)/t:.2f} docs/sec, {npages/t:.1f} pages/sec, {failed[p]} failed')
+    print(f"fast is {times['full']/max(times['fast'], 1e-6):.1f}x full, {times['legacy']/max(times['fast'], 1e-6):.1f}x legacy")
+    # ... and differences
+    for a, b in [('legacy', 'full'), ('legacy', 'fast'), ('full', 'fast')]:
+        c = compare(outputs, a, b)
+        print(f"{b} vs {a} over {c['n']} docs: identical titles {c['title']}, abstracts {c['abstract']}; "
+              f"abstract similarity {c['abstract_sim']:.3f}, sentence list similarity {c['sentence_sim']:.3f}; "
+              f"sentences per doc {c['sentences'][0]:.1f} / {c['sentences'][1]:.1f}")
+    if reportfile is not None:
+        write_report(outputs)
+        print(f'Diffs written to {reportfile}')
+    return 0
+
+##########################################################
+
+if __name__ == '__main__':
+    main()
+
+# DONE
\ No newline at end of file
@@ -1,6 +1,13 @@
 """
 Processses manually uploaded PDF files  adds relevant details to the database.
 
+Text is extracted by a pool of worker processes and inserts written in batches as
+they come (see ingest_pipeline.py). Each file is moved to the out-tray once read.
+
+Two-tier mode: with 'abstract', only the first pdf2txt.FIRSTPAGES pages of each PDF are
+read, for date, title and abstract; the full text of longer documents is left to a
+later 'fulltext' pass, which reads them again from the out-tray (see get_pdf_text.py).
+
 E.g.
 
 pgfile="/Volumes/blitshare/pg/param.txt"
@@ -11,11 +18,23 @@ wwwpath="webapp/www/upload"
 open -g $AZURE_VOLUME
 python3 ./scrape/read_pdf_uploads.py $pgfile $pdfpath $wwwpath
 
+or, splitting sentences with a rule-based sentencizer rather than the full spaCy model
+(quicker, see pdf2txt_benchmark.py):
+
+python3 ./scrape/read_pdf_uploads.py $pgfile $pdfpath $wwwpath fast
+
+or in two tiers, title/abstract now and full text later:
+
+python3 ./scrape/read_pdf_uploads.py $pgfile $pdfpath $wwwpath fast abstract
+...
+python3 ./scrape/read_pdf_uploads.py $pgfile $pdfpath $wwwpath fast fulltext
+
 """
 
 import os, sys
 import re
 import pdf2txt
+import ingest_pipeline as ip
 from os import listdir
 from os.path import isfile, join
 from datetime import datetime
@@ -23,14 +42,18 @@ from sqlalchemy import create_engine, select, update, insert, bindparam
 from sqlalchemy import Table, Column, String, Integer, MetaData
 
 # read command line
+usage = "pg_file pdf_path www_path [fast] [abstract|fulltext]"
 try:
 	pgfile = sys.argv[1];			        del sys.argv[1]
 	pdfpath = sys.argv[1];			        del sys.argv[1]
 	wwwpath = sys.argv[1];			        del sys.argv[1]
 except:
-	print("Usage:", sys.argv[0], "pg_file pdf_path")
+	print("Usage:", sys.argv[0], usage)
 	sys.exit(1)
 
+# optional modes (see ingest_pipeline.py)
+fast, abstract, fulltext = ip.parse_modes(sys.argv, usage)
+
 # read Postgres parameters
 try:
 	exec(open(pgfile).read())
@@ -71,7 +94,8 @@ links = Table('links', metadata_obj,
               Column('gottranslation', Integer),
               Column('donepdf', Integer),
               Column('donecrossref', Integer),
-              Column('datecheck', Integer)
+              Column('datecheck', Integer),
+              Column('donefulltext', Integer)
              )
 
 # find files to process
@@ -92,24 +116,10 @@ def get_local_list():
         local_list += [row.link.lstrip("upload/")]
     return local_list
 
-def main():
-    # check we have files to process
-    if len(filelist) == 0:
-        print('No uploads found')
-        return 0
-
-    # otherwise proceed - get filenames already in the database
-    local_list = get_local_list()   
-
-    # set NLP pipeline
-    nlp = pdf2txt.make_nlp_pipeline()
-
-    # initialise for main loop
-    update_list = []
-    nfiles = 0
-    ngood = 0
-
-    # main loop
+def upload_files(local_list, counts):
+    """
+    (file name, file path) of new uploads, at most MAXFILES
+    """
     for file in filelist:
         # check next file
         if file in local_list:
@@ -117,67 +127,43 @@ def main():
         infile = join(pdfpath, file)
         if not isfile(infile):
             continue
-
         # check file limit
-        if nfiles >= MAXFILES:
+        if counts['files'] >= MAXFILES:
             break
-        else:
-            # set outfile locations
-            wwwfile = join(wwwpath, file)
-            outfile = join(outpath, file)
-            print(f'Processing {infile}')
-            nfiles += 1
-        # proceed to file content/metadata
-        try:
-            link = 'upload/' + file
-            date = pdf2txt.parse_creation_date(infile)
-            title = pdf2txt.get_title(infile)
-            text_list = pdf2txt.get_text(nlp, infile)
-            if title == "":
-                title = pdf2txt.guess_title(text_list)
-            abstract = pdf2txt.guess_abstract(text_list)
-            # verbose output
-            print(date)
-            print(link)
-            print('--->')
-            print(abstract)
-            print()
-            # record updates
-            update_list += [{
-                'linkvalue': link,
-                'datevalue': date, 
-                'titlevalue': title,
-                'abstractvalue': abstract,
-                'pdftextvalue': '\n'.join(text_list),
-                'qdatevalue': today,
-                'stermvalue': "file_upload",
-                'domainvalue': "local",
-                'langvalue': '',
-                # flags:
-                'textflagvalue': 1,
-                'scoreflagvalue': 0,
-                'speciesflagvalue': 0,
-                'transflagvalue': 1,
-                'crflagvalue': 0,
-                'dateflagvalue': 1,
-                'pdfflagvalue': 1,
-                'badlinkvalue': 0
-            }]
-            ngood += 1
-        except:
-            print(f'Broken file {infile}') 
-        # move file to out-tray
-        res1 = os.system(f'cp {infile} {wwwfile}')
-        res2 = os.system(f'mv {infile} {outfile}')
-        res3 = os.system(f'chmod 644 {wwwpath}/*')
-    # END OF main loop
+        print(f'Processing {infile}')
+        counts['files'] += 1
+        yield file, infile
+
+def partial_files(counts):
+    """
+    (link, file path in the out-tray) of uploads read only in part, at most MAXFILES
+    """
+    selecter = select(links.c.link).\
+        where(
+            links.c.domain == 'local',
+            links.c.donefulltext == 0
+            ).\
+        limit(MAXFILES)
+    with engine.connect() as conn:
+        rows = conn.execute(selecter).all()
+    for row in rows:
+        infile = join(outpath, row.link[len('upload/'):])
+        if not isfile(infile):
+            continue
+        print(f'Processing {infile}')
+        counts['files'] += 1
+        yield row.link, infile
 
-    # quit if no output
-    if update_list == []:
-        print(f'Got text from {ngood} out of {nfiles} files')
+def main():
+    # check we have files to process
+    if len(filelist) == 0 and not fulltext:
+        print('No uploads found')
         return 0
-        
-    # make update instructions 
+
+    # otherwise proceed - get filenames already in the database
+    local_list = get_local_list()   
+
+    # make insert instructions 
     updater = links.insert().\
         values(
             link = bindparam('linkvalue'),
@@ -197,15 +183,67 @@ def main():
             donepdf = bindparam('pdfflagvalue'),
             badlink = bindparam('badlinkvalue'),
             donecrossref = bindparam('crflagvalue'),
-            datecheck = bindparam('dateflagvalue')
+            datecheck = bindparam('dateflagvalue'),
+            donefulltext = bindparam('fulltextflagvalue')
             )
-        
-    # ... and commit to remote table
-    with engine.connect() as conn:
-        conn.execute(updater, update_list)
-        conn.commit()
-    # report
-    print(f'Got text from {ngood} out of {nfiles} files')
+    fulltext_updater = links.update().\
+        where(links.c.link == bindparam('linkvalue')).\
+        values(
+            pdftext = bindparam('pdftextvalue'),
+            # flags:
+            gotspecies = bindparam('speciesflagvalue'),
+            donefulltext = 1
+            )
+    fulltext_done_updater = links.update().\
+        where(links.c.link == bindparam('linkvalue')).\
+        values(donefulltext = 1)
+    statements = {
+        'text': updater,
+        'fulltext': fulltext_updater,
+        'fulltext_done': fulltext_done_updater
+        }
+
+    counts = {'files': 0, 'good': 0}
+
+    def to_fulltext_update(link, result, error):
+        if result != None:
+            counts['good'] += 1
+        return ip.to_update(link, {'linkvalue': link}, result, error, fulltext = True)
+
+    def to_update(file, result, error):
+        infile = join(pdfpath, file)
+        update = None
+        if result == None:
+            print(f'Broken file {infile}') 
+        else:
+            counts['good'] += 1
+            link = 'upload/' + file
+            update = ip.to_update(link, {'linkvalue': link}, result, error, values = {
+                'qdatevalue': today,
+                'stermvalue': "file_upload",
+                'domainvalue': "local",
+                'langvalue': '',
+                'transflagvalue': 1
+            })
+        # move file to out-tray
+        wwwfile = join(wwwpath, file)
+        outfile = join(outpath, file)
+        res1 = os.system(f'cp {infile} {wwwfile}')
+        res2 = os.system(f'mv {infile} {outfile}')
+        res3 = os.system(f'chmod 644 {wwwpath}/*')
+        return update
+
+    # main loop - files are read by a pool of extraction workers, inserts written in batches
+    write = ip.make_writer(engine, statements)
+    if fulltext:
+        stats = ip.run(partial_files(counts), to_fulltext_update, write, fast = fast)
+    else:
+        stats = ip.run(upload_files(local_list, counts), to_update, write, fast = fast,
+                       max_pages = pdf2txt.FIRSTPAGES if abstract else None)
+
+    # report
+    print(ip.summary(stats))
+    print(f"Got text from {counts['good']} out of {counts['files']} files")
     return 0
 
 #############################################################
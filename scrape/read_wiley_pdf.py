@@ -2,6 +2,13 @@
 Get DOIs of unread ConBio PDFs from 'links' table; check Wiley path for corresponding PDFs; extract text and
 update 'links' table.
 
+Text is extracted by a pool of worker processes and updates written in batches as
+they come (see ingest_pipeline.py).
+
+Two-tier mode: with 'abstract', only the first pdf2txt.FIRSTPAGES pages of each PDF are
+read, for date, title and abstract; the full text of longer documents is left to a
+later 'fulltext' pass (see get_pdf_text.py).
+
 E.g.
 
 pgfile="/Volumes/blitshare/pg/param.txt"
@@ -11,24 +18,40 @@ open -g $AZURE_VOLUME
 python3 ./scrape/read_wiley_pdf.py $pgfile $pdfpath
 python3 ./read_wiley_pdf.py $pgfile $pdfpath
 
+or, splitting sentences with a rule-based sentencizer rather than the full spaCy model
+(quicker, see pdf2txt_benchmark.py):
+
+python3 ./read_wiley_pdf.py $pgfile $pdfpath fast
+
+or in two tiers, title/abstract now and full text later:
+
+python3 ./read_wiley_pdf.py $pgfile $pdfpath fast abstract
+...
+python3 ./read_wiley_pdf.py $pgfile $pdfpath fast fulltext
+
 """
 
 import os, sys
 import re
 import pdf2txt
+import ingest_pipeline as ip
 from os.path import isfile
 from datetime import datetime
 from sqlalchemy import create_engine, update, select, bindparam
 from sqlalchemy import Table, Column, String, Integer, MetaData
 
 # read command line
+usage = "pg_file pdf_path [fast] [abstract|fulltext]"
 try:
 	pgfile = sys.argv[1];			        del sys.argv[1]
 	pdfpath = sys.argv[1];			        del sys.argv[1]
 except:
-	print("Usage:", sys.argv[0], "pg_file pdf_path")
+	print("Usage:", sys.argv[0], usage)
 	sys.exit(1)
 
+# optional modes (see ingest_pipeline.py)
+fast, abstract, fulltext = ip.parse_modes(sys.argv, usage)
+
 # read Postgres parameters
 try:
 	exec(open(pgfile).read())
@@ -65,103 +88,42 @@ links = Table('links', metadata_obj,
               Column('gottranslation', Integer),
               Column('donepdf', Integer),
               Column('donecrossref', Integer),
-              Column('datecheck', Integer)
+              Column('datecheck', Integer),
+              Column('donefulltext', Integer)
              )
 
 def doi_pdfname(doi):
     return re.sub('/','_', doi) + ".pdf"
 
+def wiley_files(rows, counts):
+    """
+    (doi, file path) of the PDFs found for rows, at most MAXFILES
+    """
+    for row in rows:
+        counts['rows'] += 1
+        # find file
+        infile = pdfpath + '/' + doi_pdfname(row.doi)
+        if not os.path.isfile(infile):
+            continue
+        # check file limit
+        if counts['files'] >= MAXFILES:
+            break
+        counts['files'] += 1
+        yield row.doi, infile
+
 def main():
-    # nlp pipeline
-    nlp = pdf2txt.make_nlp_pipeline()
-    # create text update list 
-    update_list = []
-    # select relevant records
+    # select relevant records - unread, or in fulltext mode read only in part
     selecter = select(links).\
         where(
             links.c.domain.like('conbio.onlinelibrary.wiley%'),
-            links.c.donepdf == 0,
             links.c.badlink == 0
             )
+    if fulltext:
+        selecter = selecter.where(links.c.donepdf == 1, links.c.donefulltext == 0)
+    else:
+        selecter = selecter.where(links.c.donepdf == 0)
     with engine.connect() as conn:
-        result = conn.execute(selecter)
-    
-    # process results
-    nrows = 0
-    nfiles = 0
-    ngood = 0
-    # MAIN LOOP
-    for row in result:
-        nrows += 1
-        # find file
-        infile = pdfpath + '/' + doi_pdfname(row.doi)
-        check = os.path.isfile(infile)
-        if not check:
-            continue
-        nfiles += 1
-        # check file limit
-        if nfiles > MAXFILES:
-            break
-        # proceed to file content/metadata
-        try:
-            date = pdf2txt.parse_creation_date(infile)
-            title = pdf2txt.get_title(infile)
-            text_list = pdf2txt.get_text(nlp, infile)
-            if title == "":
-                title = pdf2txt.guess_title(text_list)
-            abstract = pdf2txt.guess_abstract(text_list)
-            # verbose output
-            print(date)
-            print(title)
-            print('--->')
-            print(abstract)
-            print()
-            ngood += 1
-            # record updates
-            update_list += [{
-                'doivalue': row.doi,
-                'datevalue': date, 
-                'titlevalue': title,
-                'abstractvalue': abstract,
-                'pdftextvalue': '\n'.join(text_list),
-                'qdatevalue': today,
-                'stermvalue': "wiley_access",
-                # flags:
-                'textflagvalue': 1,
-                'scoreflagvalue': 0,
-                'speciesflagvalue': 0,
-                'transflagvalue': 0,
-                'crflagvalue': 0,
-                'dateflagvalue': 1,
-                'pdfflagvalue': 1,
-                'badlinkvalue': 0
-            }]
-        except:
-            update_list += [{
-                'doivalue': row.doi,
-                'datevalue': "", 
-                'titlevalue': "",
-                'abstractvalue': "",
-                'pdftextvalue': "",
-                'qdatevalue': today,
-                'stermvalue': "wiley_access",
-                # flags:
-                'textflagvalue': 0,
-                'scoreflagvalue': 0,
-                'speciesflagvalue': 0,
-                'transflagvalue': 0,
-                'crflagvalue': 0,
-                'dateflagvalue': 0,
-                'pdfflagvalue': 1,
-                'badlinkvalue': 1
-            }]
-            continue
-    # END OF MAIN LOOP
-
-    # quit if no output
-    if update_list == []:
-        print(f'Got text from {ngood} out of {nfiles} files from {nrows} DOIs')
-        return 0
+        rows = conn.execute(selecter).all()
 
     # make update instructions 
     updater = links.update().\
@@ -181,15 +143,40 @@ def main():
             donepdf = bindparam('pdfflagvalue'),
             badlink = bindparam('badlinkvalue'),
             donecrossref = bindparam('crflagvalue'),
-            datecheck = bindparam('dateflagvalue')
+            datecheck = bindparam('dateflagvalue'),
+            donefulltext = bindparam('fulltextflagvalue')
             )
-
-    # ... and commit to remote table
-    with engine.connect() as conn:
-        conn.execute(updater, update_list)
-        conn.commit()
-
-    print(f'Got text from {ngood} out of {nfiles} files from {nrows} DOIs')
+    fulltext_updater = links.update().\
+        where(links.c.doi == bindparam('doivalue')).\
+        values(
+            pdftext = bindparam('pdftextvalue'),
+            # flags:
+            gotspecies = bindparam('speciesflagvalue'),
+            donefulltext = 1
+            )
+    fulltext_done_updater = links.update().\
+        where(links.c.doi == bindparam('doivalue')).\
+        values(donefulltext = 1)
+    statements = {
+        'text': updater,
+        'fulltext': fulltext_updater,
+        'fulltext_done': fulltext_done_updater
+        }
+
+    counts = {'rows': 0, 'files': 0, 'good': 0}
+
+    def to_update(doi, result, error):
+        if result != None:
+            counts['good'] += 1
+        return ip.to_update(doi, {'doivalue': doi}, result, error, fulltext,
+                            {'qdatevalue': today, 'stermvalue': "wiley_access"})
+
+    # MAIN LOOP - files are read by a pool of extraction workers, updates written in batches
+    stats = ip.run(wiley_files(rows, counts), to_update, ip.make_writer(engine, statements), fast = fast,
+                   max_pages = pdf2txt.FIRSTPAGES if abstract else None)
+
+    print(ip.summary(stats))
+    print(f"Got text from {counts['good']} out of {counts['files']} files from {counts['rows']} DOIs")
     return 0
 
 #############################################################
@@ -24,6 +24,21 @@ update='
 psql -d postgresql://$PGUSER:$PGPASSWORD@$PGHOST:5432/$PGDATABASE \
     -c "$update"
 
+# PER-LINK TABLES
+echo 'Removing species rows of deleted links ...'
+
+# link_species and species_tokens made before they had foreign keys to links
+# (see process/find_species.py) keep the rows of deleted links
+update='
+    DELETE FROM link_species
+    WHERE NOT EXISTS (SELECT * FROM links WHERE links.link = link_species.link);
+    DELETE FROM species_tokens
+    WHERE NOT EXISTS (SELECT * FROM links WHERE links.link = species_tokens.link)'
+
+# send commmand
+psql -d postgresql://$PGUSER:$PGPASSWORD@$PGHOST:5432/$PGDATABASE \
+    -c "$update"
+
 # DOI TABLE
 echo 'Deduping DOI records  ...'
 